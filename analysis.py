@@ -1,100 +1,210 @@
 
+import logging
+import multiprocessing
 import re
-import nltk
 import string
+import time
+import numpy
 import pymongo
-from nltk.stem.porter import PorterStemmer
+from collections import Counter, deque
+from Queue import Queue, Empty
+import mongo
+import profiling
+from profiling import profiled
 from tree import SuffixTree
-from sklearn import feature_extraction
-
-db = pymongo.MongoClient()['reddit']
 
+@profiled('analysis.search')
 def search(college, term, limit=30):
-    return db.posts.find({
+    return mongo.get_db().posts.find({
             '$text': {'$search': term},
             'college': college
     }).limit(limit)
 
+@profiled('analysis.recent')
 def recent(college, collection, limit=30):
-    return db[collection].find({
+    return mongo.get_db()[collection].find({
         'college': college,
         }).sort('created_utc', pymongo.DESCENDING).limit(limit)
 
+@profiled('analysis.query_college')
 def query_college(college): 
-    return db.posts.find({'college': college})
+    return mongo.get_db().posts.find({'college': college})
+
+logger = logging.getLogger(__name__)
+
+TOKEN = re.compile(r"[\w']+", re.UNICODE)
+
+_worker_db = None
+
+def init_worker():
+    """
+    Pool initializer: every worker process opens one connection, sockets
+    don't survive a fork.
+    """
+    global _worker_db
+    _worker_db = mongo.connect()
+
+def worker_db():
+    """
+    Returns: the connection of the pool worker, the shared database when
+        the task runs in a thread pool
+    """
+    return _worker_db if _worker_db is not None else mongo.get_db()
+
+def continuations(task):
+    """
+    Process pool task: stream the documents of one college and collection
+    matching the term and return the token sequences following it.
+
+    Input:
+        task <tuple>: (college, collection, term, limit, batch_size)
+
+    Returns: (list<list<str>>, query profiles recorded by the task), the
+        sequences are None when the search failed
+    """
+    college, collection, term, limit, batch_size = task
+    formatter = SankeyFormatter(worker_db(), [college], term)
+    try:
+        sequences = list(formatter._process(
+            document['text'] for document in formatter.search(
+                college, collection, limit, batch_size)))
+    except Exception:
+        # A failed task would otherwise never report back to json.
+        logger.exception('Sankey search of {} {} failed'.format(college,
+            collection))
+        sequences = None
+    return sequences, profiling.take()
 
 class SankeyFormatter(object):
+    """
+    Builds the tree of the phrases that follow a term across colleges.
+    Every (college, collection) pair is searched in a process pool and the
+    results are fed into the tree as they come back.
+    """
+
+    COLLECTIONS = ('posts', 'comments')
 
     def __init__(self, db, colleges, term, tree=None):
         self.db = db
         self.colleges = colleges
         self.term = term
-        self.tree = tree or SuffixTree(self.term)
+        self.tree = tree or SuffixTree(self.term.lower())
+        # The continuation runs to the end of the sentence.
+        self.pattern = re.compile(r'\b%s\b([^.!?\n]*)' % re.escape(term),
+            re.IGNORECASE | re.UNICODE)
+        self.complete = True
         return
 
-    def search(self):
-        post_pipe = [
-            {'$match': {
-                '$text': {'$search': self.term},
-                'college': { '$in': self.colleges}
-            }},
-            {'$limit': 4}
-            ,
-
-            {'$group': {
-                '_id': '$college', 
-                'count': {'$sum': 1},
-                'posts': {'$push': '$text'}
-            }},
-        ]
-        comment_pipe = [
-            {'$match': {
-                '$text': {'$search': self.term},
-                'college': { '$in': self.colleges}
-            }},
-            {'$limit': 4},
-            {'$group': {
-                '_id': '$college', 
-                'count': {'$sum': 1},
-                'posts': {'$push': '$body'}
-            }},
-        ]
-
-        return (self.db.post.aggregate(pipeline=post_pipe)['result'] +
-            self.db.comments.aggregate(pipeline=comment_pipe)['result'])
-
-
-    def _process(self, search_results):
-        for college in search_results:
-            relevent = []
-            for post in college['posts']:
-                exp = '%s (.*)' % format(self.term)
-                relevent.extend(re.findall(exp, post))
-            college['relevent'] = relevent
-        return search_results  
-
-    def json(self, processed):
-        for college in processed:
-            for sent in college['relevent']:
-                self.tree.insert(sent.split(' '))
-        return self.tree.json()
-        
+    @profiled('analysis.SankeyFormatter.search')
+    def search(self, college, collection, limit=1000, batch_size=200):
+        """
+        Returns: cursor over the documents of a college matching the term
+        """
+        return self.db[collection].find({
+            '$text': {'$search': self.term},
+            'college': college
+        }, {'_id': False, 'text': True}).batch_size(batch_size).limit(limit)
+
+    def _process(self, texts):
+        """
+        Returns: iterator of the token sequences following the term
+        """
+        for text in texts:
+            for continuation in self.pattern.findall(text or ''):
+                tokens = TOKEN.findall(continuation.lower())
+                if tokens:
+                    yield tokens
+
+    def json(self, limit=1000, batch_size=200, timeout=30, min_count=1,
+            top_k=None, pool=None, max_tasks=64, parallel=None):
+        """
+        Input:
+            limit <int>: maximum documents read per college and collection
+            batch_size <int>: cursor batch size
+            timeout <int>: seconds after which the results received so far
+                are returned and self.complete is set to False
+            min_count <int>: skip branches seen fewer times
+            top_k <int>: only keep the most frequent children of every node
+            pool <multiprocessing.Pool>: defaults to the shared pool
+            max_tasks <int>: (college, collection) searches per request, the
+                others are skipped and self.complete is set to False
+            parallel <int>: tasks submitted to the pool at a time, one per
+                cpu by default
+        """
+        pool = pool or get_pool()
+        parallel = parallel or multiprocessing.cpu_count()
+        tasks = deque((college, collection, self.term, limit, batch_size)
+            for college in self.colleges for collection in self.COLLECTIONS)
+        if len(tasks) > max_tasks:
+            self.complete = False
+            tasks = deque(list(tasks)[:max_tasks])
+        # Tasks are submitted a few at a time so that nothing new is queued
+        # on the shared pool once the deadline has passed.
+        results = Queue()
+        running = 0
+        deadline = time.time() + timeout
+        while tasks or running:
+            while tasks and running < parallel and time.time() < deadline:
+                pool.apply_async(continuations, (tasks.popleft(),),
+                    callback=results.put)
+                running += 1
+            try:
+                sequences, profiles = results.get(
+                    timeout=max(deadline - time.time(), 0))
+            except Empty:
+                self.complete = False
+                break
+            running -= 1
+            profiling.merge(profiles)
+            if sequences is None:
+                self.complete = False
+                continue
+            self.tree.insert_many(sequences)
+        return self.tree.json(min_count=min_count, top_k=top_k)
+
+_pool = None
+
+def get_pool():
+    """
+    Returns: the process pool shared by the requests of the web process
+    """
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.Pool(initializer=init_worker)
+    return _pool
 
 class KeywordExtractor(object):
 
-    def __init__(self, stopwords=nltk.corpus.stopwords.words('english'), 
-                get_text=lambda x: x):
+    def __init__(self, stopwords=None, get_text=lambda x: x, model=None,
+                get_tokens=None):
         """
         Input:
-            stopwords list<str>: list of terms to ignore
+            stopwords list<str>: list of terms to ignore, nltk's english
+                stopwords by default
             get_text <function>: text accessor function to retrieve strings.
+            model <vocabulary.TfidfModel>: persisted model used instead of
+                fitting a vectorizer on every call
+            get_tokens <function>: accessor of the tokens stored by the
+                crawler (see preprocess.tokenize). When given, documents
+                are not tokenized again and get_text isn't used.
 
         """
+        # nltk and sklearn take over a second to import, only pay for them
+        # when keywords are computed.
+        from sklearn import feature_extraction
+        if stopwords is None:
+            import nltk
+            stopwords = nltk.corpus.stopwords.words('english')
         self.stopwords = set(stopwords)
         self.stopwords.add('thanks')
         self.tfidf_transformer = feature_extraction.text.TfidfTransformer()
         self.cv = feature_extraction.text.CountVectorizer(stop_words=stopwords, ngram_range=(1,1))
         self.get_text = get_text
+        self.model = model
+        self.get_tokens = get_tokens
+        if get_tokens:
+            self.cv = feature_extraction.text.CountVectorizer(
+                analyzer=lambda tokens: tokens)
         self.vocabulary_keys = None
         self.vocabulary_values = None
         return
@@ -132,26 +242,101 @@ class KeywordExtractor(object):
         Returns:
 
         """
-        word_counts = self._count_vectorize(
-            [self.get_text(document) for document in documents])
+        return self.compute_sparse(documents).toarray()
+
+    def compute_sparse(self, documents):
+        """
+        Same as compute but keeps the tfidf vectors in a sparse matrix.
+
+        Input:
+            documents list<T> : list of documents
+
+        Returns: scipy.sparse.csr_matrix of l2 normalized tfidf vectors
+        """
+        if self.get_tokens:
+            inputs = [self.get_tokens(document) for document in documents]
+        else:
+            inputs = [self.get_text(document) for document in documents]
+        if self.model:
+            if self.model.vocabulary is not None:
+                self.vocabulary_keys = self.model.vocabulary.keys()
+                self.vocabulary_values = self.model.vocabulary.values()
+            if self.get_tokens:
+                return self.model.transform_tokens(inputs)
+            return self.model.transform(inputs)
+        word_counts = self._count_vectorize(inputs)
         self.vocabulary_keys = self.cv.vocabulary_.keys()
         self.vocabulary_values = self.cv.vocabulary_.values()
-        return self._fit_transform(word_counts).toarray()
+        return self._fit_transform(word_counts)
+
+
+    def terms(self):
+        """
+        Returns: array mapping a column of the tfidf matrix to its term
+        """
+        if self.vocabulary_keys is None:
+            raise ValueError('No vocabulary: compute has not been called or '
+                'the model is hashed')
+        terms = numpy.empty(len(self.vocabulary_keys), dtype=object)
+        terms[list(self.vocabulary_values)] = list(self.vocabulary_keys)
+        return terms
+
+    def extract(self, documents, threshold=0.25, top_k=None):
+        """
+        Input:
+            documents list<T> : list of documents
+            threshold <int> : value to filter out relevant terms
+            top_k <int> : maximum number of terms kept per document
 
+        Returns: list of [(term, score)] per document, best first
+        """
+        return self.keywords(self.compute_sparse(documents), threshold, top_k)
 
-    def extract(self, documents, threshold=0.25):
+    def compute_counts(self, counts, terms):
         """
+        Tfidf vectors of precomputed term counts, e.g. the ones of a
+        snapshot.Snapshot.
+
+        Input:
+            counts <scipy.sparse matrix>: documents x terms counts
+            terms list<str>: term of every column
+
+        Returns: scipy.sparse.csr_matrix of l2 normalized tfidf vectors
+        """
+        self.vocabulary_keys = list(terms)
+        self.vocabulary_values = range(len(terms))
+        return self._fit_transform(counts)
+
+    def keywords(self, tfidf_vectors, threshold=0.25, top_k=None):
+        """
+        Returns: list of [(term, score)] per row of the tfidf matrix
+        """
+        tfidf_vectors = tfidf_vectors.tocsr()
+        terms = self.terms()
+        keywords = []
+        for i in range(tfidf_vectors.shape[0]):
+            start, end = tfidf_vectors.indptr[i], tfidf_vectors.indptr[i + 1]
+            scores = tfidf_vectors.data[start:end]
+            columns = tfidf_vectors.indices[start:end]
+            mask = scores > threshold
+            scores, columns = scores[mask], columns[mask]
+            order = numpy.argsort(-scores, kind='mergesort')[:top_k]
+            keywords.append(zip(terms[columns[order]], scores[order]))
+        return keywords
+
+    def frequencies(self, documents, threshold=0.25, top_k=None, limit=None):
+        """
+        Count how many documents each term is a keyword of.
+
         Input:
             documents list<T> : list of documents
             threshold <int> : value to filter out relevant terms
-            post_process <function> : function to perform once the relevant
-                terms have been identified. Expects (document, terms)
-        """
-        tfidf_vectors = self.compute(documents)
-        for i, document in enumerate(tfidf_vectors):
-            terms = []
-            for j, score in enumerate(document):
-                if score > threshold:
-                    term = self.vocabulary_keys[self.vocabulary_values.index(j)]
-                    terms.append(term)
-            
+            top_k <int> : maximum number of terms kept per document
+            limit <int> : number of terms returned
+
+        Returns: list of (term, count), most frequent first
+        """
+        counts = Counter()
+        for keywords in self.extract(documents, threshold, top_k):
+            counts.update(term for term, _ in keywords)
+        return counts.most_common(limit)
@@ -1,7 +1,59 @@
-from flask import Flask, jsonify, render_template, request
-from crawler import db
+from flask import (Flask, Response, jsonify, render_template, request,
+    stream_with_context)
+import cache
 import handlers
+import indexes
+import metrics
+import mongo
+import profiling
 application = Flask(__name__, static_url_path='')
+NDJSON = 'application/x-ndjson'
+
+@application.before_first_request
+def build_indexes():
+    indexes.ensure_indexes(mongo.get_db())
+
+@application.before_request
+def start_timing():
+    metrics.begin()
+
+@application.errorhandler(handlers.RequestError)
+def request_error(error):
+    response = jsonify(error=str(error))
+    response.status_code = error.status
+    return response
+
+@application.after_request
+def add_server_timing(response):
+    timings = metrics.end(request.endpoint)
+    if timings:
+        response.headers['Server-Timing'] = metrics.server_timing(timings)
+    return response
+
+def cached_response(key, compute):
+    """
+    Answer with 304 when the client already has the result for this cache
+    key, otherwise jsonify the computed result and tag it with the key's
+    ETag.
+    """
+    etag = cache.digest(key)
+    if etag in request.if_none_match:
+        return application.response_class(status=304, headers={'ETag': etag})
+    data = compute()
+    with metrics.stage('encode'):
+        response = jsonify(data=data)
+    response.set_etag(etag)
+    return response
+
+def wants_stream():
+    """
+    Stream when asked for with ?stream=1 or an Accept header preferring
+    newline delimited JSON.
+    """
+    if request.args.get('stream', 0, type=int):
+        return True
+    return request.accept_mimetypes.best_match(
+        ['application/json', NDJSON]) == NDJSON
 
 @application.route('/')
 def root():
@@ -9,12 +61,86 @@ def root():
     
 @application.route('/<college>/<start>/<end>/<threshold>')
 def create_graph(college, start, end, threshold):
-    return jsonify(data=handlers.create_graph_handler(
-        college, start, end, float(threshold)))
+    threshold = float(threshold)
+    top_k = request.args.get('top_k', None, type=int)
+    tables = handlers.graph_tables(top_k,
+        request.args.get('tables', None, type=int))
+    compact = request.args.get('format') == 'compact'
+    reduce_options = {
+        'max_nodes': request.args.get('max_nodes', None, type=int),
+        'rank': request.args.get('rank', 'degree'),
+        'collapse': request.args.get('collapse'),
+        'cluster': request.args.get('cluster', None, type=int)
+    }
+    handlers.graph_reduction(compact, **reduce_options)
+    reduced = (reduce_options['max_nodes'] or reduce_options['collapse'] or
+        reduce_options['cluster'] is not None)
+    if wants_stream() and not reduced:
+        return Response(stream_with_context(handlers.stream_graph_handler(
+            college, start, end, threshold, top_k, tables, compact)),
+            mimetype=NDJSON)
+    key = handlers.graph_cache_key(college, start, end, threshold, top_k,
+        tables, compact, **reduce_options)
+    return cached_response(key, lambda: handlers.create_graph_handler(
+        college, start, end, threshold, top_k=top_k, tables=tables,
+        compact=compact, key=key, **reduce_options))
+
+@application.route('/keywords/<college>/<start>/<end>')
+def get_keywords(college, start, end):
+    return jsonify(data=handlers.keywords_handler(
+        college, start, end,
+        threshold=request.args.get('threshold', 0.25, type=float),
+        top_k=request.args.get('top_k', None, type=int),
+        limit=request.args.get('limit', 50, type=int)))
+
+@application.route('/activity/<college>/<start>/<end>')
+def get_activity(college, start, end):
+    return jsonify(data=handlers.activity_handler(
+        college, start, end, request.args.get('resolution', 'day')))
+
+@application.route('/sankey/<term>')
+def get_sankey(term):
+    colleges = request.args.get('colleges')
+    return jsonify(data=handlers.sankey_handler(
+        term, colleges.split(',') if colleges else None,
+        limit=request.args.get('limit', 1000, type=int),
+        timeout=request.args.get('timeout', 30, type=float),
+        min_count=request.args.get('min_count', 1, type=int),
+        top_k=request.args.get('top_k', None, type=int)))
+
+@application.route('/compare/<start>/<end>')
+def compare_colleges(start, end):
+    colleges = request.args.get('colleges')
+    return jsonify(data=handlers.comparison_handler(
+        start, end, colleges.split(',') if colleges else None,
+        method=request.args.get('method', 'log_odds'),
+        top_k=request.args.get('top_k', 20, type=int)))
+
+@application.route('/search')
+def search():
+    return jsonify(data=handlers.search_handler(
+        request.args.get('q', ''),
+        college=request.args.get('college'),
+        kind=request.args.get('kind'),
+        cursor=request.args.get('cursor'),
+        limit=request.args.get('limit', 20, type=int)))
 
 @application.route('/colleges')
 def get_colleges():
-    return jsonify(data=handlers.get_colleges_handler())
+    key = handlers.colleges_cache_key()
+    return cached_response(key, lambda: handlers.get_colleges_handler(key))
+
+@application.route('/cache')
+def get_cache_stats():
+    return jsonify(data=handlers.cache_stats_handler())
+
+@application.route('/metrics')
+def get_metrics():
+    return jsonify(data=metrics.snapshot())
+
+@application.route('/profile/queries')
+def get_query_profile():
+    return jsonify(data=profiling.summary())
 
 @application.route('/post/<_id>')
 def get_post(_id):
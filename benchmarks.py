@@ -0,0 +1,414 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import deque
+from datetime import datetime
+import numpy as np
+import pymongo
+from scipy import sparse
+from sklearn import feature_extraction
+import similarity
+import tree
+
+
+def synthetic_vectors(n_documents, n_terms=5000, n_topics=50,
+        document_length=40, seed=0):
+    """
+    Tfidf vectors of a synthetic corpus. Each document draws its words from
+    one of a few topics so that the corpus has clusters of similar documents
+    like a subreddit does.
+
+    Input:
+        n_documents <int>: number of documents
+        n_terms <int>: vocabulary size
+        n_topics <int>: number of topics
+        document_length <int>: words per document
+        seed <int>: random seed
+
+    Returns: scipy.sparse.csr_matrix of l2 normalized tfidf vectors
+    """
+    random = np.random.RandomState(seed)
+    topics = random.dirichlet(np.ones(n_terms) * 0.05, n_topics).cumsum(axis=1)
+    assignments = random.randint(n_topics, size=n_documents)
+    rows = np.repeat(np.arange(n_documents), document_length)
+    draws = random.random_sample((n_documents, document_length))
+    columns = np.concatenate([np.searchsorted(topics[topic], draw)
+        for topic, draw in zip(assignments, draws)])
+    columns = np.minimum(columns, n_terms - 1)
+    counts = sparse.coo_matrix((np.ones(len(rows)), (rows, columns)),
+        shape=(n_documents, n_terms)).tocsr()
+    transformer = feature_extraction.text.TfidfTransformer()
+    return transformer.fit_transform(counts).tocsr()
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
+
+
+def recall_benchmark(n_documents=20000, threshold=0.4,
+        tables=(2, 8, 32)):
+    """
+    Compare approximate_edges against the exact threshold_edges.
+
+    Returns: list of {'tables', 'recall', 'seconds', 'speedup'}
+    """
+    vectors = synthetic_vectors(n_documents)
+    exact, exact_seconds = timed(
+        lambda: set(similarity.threshold_edges(vectors, threshold)))
+    results = [{'tables': 'exact', 'recall': 1.0, 'seconds': exact_seconds,
+        'speedup': 1.0}]
+    for n_tables in tables:
+        approximate, seconds = timed(lambda: set(similarity.approximate_edges(
+            vectors, threshold, tables=n_tables)))
+        recall = len(approximate & exact) / float(len(exact) or 1)
+        results.append({'tables': n_tables, 'recall': recall,
+            'seconds': seconds, 'speedup': exact_seconds / seconds})
+    return results
+
+
+class LegacySuffixTree(object):
+    """ The recursive tree.SuffixTree this module's tree benchmark compares
+    against """
+
+    def __init__(self, root_word):
+        self.root = LegacyNode(root_word)
+
+    def insert(self, tokens):
+        self._traverse(self.root, deque(tokens))
+
+    def _traverse(self, node, q):
+        if not q:
+            return
+        term = q.popleft()
+        if term == node.term:
+            self._traverse(node, q)
+            return
+        if term not in node._set:
+            new_node = LegacyNode(term, parent=node)
+            node._set.add(term)
+            node.nodes.append(new_node)
+            self._traverse(new_node, q)
+        else:
+            for n in node.nodes:
+                if term == n.term:
+                    self._traverse(n, q)
+        self._traverse(node, q)
+
+    def json(self):
+        nodes = []
+        edges = []
+        self._json_traverse(self.root, nodes, edges, {}, 0)
+        return {'nodes': nodes, 'edges': edges}
+
+    def _json_traverse(self, node, nodes, edges, location, depth):
+        nodes.append({'term': node.term, 'depth': depth})
+        location[node.term] = len(nodes) - 1
+        if node.parent:
+            edges.append({'source': location[node.parent.term],
+                'target': location[node.term], 'weight': len(node.nodes)})
+        for child in node.nodes:
+            self._json_traverse(child, nodes, edges, location, depth + 1)
+
+
+class LegacyNode(object):
+
+    def __init__(self, term, parent=None):
+        self._set = set()
+        self.term = term
+        self.nodes = []
+        self.parent = parent
+
+
+def synthetic_sentences(n_sentences, n_terms=2000, max_length=12, seed=0):
+    """
+    Zipf distributed token sequences, like the phrases following a search
+    term.
+    """
+    random = np.random.RandomState(seed)
+    terms = ['w{}'.format(i) for i in range(n_terms)]
+    lengths = random.randint(1, max_length + 1, size=n_sentences)
+    ranks = np.minimum(random.zipf(1.3, size=lengths.sum()), n_terms) - 1
+    sentences = []
+    offset = 0
+    for length in lengths:
+        sentences.append([terms[rank] for rank in ranks[offset:offset + length]])
+        offset += length
+    return sentences
+
+
+def tree_benchmark(n_sentences=100000):
+    """
+    Compare tree.SuffixTree with the legacy recursive implementation.
+
+    Returns: list of {'tree', 'insert', 'json', 'nodes'}
+    """
+    sentences = synthetic_sentences(n_sentences)
+    results = []
+    for name, cls in (('legacy', LegacySuffixTree), ('trie', tree.SuffixTree)):
+        trie = cls('root')
+        _, insert_seconds = timed(lambda: [trie.insert(tokens)
+            for tokens in sentences])
+        graph, json_seconds = timed(trie.json)
+        results.append({'tree': name, 'insert': insert_seconds,
+            'json': json_seconds, 'nodes': len(graph['nodes'])})
+    trie = tree.SuffixTree('root')
+    trie.insert_many(sentences)
+    graph, json_seconds = timed(lambda: trie.json(min_count=5, top_k=10))
+    results.append({'tree': 'pruned', 'insert': 0.0, 'json': json_seconds,
+        'nodes': len(graph['nodes'])})
+    return results
+
+
+class SyntheticSubmission(object):
+    """ Stand-in for a praw submission """
+
+    def __init__(self, id, title, selftext, ups, created_utc, comments):
+        self.id = id
+        self.title = title
+        self.selftext = selftext
+        self.url = 'https://www.reddit.com/' + id
+        self.ups = ups
+        self.downs = 0
+        self.created_utc = created_utc
+        self.comments = comments
+        self.num_comments = len(comments)
+        self.edited = False
+
+
+class SyntheticComment(object):
+    """ Stand-in for a praw comment """
+
+    def __init__(self, id, body, ups, created_utc):
+        self.id = id
+        self.body = body
+        self.ups = ups
+        self.downs = 0
+        self.created_utc = created_utc
+        self.edited = False
+
+
+def synthetic_reddit(n_posts, comments_per_post=5, n_terms=3000,
+        n_colleges=3, post_length=30, comment_length=12,
+        start=datetime(2015, 1, 1), days=30, seed=0):
+    """
+    Deterministic posts and comments for every college. Each post picks a
+    topic and its comments mostly reuse the post's topic words, so the
+    corpus has threads of similar documents.
+
+    Input:
+        n_posts <int>: posts per college
+        comments_per_post <int>: average comments per post
+        n_terms <int>: vocabulary size
+        n_colleges <int>: number of colleges
+        post_length, comment_length <int>: words per post and comment
+        start <datetime>: date of the oldest post
+        days <int>: posts are spread over this many days
+        seed <int>: random seed
+
+    Returns: list of (college_info, list<SyntheticSubmission>)
+    """
+    random = np.random.RandomState(seed)
+    terms = np.array(['w{}'.format(i) for i in range(n_terms)])
+    epoch = (start - datetime(1970, 1, 1)).total_seconds()
+
+    def words(topic, length):
+        ranks = np.minimum(random.zipf(1.5, size=length), n_terms) - 1
+        # Half the words come from the thread's topic, the rest are common
+        # words shared by every thread.
+        ranks[::2] = topic[random.randint(len(topic), size=len(ranks[::2]))]
+        return ' '.join(terms[ranks])
+
+    colleges = []
+    for c in range(n_colleges):
+        college_info = {'name': 'College {}'.format(c),
+            'subreddit': 'college{}'.format(c)}
+        posts = []
+        for p in range(n_posts):
+            topic = random.randint(n_terms, size=20)
+            created = epoch + random.randint(days * 86400)
+            comments = [SyntheticComment('c{}_{}_{}'.format(c, p, i),
+                words(topic, comment_length), int(random.randint(50)),
+                created + random.randint(86400))
+                for i in range(random.poisson(comments_per_post))]
+            posts.append(SyntheticSubmission('p{}_{}'.format(c, p),
+                words(topic, 8), words(topic, post_length),
+                int(random.randint(500)), created, comments))
+        colleges.append((college_info, posts))
+    return colleges
+
+
+def benchmark_database(uri=None, name='reddit_benchmark'):
+    """
+    Empty database for the suite: a local Mongo when uri is given,
+    otherwise mongomock's in-memory stand-in.
+    """
+    if uri:
+        client = pymongo.MongoClient(uri)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    client.drop_database(name)
+    return client[name]
+
+
+def suite(scales=(50, 200, 500), uri=None, term='w1'):
+    """
+    Time the data layer and the analysis code on synthetic corpora of
+    increasing size.
+
+    Input:
+        scales list<int>: posts per college of every run
+        uri <string>: Mongo to load the corpora into, in-memory when None
+        term <string>: root word of the suffix tree
+
+    Returns: list of {'posts', 'documents', 'benchmark', 'seconds'}
+    """
+    import analysis
+    import crawler
+    import dao
+    import handlers
+    import mongo
+    results = []
+    try:
+        for n_posts in scales:
+            db = benchmark_database(uri)
+            mongo.set_db(db)
+            service = crawler.MongoDBService(db)
+            colleges = synthetic_reddit(n_posts)
+            timings = []
+            _, seconds = timed(lambda: [service.save(posts, college_info,
+                lambda post: post.comments) for college_info, posts in colleges])
+            timings.append(('MongoDBService.save', seconds))
+            _, seconds = timed(lambda: [service.save(posts, college_info,
+                lambda post: post.comments) for college_info, posts in colleges])
+            timings.append(('MongoDBService.save unchanged', seconds))
+            college = colleges[0][0]['name']
+            posts = list(db.posts.find({'college': college}, dao.POST_FIELDS))
+            for post in posts:
+                post['color'] = 'red'
+            corpus, seconds = timed(dao.join_comments, posts)
+            timings.append(('dao.join_comments', seconds))
+            _, seconds = timed(handlers.cosine_graph, corpus, 0.3)
+            timings.append(('cosine_graph', seconds))
+            _, seconds = timed(handlers.cosine_graph, corpus, 0.3, top_k=10)
+            timings.append(('cosine_graph top_k', seconds))
+            extractor = analysis.KeywordExtractor(get_text=lambda x: x['text'])
+            _, seconds = timed(extractor.compute, corpus)
+            timings.append(('KeywordExtractor.compute', seconds))
+            _, seconds = timed(extractor.extract, corpus)
+            timings.append(('KeywordExtractor.extract', seconds))
+            formatter = analysis.SankeyFormatter(db, [college], term)
+            sequences = list(formatter._process(doc['text'] for doc in corpus))
+            trie = tree.SuffixTree(term)
+            _, seconds = timed(trie.insert_many, sequences)
+            timings.append(('SuffixTree.insert', seconds))
+            _, seconds = timed(trie.json)
+            timings.append(('SuffixTree.json', seconds))
+            for benchmark, seconds in timings:
+                results.append({'posts': n_posts, 'documents': len(corpus),
+                    'benchmark': benchmark, 'seconds': seconds})
+    finally:
+        # Back to the configured database.
+        mongo.set_db(None)
+    return results
+
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.time()
+import {module}
+print time.time() - start, ' '.join(name for name in ('nltk', 'sklearn')
+    if name in sys.modules)
+'''
+
+def import_benchmark(modules=('application', 'handlers', 'crawler'),
+        repeat=3):
+    """
+    Time a cold import of every module in a fresh interpreter, i.e. the
+    startup cost of the web and crawler processes.
+
+    Returns: list of {'posts', 'documents', 'benchmark', 'seconds',
+        'loaded'} with loaded the heavy libraries the import pulled in
+    """
+    results = []
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in modules:
+        timings = []
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c',
+                IMPORT_SCRIPT.format(module=module)], cwd=directory)
+            seconds, _, loaded = output.strip().partition(' ')
+            timings.append(float(seconds))
+        results.append({'posts': 0, 'documents': 0,
+            'benchmark': 'import ' + module, 'seconds': min(timings),
+            'loaded': loaded.split()})
+    return results
+
+
+def record(results, kind, path='benchmarks.json', label=None):
+    """
+    Append a run to the results file, which keeps the runs of every kind of
+    benchmark.
+
+    Input:
+        kind <string>: 'suite' or 'imports', runs are only compared to the
+            runs of the same kind
+
+    Returns: the previous run of the same kind, None for the first one
+    """
+    runs = []
+    if os.path.exists(path):
+        with open(path) as f:
+            runs = json.load(f)
+    previous = [run for run in runs if run.get('kind') == kind]
+    runs.append({'time': datetime.utcnow().isoformat(), 'kind': kind,
+        'label': label, 'results': results})
+    with open(path, 'w') as f:
+        json.dump(runs, f, indent=1)
+    return previous[-1] if previous else None
+
+
+def compare(previous, results, tolerance=1.2):
+    """
+    Returns: list of (posts, benchmark, previous seconds, seconds, ratio)
+        of the benchmarks that got slower than tolerance times
+    """
+    before = dict(((result['posts'], result['benchmark']), result['seconds'])
+        for result in previous['results'])
+    regressions = []
+    for result in results:
+        key = (result['posts'], result['benchmark'])
+        if before.get(key) and result['seconds'] > before[key] * tolerance:
+            regressions.append(key + (before[key], result['seconds'],
+                result['seconds'] / before[key]))
+    return regressions
+
+
+if __name__ == '__main__':
+    benchmark = sys.argv[1] if len(sys.argv) > 1 else 'similarity'
+    if benchmark in ('suite', 'imports'):
+        # python benchmarks.py suite [mongodb uri], or imports
+        if benchmark == 'imports':
+            results = import_benchmark()
+        else:
+            results = suite(uri=sys.argv[2] if len(sys.argv) > 2 else None)
+        for result in results:
+            print '{posts:>6} {documents:>7} {benchmark:<26} {seconds:.3f}s'.format(
+                **result)
+        previous = record(results, benchmark)
+        if previous:
+            for posts, name, before, after, ratio in compare(previous, results):
+                print 'slower: {} {} {:.3f}s -> {:.3f}s x{:.2f}'.format(
+                    posts, name, before, after, ratio)
+    elif benchmark == 'tree':
+        for result in tree_benchmark():
+            print '{tree:>7} insert={insert:.2f}s json={json:.2f}s nodes={nodes}'.format(
+                **result)
+    else:
+        for result in recall_benchmark():
+            print '{tables:>6} recall={recall:.3f} {seconds:.2f}s x{speedup:.1f}'.format(
+                **result)
@@ -0,0 +1,127 @@
+import cPickle as pickle
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def digest(key):
+    """
+    Stable hex digest of a cache key. Used for on-disk file names and ETags.
+    """
+    return hashlib.sha1(repr(key)).hexdigest()
+
+
+class LRUCache(object):
+    """
+    Least recently used cache with an optional on-disk second tier. Entries
+    evicted from memory stay on disk until the disk tier is full.
+    """
+
+    def __init__(self, max_entries=128, directory=None, max_disk_entries=1024):
+        """
+        Input:
+            max_entries <int>: number of values kept in memory
+            directory <string>: directory of the on-disk tier, disabled when
+                None
+            max_disk_entries <int>: number of values kept on disk
+        """
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                self.hits += 1
+                return value
+        value = self._read(key)
+        if value is not None:
+            with self.lock:
+                self.disk_hits += 1
+            self._remember(key, value)
+            return value
+        with self.lock:
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self._remember(key, value)
+        self._write(key, value)
+
+    def get_or_compute(self, key, compute):
+        """
+        Input:
+            key: hashable cache key
+            compute <function>: called without arguments on a miss
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses
+            }
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, digest(key) + '.pickle')
+
+    def _read(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                stored_key, value = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        # Guard against digest collisions.
+        return value if stored_key == key else None
+
+    def _write(self, key, value):
+        if not self.directory:
+            return
+        path = self._path(key)
+        temporary = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        with open(temporary, 'wb') as f:
+            pickle.dump((key, value), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary, path)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = [os.path.join(self.directory, name)
+            for name in os.listdir(self.directory) if name.endswith('.pickle')]
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,213 @@
+import sys
+from collections import Counter
+from datetime import datetime, timedelta
+import numpy as np
+from scipy import sparse
+import analysis
+import dao
+import mongo
+import vocabulary
+
+COLLECTION = 'keyword_comparisons'
+METHODS = ('log_odds', 'tfidf')
+
+def college_counts(task):
+    """
+    Process pool task: stream the posts and comments of one college in a
+    date range and count its terms.
+
+    Input:
+        task <tuple>: (college, start, end, max_documents)
+
+    Returns: (college, Counter of term counts, number of documents)
+    """
+    college, start, end, max_documents = task
+    database = analysis.worker_db()
+    counts = Counter()
+    documents = 0
+    for collection in ('posts', 'comments'):
+        for document in database[collection].find({'college': college,
+                'created_utc': {'$gte': start, '$lte': end}},
+                {'_id': False, 'text': True, 'tokens': True}).limit(
+                max_documents or 0):
+            counts.update(vocabulary.analyze(document))
+            documents += 1
+    return college, counts, documents
+
+
+def count_matrix(results):
+    """
+    Merge the per-college counts into one shared vocabulary.
+
+    Input:
+        results list<(college, Counter, int)>: college_counts results
+
+    Returns: (colleges, terms, colleges x terms scipy.sparse.csr_matrix,
+        documents per college)
+    """
+    results = sorted(results)
+    codes = {}
+    rows, columns, values = [], [], []
+    for row, (_, counts, _) in enumerate(results):
+        for term, count in counts.iteritems():
+            rows.append(row)
+            columns.append(codes.setdefault(term, len(codes)))
+            values.append(count)
+    terms = np.empty(len(codes), dtype=object)
+    for term, code in codes.iteritems():
+        terms[code] = term
+    matrix = sparse.csr_matrix((values, (rows, columns)),
+        shape=(len(results), len(codes)), dtype=float)
+    return ([college for college, _, _ in results], terms, matrix,
+        [documents for _, _, documents in results])
+
+
+def log_odds(counts, columns=None, prior=0.01):
+    """
+    Log-odds ratio of every term in each college against all the other
+    colleges, with an informative Dirichlet prior proportional to the
+    overall term frequencies, divided by its standard deviation (Monroe et
+    al., Fightin' Words). Rare terms don't dominate like with raw ratios.
+
+    Input:
+        counts <scipy.sparse matrix>: colleges x terms counts
+        columns array<int>: only score these terms
+        prior <float>: pseudo-count of the prior per observed word
+
+    Returns: colleges x columns numpy array of z-scores
+    """
+    counts = sparse.csr_matrix(counts)
+    college_totals = np.asarray(counts.sum(axis=1), dtype=float)
+    alpha_0 = (prior * np.asarray(counts.sum(axis=0)) + 1e-3).sum()
+    if columns is not None:
+        counts = counts[:, columns]
+    counts = counts.toarray()
+    totals = counts.sum(axis=0)
+    alpha = prior * totals + 1e-3
+    rest = totals - counts
+    rest_totals = college_totals.sum() - college_totals
+    delta = (np.log((counts + alpha) / (college_totals + alpha_0 - counts -
+        alpha)) - np.log((rest + alpha) / (rest_totals + alpha_0 - rest -
+        alpha)))
+    variance = 1.0 / (counts + alpha) + 1.0 / (rest + alpha)
+    return delta / np.sqrt(variance)
+
+
+def tfidf(counts, columns=None):
+    """
+    Tfidf of every term with each college as one document.
+
+    Returns: colleges x columns numpy array
+    """
+    counts = sparse.csr_matrix(counts)
+    lengths = np.asarray(counts.sum(axis=1), dtype=float)
+    if columns is not None:
+        counts = counts[:, columns]
+    counts = counts.toarray()
+    frequencies = (counts > 0).sum(axis=0)
+    idf = np.log((1.0 + len(counts)) / (1.0 + frequencies)) + 1.0
+    return counts / np.maximum(lengths, 1) * idf
+
+
+def compare(colleges, start, end, method='log_odds', top_k=20, min_count=5,
+        pool=None, max_documents=None, timeout=None):
+    """
+    Distinctive terms of every college in a date range. Every college is
+    read once, in parallel, and the scores are computed over the shared
+    vocabulary of all of them.
+
+    Input:
+        colleges list<string>: college names
+        start, end <datetime>: date range
+        method <string>: 'log_odds' or 'tfidf'
+        top_k <int>: terms returned per college
+        min_count <int>: ignore terms used fewer times by the college
+        pool <multiprocessing.Pool>: defaults to analysis' shared pool
+        max_documents <int>: posts and comments read per college, each,
+            all of them when None
+        timeout <float>: seconds to wait for the colleges to be read,
+            raises multiprocessing.TimeoutError past it. No limit when None
+
+    Returns: {'colleges': {college: {'documents', 'terms': [{'term',
+        'score', 'count'}]}}, 'vocabulary': number of distinct terms}
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown method {}'.format(method))
+    pool = pool or analysis.get_pool()
+    results = pool.map_async(college_counts,
+        [(college, start, end, max_documents) for college in colleges]).get(
+        timeout)
+    names, terms, counts, documents = count_matrix(results)
+    # Only the terms frequent enough in some college are scored, which
+    # drops the long tail of the vocabulary before going dense.
+    columns = np.flatnonzero(np.asarray(counts.max(axis=0).todense()).ravel()
+        >= min_count)
+    if method == 'log_odds':
+        scores = log_odds(counts, columns)
+    else:
+        scores = tfidf(counts, columns)
+    dense = counts[:, columns].toarray()
+    table = {}
+    for row, college in enumerate(names):
+        candidates = np.flatnonzero(dense[row] >= min_count)
+        best = candidates[np.argsort(-scores[row, candidates],
+            kind='mergesort')[:top_k]]
+        table[college] = {
+            'documents': documents[row],
+            'terms': [{'term': terms[columns[i]],
+                'score': float(scores[row, i]),
+                'count': int(dense[row, i])} for i in best]
+        }
+    return {'colleges': table, 'vocabulary': len(terms)}
+
+
+def stored(db, start, end, method, top_k, colleges, watermark,
+        max_age=timedelta(hours=6)):
+    """
+    Input:
+        watermark <tuple>: current dao.watermark('*')
+
+    Returns: the comparison saved for these parameters, None if there is
+        none or the crawler wrote data since and it is older than max_age
+    """
+    record = db[COLLECTION].find_one(comparison_spec(start, end, method,
+        top_k, colleges))
+    if not record:
+        return None
+    if (record['watermark'] == list(watermark) or
+            datetime.utcnow() - record['created'] < max_age):
+        return record['comparison']
+    return None
+
+def store(db, start, end, method, top_k, colleges, comparison, watermark):
+    spec = comparison_spec(start, end, method, top_k, colleges)
+    record = dict(spec, comparison=comparison, watermark=list(watermark),
+        created=datetime.utcnow())
+    db[COLLECTION].update(spec, record, upsert=True)
+
+def comparison_spec(start, end, method, top_k, colleges):
+    return {'start': start, 'end': end, 'method': method, 'top_k': top_k,
+        'colleges': sorted(colleges)}
+
+
+def batch(db, colleges, windows=(7, 30), methods=METHODS, top_k=20):
+    """
+    Precompute the comparisons of the trailing windows (in days) so the
+    route answers them without reading the corpus.
+    """
+    end = datetime.utcnow().replace(hour=0, minute=0, second=0,
+        microsecond=0)
+    names = [college['name'] for college in colleges]
+    watermark = dao.watermark('*')
+    for days in windows:
+        start = end - timedelta(days=days)
+        for method in methods:
+            store(db, start, end, method, top_k, names,
+                compare(names, start, end, method, top_k), watermark)
+
+
+if __name__ == '__main__':
+    # python comparison.py [days ...]
+    from config import SUBREDDITS
+    windows = [int(days) for days in sys.argv[1:]] or (7, 30)
+    batch(mongo.get_db(), SUBREDDITS, windows)
@@ -26,3 +26,35 @@ PRAW_PASSWORD = 'password'
 CREDENTIALS = [ ('gt-elc', 'password'),
                 ('elc-gt', 'password'), 
                 ('elc-gt3', 'wallmoose17')]
+
+# Result cache of the web process. Setting CACHE_DIRECTORY adds an on-disk
+# tier behind the in-memory LRU.
+CACHE_ENTRIES = 64
+CACHE_DIRECTORY = None
+
+# Explain every dao/analysis query and record its plan. Costs an extra round
+# trip per query, leave off in production.
+QUERY_PROFILING = False
+SLOW_QUERY_MS = 100
+
+# Search result pages kept in memory.
+SEARCH_CACHE_ENTRIES = 256
+
+# Per-stage request timings, served in the Server-Timing header and
+# aggregated under /metrics.
+REQUEST_METRICS = True
+
+# Shared connection pool of the process, see mongo.py. Size it to the number
+# of threads serving requests or crawling.
+MONGO_URI = 'mongodb://localhost:27017'
+MONGO_DATABASE = 'reddit'
+MONGO_POOL_SIZE = 16
+
+# Bounds of the keyword comparisons computed on a request, see comparison.py.
+COMPARISON_MAX_DAYS = 92
+COMPARISON_MAX_DOCUMENTS = 50000
+COMPARISON_TIMEOUT = 60
+
+# Newest post date and write version of every college, written by the
+# crawler and read into the cache keys of the web process.
+WATERMARK_COLLECTION = 'watermarks'
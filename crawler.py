@@ -1,18 +1,26 @@
+import hashlib
 import logging
 import pymongo
 import praw
 import random
 import string
+import sys
 import threading
+import time
+from bson.son import SON
+from collections import Counter, deque
 from datetime import datetime, timedelta
-from config import SUBREDDITS, CREDENTIALS
+from config import SUBREDDITS, CREDENTIALS, WATERMARK_COLLECTION
+import indexes
+import mongo
+import pipeline
+import preprocess
+import rollups
+import vocabulary
 from Queue import Queue
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logging.getLogger('requests').setLevel(logging.CRITICAL)
 logger = logging.getLogger(__name__)
 
-db = pymongo.MongoClient()['reddit']
 
 class RedditApiClient(object):
     """ Wrapper around praw """
@@ -20,13 +28,15 @@ class RedditApiClient(object):
     CLOUD_QUERY = 'timestamp:{end}..{start}'
     CLOUD_SEARCH = 'cloudsearch'
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, **config):
         """
         Input:
             username <string> : reddit username
             password <string> : reddit password
+            config : praw config overrides, e.g. api_request_delay or the
+                domains of a stub api server
         """
-        self.reddit = praw.Reddit(self.random_name())
+        self.reddit = praw.Reddit(self.random_name(), **config)
         self.reddit.login(username, password)
         return
 
@@ -79,25 +89,106 @@ class RedditApiClient(object):
         return int(dt.strftime('%s'))
 
 
+class TokenBucket(object):
+    """ Thread safe token bucket rate limiter """
+
+    def __init__(self, rate, capacity=1):
+        """
+        Input:
+            rate <float> : tokens added per second
+            capacity <int> : maximum number of tokens, i.e. the burst size
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                    self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimitedClient(object):
+    """
+    Wraps a RedditApiClient so that every call spends a token of its
+    credential's bucket and failed calls are retried with exponential
+    backoff.
+    """
+
+    def __init__(self, client, bucket, retries=3, backoff=2):
+        """
+        Input:
+            client <RedditApiClient> : client logged in with one credential
+            bucket <TokenBucket> : rate limiter of that credential
+            retries <int> : attempts after the first failure
+            backoff <float> : seconds before the first retry, doubled after
+                every failure
+        """
+        self.client = client
+        self.bucket = bucket
+        self.retries = retries
+        self.backoff = backoff
+
+    def get_posts(self, subreddit, start, end, sort='new'):
+        # Listings are lazy, materialize them so that failures happen inside
+        # the retry loop.
+        return self.call(lambda: list(
+            self.client.get_posts(subreddit, start, end, sort)))
+
+    def get_comments(self, post):
+        return self.call(lambda: self.client.get_comments(post))
+
+    def call(self, request):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                return request()
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                logger.warning('Request failed, retrying in {}s'.format(delay),
+                    exc_info=True)
+                time.sleep(delay)
+                delay *= 2
+
+
 class RedditWorker(threading.Thread):
     """ self contained thread object """
 
     def __init__(self, reddit_client, database_client, q,
-            interval=timedelta(days=1)):
+            interval=timedelta(days=1), checkpoint=None):
         """
         Input:
             reddit_client <praw.reddit> : praw.reddit object used for
                 communicating with reddit api
             database_client: custom class that has a save method
             q <Queue> : queue containing college infos
-            interval <timedelta> amount to shift the window every time a query
-                is created
+            interval <timedelta> initial size of the query windows, adapted
+                to the activity of the subreddit
+            checkpoint <CrawlCheckpoint> : completed windows, crawls resume
+                from it when given
         """
         threading.Thread.__init__(self)
         self.reddit_client = reddit_client
         self.database_client = database_client
         self.q = q
         self.interval = interval
+        self.policy = WindowPolicy(initial=interval)
+        self.checkpoint = checkpoint
         return
 
     def run(self):
@@ -107,32 +198,217 @@ class RedditWorker(threading.Thread):
         while True:
             college_info = self.q.get()
             logging.info('Started {}'.format(college_info['name']))
-            start_date = datetime.now()
-            end_date = self.get_start_time(college_info)
-            if not end_date:
-                # The college is not in the database so just get the last month
-                # worth of data
-                end_date = start_date - timedelta(weeks=4)
-            self.crawl(college_info, start_date, end_date)
-            logger.info('Finished {} from {} to {}'.format(
-                college_info['name'], start_date, end_date))
-            self.q.task_done()
+            start_date, end_date = crawl_range(
+                self.database_client, college_info, self.checkpoint)
+            try:
+                self.crawl(college_info, start_date, end_date)
+                logger.info('Finished {} from {} to {}'.format(
+                    college_info['name'], start_date, end_date))
+            except Exception:
+                logger.exception('Failed {}'.format(college_info['name']))
+            finally:
+                self.q.task_done()
 
     def crawl(self, college_info, start, end):
-        college = college_info['name']
         subreddit = college_info['subreddit']
+        ranges = [(start, end)]
+        if self.checkpoint:
+            ranges = self.checkpoint.remaining(subreddit, start, end)
+        for range_start, range_end in ranges:
+            for upper, lower, posts in self.policy.listings(
+                    self.reddit_client, subreddit, range_start, range_end):
+                self.database_client.save(posts, college_info,
+                    self.reddit_client.get_comments)
+                if self.checkpoint:
+                    self.checkpoint.mark(subreddit, upper, lower)
+
+
+def crawl_range(database_client, college_info, checkpoint=None):
+    """
+    Returns: (start, end) datetimes of the next crawl of a college, walking
+        back from now to the oldest checkpointed window or, without
+        checkpoints, the newest post already in the database.
+    """
+    start_date = datetime.now()
+    end_date = None
+    if checkpoint:
+        end_date = checkpoint.earliest(college_info['subreddit'])
+    if not end_date:
+        end_date = database_client.last_post_date(college_info)
+    if not end_date:
+        # The college is not in the database so just get the last month
+        # worth of data
+        end_date = start_date - timedelta(weeks=4)
+    return start_date, end_date
+
+
+class WindowPolicy(object):
+    """
+    Adapts the size of the search windows to the activity of a subreddit.
+    Cloudsearch silently truncates large result sets, so windows that come
+    back saturated are split and retried, while sparse windows double the
+    size of the next one.
+    """
+
+    def __init__(self, initial=timedelta(days=1), minimum=timedelta(hours=1),
+            maximum=timedelta(weeks=4), saturation=900):
+        """
+        Input:
+            initial <timedelta> : size of the first window
+            minimum <timedelta> : windows this small are never split
+            maximum <timedelta> : windows never grow past this
+            saturation <int> : result count at which a window is considered
+                truncated
+        """
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.saturation = saturation
+
+    def listings(self, client, subreddit, start, end):
+        """
+        Walk from start back to end.
+
+        Returns: iterator of (upper, lower, posts) covering the range
+        """
+        size = self.initial
         upper = start
-        lower = upper - self.interval
         while upper > end:
-            posts = self.reddit_client.get_posts(subreddit, upper, lower)
-            self.database_client.save(posts, college_info, RedditApiClient.get_comments)
+            lower = max(upper - size, end)
+            posts = list(client.get_posts(subreddit, upper, lower))
+            if (len(posts) >= self.saturation and
+                    upper - lower > self.minimum):
+                size = max((upper - lower) / 2, self.minimum)
+                continue
+            yield upper, lower, posts
+            if len(posts) < self.saturation / 4:
+                size = min(size * 2, self.maximum)
             upper = lower
-            lower -= self.interval
-            if lower < end:
-                lower = end
 
-    def get_start_time(self, college_info):
-        return self.database_client.last_post_date(college_info)
+
+class CrawlCheckpoint(object):
+    """
+    Persisted list of the windows of every subreddit whose posts have all
+    been written. Crawls only visit the gaps between them, so an interrupted
+    crawl resumes where it stopped and parallel backfills of disjoint ranges
+    don't repeat each other's work.
+    """
+
+    def __init__(self, db, collection='crawl_checkpoints', compact_after=50):
+        """
+        Input:
+            db: pymongo database
+            collection <string>: name of the checkpoint collection
+            compact_after <int>: merge overlapping windows once a subreddit
+                has more than this many
+        """
+        self.db = db
+        self.collection = collection
+        self.compact_after = compact_after
+
+    def mark(self, subreddit, upper, lower):
+        self.db[self.collection].update({'subreddit': subreddit},
+            {'$push': {'windows': self.window(upper, lower)}}, upsert=True)
+
+    @staticmethod
+    def window(upper, lower):
+        # $pullAll compares documents field by field, keep the order fixed.
+        return SON([('upper', upper), ('lower', lower)])
+
+    def completed(self, subreddit):
+        """
+        Returns: merged list of (upper, lower) windows, newest first
+        """
+        record = self.db[self.collection].find_one({'subreddit': subreddit})
+        if not record:
+            return []
+        windows = sorted(((w['upper'], w['lower']) for w in record['windows']),
+            reverse=True)
+        merged = []
+        for upper, lower in windows:
+            if merged and upper >= merged[-1][1]:
+                merged[-1] = (merged[-1][0], min(lower, merged[-1][1]))
+            else:
+                merged.append((upper, lower))
+        if len(record['windows']) > self.compact_after:
+            self.compact(subreddit, record['windows'], merged)
+        return merged
+
+    def compact(self, subreddit, windows, merged):
+        # Pull exactly the windows that were read so that windows pushed
+        # concurrently survive.
+        existing = set((w['upper'], w['lower']) for w in windows)
+        merged = set(merged)
+        collection = self.db[self.collection]
+        collection.update({'subreddit': subreddit},
+            {'$push': {'windows': {'$each': [self.window(upper, lower)
+                for upper, lower in merged - existing]}}})
+        collection.update({'subreddit': subreddit},
+            {'$pullAll': {'windows': [self.window(upper, lower)
+                for upper, lower in existing - merged]}})
+
+    def earliest(self, subreddit):
+        completed = self.completed(subreddit)
+        return completed[-1][1] if completed else None
+
+    def remaining(self, subreddit, start, end):
+        """
+        Returns: list of the (upper, lower) gaps between start and the
+            earlier end that haven't been crawled, newest first
+        """
+        gaps = []
+        upper = start
+        for done_upper, done_lower in self.completed(subreddit):
+            if done_lower >= upper:
+                continue
+            if done_upper <= end:
+                break
+            if done_upper < upper:
+                gaps.append((upper, max(done_upper, end)))
+            upper = done_lower
+            if upper <= end:
+                return gaps
+        if upper > end:
+            gaps.append((upper, end))
+        return gaps
+
+
+class WindowTracker(object):
+    """
+    Marks a pipeline listing window in the checkpoint once the window has
+    been fully listed and every one of its posts has been written.
+    """
+
+    def __init__(self, checkpoint, subreddit, upper, lower):
+        self.checkpoint = checkpoint
+        self.subreddit = subreddit
+        self.upper = upper
+        self.lower = lower
+        self.pending = 0
+        self.listed = False
+        self.lock = threading.Lock()
+
+    def add(self):
+        with self.lock:
+            self.pending += 1
+
+    def finish_listing(self):
+        with self.lock:
+            self.listed = True
+            done = self.pending == 0
+        if done:
+            self.mark()
+
+    def written(self):
+        with self.lock:
+            self.pending -= 1
+            done = self.listed and self.pending == 0
+        if done:
+            self.mark()
+
+    def mark(self):
+        if self.checkpoint:
+            self.checkpoint.mark(self.subreddit, self.upper, self.lower)
 
 
 class MultiThreadedCrawler(object):
@@ -154,7 +430,7 @@ class MultiThreadedCrawler(object):
         for i in range(8):
             logger.info('Spawned #{}'.format(i))
             username, password = self.credentials
-            client = MongoDBService(pymongo.MongoClient()['reddit'])
+            client = default_database_service()
             worker = RedditWorker(
                 RedditApiClient(username, password), client,  q)
             worker.daemon = True
@@ -168,48 +444,565 @@ class MultiThreadedCrawler(object):
         q.join()
 
 
+class ConcurrentCrawler(object):
+    """
+    Crawls with every configured credential at once. Each credential gets
+    its own client, token bucket and pool of workers; all workers pull
+    colleges from one shared queue so the load spreads across accounts.
+    """
+
+    def __init__(self, credentials, colleges, requests_per_second=0.5,
+            burst=5, workers_per_credential=4, client_factory=None,
+            database_factory=None):
+        """
+        Input:
+            credentials list<(username, password)>: reddit accounts
+            colleges[] <dict>: array of {'name', 'subreddit'}
+            requests_per_second <float>: rate limit of each credential
+            burst <int>: requests a credential may issue back to back
+            workers_per_credential <int>: requests kept in flight per
+                credential
+            client_factory <function>: (username, password) -> api client
+            database_factory <function>: () -> MongoDBService
+        """
+        self.credentials = credentials
+        self.colleges = colleges
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.workers_per_credential = workers_per_credential
+        # praw's own request delay is shared by every instance in the
+        # process, the token buckets take over its job.
+        self.client_factory = client_factory or (lambda username, password:
+            RedditApiClient(username, password, api_request_delay=0))
+        self.database_factory = database_factory or default_database_service
+
+    def start(self):
+        q = Queue()
+        for username, password in self.credentials:
+            bucket = TokenBucket(self.requests_per_second, self.burst)
+            client = RateLimitedClient(
+                self.client_factory(username, password), bucket)
+            for i in range(self.workers_per_credential):
+                logger.info('Spawned {} #{}'.format(username, i))
+                worker = RedditWorker(client, self.database_factory(), q)
+                worker.daemon = True
+                worker.start()
+        for college in self.colleges:
+            logger.info('Queueing {}'.format(college['name']))
+            q.put(college)
+        q.join()
+
+
+class BatchWriter(object):
+    """
+    Last stage of the crawl pipeline. Accumulates serialized posts per
+    college and writes them with MongoDBService.write once a batch is full.
+    """
+
+    def __init__(self, database_client, batch_size=None):
+        self.database_client = database_client
+        self.batch_size = batch_size or database_client.batch_size
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, item):
+        college_info, post_record, comment_records, tracker = item
+        with self.lock:
+            batch = self.pending.setdefault(college_info['name'],
+                [college_info, [], [], 0])
+            batch[1].append((post_record, comment_records))
+            batch[2].append(tracker)
+            batch[3] += 1 + len(comment_records or ())
+            if batch[3] < self.batch_size:
+                return ()
+            del self.pending[college_info['name']]
+        self.write(*batch)
+        return ()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for batch in pending.values():
+            self.write(*batch)
+        return ()
+
+    def write(self, college_info, records, trackers, size):
+        self.database_client.write(records, college_info)
+        for tracker in trackers:
+            tracker.written()
+
+
+class PipelineCrawler(object):
+    """
+    Crawls in four stages connected by bounded queues: post listing,
+    comment tree expansion, serialization and batched writing. Each stage
+    has its own pool of threads so reddit and Mongo waits overlap.
+    """
+
+    def __init__(self, clients, database_client, colleges,
+            interval=timedelta(days=1), checkpoint=None, listing_workers=2,
+            expand_workers=8, serialize_workers=1, write_workers=2,
+            queue_size=200, log_interval=30):
+        """
+        Input:
+            clients list: api clients (e.g. one RateLimitedClient per
+                credential) used in turn by the network stages
+            database_client <MongoDBService>: database writer
+            colleges[] <dict>: array of {'name', 'subreddit'}
+            interval <timedelta>: initial size of the listing windows
+            checkpoint <CrawlCheckpoint>: completed windows, crawls resume
+                from it when given
+            listing_workers, expand_workers, serialize_workers,
+                write_workers <int>: threads per stage
+            queue_size <int>: capacity of every stage's input queue
+            log_interval <int>: seconds between metric log lines
+        """
+        self.clients = clients
+        self.database_client = database_client
+        self.colleges = colleges
+        self.policy = WindowPolicy(initial=interval)
+        self.checkpoint = checkpoint
+        self.log_interval = log_interval
+        self.started = False
+        self.client_index = 0
+        self.lock = threading.Lock()
+        # (college, reddit id) of the posts whose comments couldn't be
+        # fetched.
+        self.failed = deque(maxlen=1000)
+        self.pipeline = pipeline.Pipeline([
+            pipeline.Stage('list', self.list_posts, listing_workers,
+                queue_size),
+            pipeline.Stage('expand', self.expand, expand_workers, queue_size),
+            pipeline.Stage('serialize', self.serialize, serialize_workers,
+                queue_size),
+            pipeline.Stage('write', BatchWriter(database_client),
+                write_workers, queue_size)
+        ])
+
+    def start(self):
+        """
+        Crawl every college and block until all posts are written.
+
+        Returns: the metrics of every stage
+        """
+        ranges = []
+        for college_info in self.colleges:
+            start, end = crawl_range(self.database_client, college_info,
+                self.checkpoint)
+            ranges.append((college_info, start, end))
+        return self.run(ranges)
+
+    def backfill(self, college_info, start, end, parts=4):
+        """
+        Crawl the range between start and the earlier end as parts disjoint
+        ranges listed in parallel.
+        """
+        step = (start - end) / parts
+        ranges = [(college_info, start - step * i,
+            end if i == parts - 1 else start - step * (i + 1))
+            for i in range(parts)]
+        return self.run(ranges)
+
+    def run(self, ranges):
+        """
+        Input:
+            ranges list<(college_info, start, end)>: ranges to crawl
+        """
+        if not self.started:
+            self.pipeline.start(self.log_interval)
+            self.started = True
+        for college_info, start, end in ranges:
+            gaps = [(start, end)]
+            if self.checkpoint:
+                gaps = self.checkpoint.remaining(college_info['subreddit'],
+                    start, end)
+            for upper, lower in gaps:
+                self.pipeline.put((college_info, upper, lower))
+        self.pipeline.join()
+        metrics = self.pipeline.metrics()
+        for stage in metrics:
+            logger.info('{stage}: {processed} items {throughput:.1f}/s '
+                'max queue {max_queue_depth}'.format(**stage))
+        if self.failed:
+            logger.warning('{} posts without comments, their windows will be '
+                'crawled again'.format(len(self.failed)))
+        logger.info('Records: {}'.format(', '.join('{} {}'.format(name, count)
+            for name, count in sorted(self.database_client.stats().items()))))
+        return metrics
+
+    def next_client(self):
+        with self.lock:
+            self.client_index = (self.client_index + 1) % len(self.clients)
+            return self.clients[self.client_index]
+
+    def list_posts(self, item):
+        college_info, start, end = item
+        subreddit = college_info['subreddit']
+        for upper, lower, posts in self.policy.listings(
+                self.next_client(), subreddit, start, end):
+            tracker = WindowTracker(self.checkpoint, subreddit, upper, lower)
+            stored = self.database_client.stored_posts(
+                [post.id for post in posts])
+            for post in posts:
+                tracker.add()
+                yield college_info, post, stored.get(post.id), tracker
+            tracker.finish_listing()
+
+    def expand(self, item):
+        college_info, post, stored, tracker = item
+        if self.database_client.comments_unchanged(post, stored):
+            comments = None
+        else:
+            try:
+                comments = self.next_client().get_comments(post)
+            except Exception:
+                # The post's window is never marked, the next crawl lists it
+                # again.
+                logger.exception('Comments of {} in {} failed'.format(
+                    post.id, college_info['name']))
+                with self.lock:
+                    self.failed.append((college_info['name'], post.id))
+                return
+        yield college_info, post, comments, tracker
+
+    def serialize(self, item):
+        college_info, post, comments, tracker = item
+        comment_records = None
+        if comments is not None:
+            comment_records = [self.database_client.serialize_comment(
+                comment, college_info) for comment in comments]
+        yield (college_info,
+            self.database_client.serialize_post(post, college_info),
+            comment_records, tracker)
+
+
+def rate_limited_clients(credentials, requests_per_second=0.5, burst=5):
+    return [RateLimitedClient(
+        RedditApiClient(username, password, api_request_delay=0),
+        TokenBucket(requests_per_second, burst))
+        for username, password in credentials]
+
+
+def default_checkpoint():
+    return CrawlCheckpoint(mongo.get_db())
+
+
+def default_database_service():
+    database = mongo.get_db()
+    return MongoDBService(database, listeners=[
+        vocabulary.DocumentFrequencyUpdater(database),
+        rollups.ActivityRollup(database)],
+        preprocessor=preprocess.default_preprocessor())
+
+
+def content_hash(*fields):
+    """
+    Returns: hex sha1 of the text fields of a post or comment
+    """
+    digest = hashlib.sha1()
+    for field in fields:
+        digest.update((field or u'').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def edited_utc(thing):
+    """
+    Returns: datetime of the last edit of a praw post or comment, None if
+        it was never edited
+    """
+    # praw reports False for things that were never edited.
+    edited = getattr(thing, 'edited', False)
+    if not edited or edited is True:
+        return None
+    return datetime.utcfromtimestamp(edited)
+
+
 class MongoDBService(object):
 
+    # A stored record is only rewritten when one of these fields changed.
+    CHANGE_FIELDS = ('content_hash', 'edited', 'ups', 'downs', 'num_comments',
+        'comments')
+
     def __init__(self, mongo_client, post_collection='posts',
-            comment_collection='comments'):
+            comment_collection='comments',
+            watermark_collection=WATERMARK_COLLECTION,
+            batch_size=1000, flush_interval=5, listeners=None,
+            preprocessor=None):
+        """
+        Input:
+            mongo_client: pymongo database
+            post_collection <string>: name of the post collection
+            comment_collection <string>: name of the comment collection
+            watermark_collection <string>: name of the collection holding
+                the newest post date and write version of every college
+            batch_size <int>: number of posts and comments accumulated
+                before they are written in one bulk operation
+            flush_interval <int>: maximum seconds a record waits in the
+                buffer before the batch is written
+            listeners list: objects with an on_write(college_info, posts,
+                comments) method called with the newly inserted records of
+                every batch, and optionally an on_update(college_info,
+                records, previous) method called with the records whose
+                text was edited and their stored versions
+            preprocessor <preprocess.Preprocessor>: stores the tokens of
+                every post and comment before they are written
+        """
         self.db = mongo_client
         self.post_collection = post_collection
         self.comment_collection = comment_collection
+        self.watermark_collection = watermark_collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Counts and latency of the most recent batches.
+        self.batches = deque(maxlen=100)
+        self.listeners = listeners or []
+        self.preprocessor = preprocessor
+        # Records written and skipped as unchanged since the service started.
+        self.counters = Counter()
+        self.counter_lock = threading.Lock()
 
     def save(self, posts, college_info, get_comments):
-        post_collection = self.get_post_collection()
-        comment_collection = self.get_comment_collection()
-        post_count = 0
-        comment_count = 0
+        written = Counter()
+        pending = []
+        batch = {'buffered': 0, 'last_flush': time.time()}
+
+        def flush():
+            post_count, comment_count = self.write(pending, college_info)
+            written.update(posts=post_count, comments=comment_count)
+            del pending[:]
+            batch.update(buffered=0, last_flush=time.time())
+
+        def due():
+            return pending and (batch['buffered'] >= self.batch_size or
+                time.time() - batch['last_flush'] >= self.flush_interval)
+
+        posts = list(posts)
+        stored = self.stored_posts([post.id for post in posts])
         for post in posts:
             # TODO(faisal): add error handling capability.
-            comment_records = [self.serialize_comment(comment, college_info)
-                for comment in get_comments(post)]
+            comment_records = None
+            if not self.comments_unchanged(post, stored.get(post.id)):
+                comment_records = []
+                for comment in get_comments(post):
+                    comment_records.append(
+                        self.serialize_comment(comment, college_info))
+                    # Expanding a post can take many requests, the posts
+                    # buffered before it are written on time meanwhile.
+                    if due():
+                        flush()
             post_record = self.serialize_post(post, college_info)
-            comment_ids = []
-            if comment_records:
-                comment_ids = self.insert_comments(comment_records)
-            # Join the post to its comments by storing the object ids of the
-            # comments
-            post_record['comments'] = comment_ids
-            self.insert_post(post_record)
-            post_count += 1
-            comment_count += len(comment_ids)
+            pending.append((post_record, comment_records))
+            batch['buffered'] += 1 + len(comment_records or ())
+            if due():
+                flush()
+        if pending:
+            flush()
         logger.info('Saved: {} {} posts {} comments'.format(
-            college_info['name'], post_count, comment_count))
+            college_info['name'], written['posts'], written['comments']))
         return
 
+    def write(self, pending, college_info):
+        """
+        Write the posts and comments of a batch that are new or changed
+        since they were stored, with two unordered bulk operations.
+
+        Input:
+            pending list<(dict, list<dict>)>: serialized posts paired with
+                their serialized comments, None when the comments weren't
+                expanded and the stored ones are kept
+            college_info <dict>: {'name', 'subreddit'}
+
+        Returns: (number of posts, number of comments) written
+        """
+        start = time.time()
+        posts = [post_record for post_record, _ in pending]
+        comments = [comment for _, records in pending
+            for comment in records or ()]
+        stored_posts = self.stored_posts(
+            [post_record['reddit_id'] for post_record in posts])
+        stored_comments = self.stored_comments(
+            [comment['reddit_id'] for comment in comments])
+        changed_comments = [comment for comment in comments
+            if self.changed(comment, stored_comments.get(comment['reddit_id']))]
+        edited = self.edited(self.get_comment_collection(), changed_comments,
+            stored_comments)
+        comment_ids = dict((reddit_id, stored['_id'])
+            for reddit_id, stored in stored_comments.iteritems())
+        ids, new_comments = self.upsert_comments(changed_comments)
+        comment_ids.update((comment['reddit_id'], _id)
+            for comment, _id in zip(changed_comments, ids))
+        for post_record, records in pending:
+            # Join the post to its comments by storing the object ids of the
+            # comments
+            if records is None:
+                stored = stored_posts.get(post_record['reddit_id'])
+                post_record['comments'] = stored['comments'] if stored else []
+            else:
+                post_record['comments'] = [comment_ids[comment['reddit_id']]
+                    for comment in records]
+        changed_posts = [post_record for post_record in posts
+            if self.changed(post_record,
+                stored_posts.get(post_record['reddit_id']))]
+        edited += self.edited(self.get_post_collection(), changed_posts,
+            stored_posts)
+        if self.preprocessor:
+            self.preprocessor(changed_posts + changed_comments)
+        new_posts = self.insert_posts(changed_posts)
+        if changed_posts or changed_comments:
+            self.update_watermark(college_info, posts)
+        for listener in self.listeners:
+            listener.on_write(college_info, new_posts, new_comments)
+            if edited and hasattr(listener, 'on_update'):
+                listener.on_update(college_info,
+                    [record for record, _ in edited],
+                    [previous for _, previous in edited])
+        expanded = len([records for _, records in pending
+            if records is not None])
+        self.count(posts_written=len(changed_posts),
+            posts_skipped=len(posts) - len(changed_posts),
+            comments_written=len(changed_comments),
+            comments_skipped=len(comments) - len(changed_comments),
+            expansions=expanded, expansions_skipped=len(pending) - expanded)
+        seconds = time.time() - start
+        self.batches.append({
+            'college': college_info['name'],
+            'posts': len(changed_posts),
+            'comments': len(changed_comments),
+            'skipped_posts': len(posts) - len(changed_posts),
+            'skipped_comments': len(comments) - len(changed_comments),
+            'seconds': seconds
+        })
+        logger.debug('Batch: {} {} posts {} comments in {:.3f}s, {} posts {} '
+            'comments unchanged'.format(college_info['name'],
+            len(changed_posts), len(changed_comments), seconds,
+            len(posts) - len(changed_posts),
+            len(comments) - len(changed_comments)))
+        return len(changed_posts), len(changed_comments)
+
+    def stored_posts(self, reddit_ids):
+        """
+        Returns: {reddit_id: stored change fields} of the posts already in
+            the database
+        """
+        return self.stored(self.get_post_collection(), reddit_ids)
+
+    def stored_comments(self, reddit_ids):
+        return self.stored(self.get_comment_collection(), reddit_ids)
+
+    def stored(self, collection, reddit_ids):
+        if not reddit_ids:
+            return {}
+        fields = dict((field, True) for field in self.CHANGE_FIELDS)
+        fields['reddit_id'] = True
+        return dict((record['reddit_id'], record) for record in
+            collection.find({'reddit_id': {'$in': list(reddit_ids)}}, fields))
+
+    def edited(self, collection, records, stored):
+        """
+        Returns: list of (record, stored text and tokens) of the records
+            whose text changed since they were stored
+        """
+        records = dict((record['reddit_id'], record) for record in records
+            if stored.get(record['reddit_id']) and
+            stored[record['reddit_id']].get('content_hash') not in
+                (None, record['content_hash']))
+        if not records:
+            return []
+        return [(records[previous['reddit_id']], previous) for previous in
+            collection.find({'reddit_id': {'$in': records.keys()}},
+                {'reddit_id': True, 'text': True, 'tokens': True})]
+
+    def changed(self, record, stored):
+        if stored is None:
+            return True
+        return any(record.get(field) != stored.get(field)
+            for field in self.CHANGE_FIELDS if field in record)
+
+    @staticmethod
+    def comments_unchanged(post, stored):
+        """
+        Returns: whether the comment count of a praw post is the one stored,
+            in which case expanding its comment tree can be skipped
+        """
+        return (stored is not None and stored.get('num_comments') is not None
+            and stored['num_comments'] == post.num_comments)
+
+    def count(self, **counts):
+        with self.counter_lock:
+            self.counters.update(counts)
+
+    def stats(self):
+        """
+        Returns: the written and skipped counters
+        """
+        with self.counter_lock:
+            return dict(self.counters)
+
     def insert_comments(self, comments):
-        inserted = []
-        for comment in comments:
-            _id = self.get_comment_collection().find_and_modify(
-                {'reddit_id': comment['reddit_id']}, update=comment, upsert=True)
-            inserted.append(_id)
-        return inserted
+        return self.upsert_comments(comments)[0]
+
+    def upsert_comments(self, comments):
+        """
+        Upsert comments by reddit id.
+
+        Returns: (list of the comment ObjectIds in the same order as comments,
+            list of the comments that did not exist yet)
+        """
+        result = self.bulk_upsert(self.get_comment_collection(), comments)
+        inserted = [None] * len(comments)
+        for upserted in result.get('upserted', []):
+            inserted[upserted['index']] = upserted['_id']
+        # Comments that already existed were replaced in place so their ids
+        # have to be looked up.
+        missing = dict((comment['reddit_id'], i)
+            for i, comment in enumerate(comments) if inserted[i] is None)
+        if missing:
+            existing = self.get_comment_collection().find(
+                {'reddit_id': {'$in': missing.keys()}},
+                {'_id': True, 'reddit_id': True})
+            for comment in existing:
+                inserted[missing[comment['reddit_id']]] = comment['_id']
+        return inserted, [comments[upserted['index']]
+            for upserted in result.get('upserted', [])]
+
+    def insert_posts(self, posts):
+        """
+        Upsert posts by reddit id.
+
+        Returns: list of the posts that did not exist yet
+        """
+        result = self.bulk_upsert(self.get_post_collection(), posts)
+        return [posts[upserted['index']]
+            for upserted in result.get('upserted', [])]
 
     def insert_post(self, post):
-        self.get_post_collection().find_and_modify(
-            {'reddit_id': post['reddit_id']}, update=post, upsert=True)
+        self.insert_posts([post])
+
+    def bulk_upsert(self, collection, records):
+        """
+        Replace or insert every record keyed on its reddit id in a single
+        unordered bulk operation.
+        """
+        if not records:
+            return {}
+        bulk = collection.initialize_unordered_bulk_op()
+        for record in records:
+            bulk.find({'reddit_id': record['reddit_id']}).upsert().replace_one(
+                record)
+        return bulk.execute()
+
+    def update_watermark(self, college_info, posts):
+        """
+        Record the newest post date of the college and bump its write
+        version so results cached from older data are invalidated. The '*'
+        watermark tracks writes to any college.
+        """
+        newest = max(post['created_utc'] for post in posts)
+        for college in (college_info['name'], '*'):
+            self.db[self.watermark_collection].update({'college': college}, {
+                '$max': {'created_utc': newest},
+                '$inc': {'version': 1}
+            }, upsert=True)
 
     def last_post_date(self, college_info):
         """
@@ -255,6 +1048,10 @@ class MongoDBService(object):
             'url': submission.url,
             'ups': submission.ups,
             'downs': submission.downs,
+            'num_comments': submission.num_comments,
+            'edited': edited_utc(submission),
+            'content_hash': content_hash(submission.title,
+                submission.selftext),
             'subreddit': subreddit,
             'college': college,
             'created_utc': datetime.utcfromtimestamp(submission.created_utc),
@@ -276,11 +1073,41 @@ class MongoDBService(object):
             'reddit_id': comment.id,
             'ups': comment.ups,
             'downs': comment.downs,
+            'edited': edited_utc(comment),
+            'content_hash': content_hash(comment.body),
             'college': college,
             'subreddit' : subreddit,
             'created_utc': datetime.utcfromtimestamp(comment.created_utc)
         }
 
 if __name__ == '__main__':
-    multi = MultiThreadedCrawler(CREDENTIALS[0], SUBREDDITS)
-    multi.start()
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logging.getLogger('requests').setLevel(logging.CRITICAL)
+    logging.getLogger('urllib3').setLevel(logging.CRITICAL)
+    backfill = None
+    if len(sys.argv) > 1 and sys.argv[1] == 'backfill':
+        # python crawler.py backfill <subreddit> <start> <end>, dates as
+        # 'Jul 9 2015' with start the later date.
+        usage = ('usage: python crawler.py backfill <subreddit> <start> <end>, '
+            'dates like Jul 9 2015')
+        matches = [college for college in SUBREDDITS
+            if len(sys.argv) == 5 and college['subreddit'] == sys.argv[2]]
+        if not matches:
+            if len(sys.argv) == 5:
+                print >> sys.stderr, 'Unknown subreddit {}'.format(sys.argv[2])
+            print >> sys.stderr, usage
+            sys.exit(2)
+        try:
+            backfill = (matches[0], datetime.strptime(sys.argv[3], '%b %d %Y'),
+                datetime.strptime(sys.argv[4], '%b %d %Y'))
+        except ValueError:
+            print >> sys.stderr, usage
+            sys.exit(2)
+    indexes.ensure_indexes(mongo.get_db())
+    crawler = PipelineCrawler(rate_limited_clients(CREDENTIALS),
+        default_database_service(), SUBREDDITS,
+        checkpoint=default_checkpoint())
+    if backfill:
+        crawler.backfill(*backfill)
+    else:
+        crawler.start()
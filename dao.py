@@ -1,35 +1,121 @@
+import config
 import pymongo
 import random
+from mongo import get_db
+from profiling import inspect, profiled
 
-mongodb = pymongo.MongoClient()['reddit']
+SEARCH_FIELDS = {'_id': True, 'title': True, 'text': True, 'college': True,
+    'subreddit': True, 'created_utc': True, 'ups': True}
+COMMENT_FIELDS = {'_id': True, 'text': True, 'tokens': True, 'ups': True}
+POST_FIELDS = {'_id': True, 'text': True, 'tokens': True, 'ups': True,
+    'comments': True}
 
-def query(college, start, end):
-    return mongodb.posts.find({
+@profiled('dao.query')
+def query(college, start, end, fields=None):
+    return get_db().posts.find({
         'college': college,
         'created_utc': {'$lte': end, '$gte': start}
-        })
+        }, fields)
 
+@profiled('dao.distinct_colleges')
 def distinct_colleges():
-    return list(mongodb.posts.distinct('subreddit'))
+    return list(get_db().posts.distinct('subreddit'))
 
-def populate_comments(post):
-    comments = []
-    for comment in post['comments']:
-        result = mongodb.comments.find_one({'_id': comment})
-        result['color'] = 'blue'
-        comments.append(result)
+@profiled('dao.fetch_comments')
+def fetch_comments(posts, fields=COMMENT_FIELDS):
+    """
+    Fetch the comments of every post with a single $in query.
+
+    Input:
+        posts list<dict>: posts with a 'comments' list of comment ids
+        fields <dict>: projection applied to the comments
 
-    return comments
+    Returns: dict of comment id to comment
+    """
+    ids = [_id for post in posts for _id in post['comments'] if _id]
+    if not ids:
+        return {}
+    cursor = inspect('dao.fetch_comments',
+        get_db().comments.find({'_id': {'$in': ids}}, fields))
+    return dict((comment['_id'], comment) for comment in cursor)
 
-def join_comments(posts):
+def populate_comments(post, fields=COMMENT_FIELDS):
+    return join_comments([post], fields)[1:]
+
+def join_comments(posts, fields=COMMENT_FIELDS):
+    """
+    Returns: the posts followed by their comments, in post order.
+    """
+    found = fetch_comments(posts, fields)
     comments = []
     for post in posts:
-        comments.extend(populate_comments(post))
+        for _id in post['comments']:
+            if _id in found:
+                comment = found[_id]
+                comment['color'] = 'blue'
+                comments.append(comment)
     return posts + comments
 
+@profiled('dao.search')
+def search(term, college=None, collections=('posts', 'comments'), after=None,
+        limit=20):
+    """
+    Full text search over posts and comments, newest first. Pages are
+    delimited by the (created_utc, _id) key of their last result so deep
+    pages don't skip over the previous ones.
+
+    Input:
+        term <string>: $text search string
+        college <string>: only search one college when given
+        collections list<string>: 'posts' and/or 'comments'
+        after <(datetime, ObjectId)>: key of the last result of the previous
+            page
+        limit <int>: page size
+
+    Returns: list of documents with a 'kind' of 'post' or 'comment', at most
+        limit + 1 so the caller knows whether there is a next page
+    """
+    spec = {'$text': {'$search': term}}
+    if college:
+        spec['college'] = college
+    if after:
+        created_utc, _id = after
+        spec['$or'] = [
+            {'created_utc': {'$lt': created_utc}},
+            {'created_utc': created_utc, '_id': {'$lt': _id}}
+        ]
+    results = []
+    for collection in collections:
+        cursor = inspect('dao.search.' + collection, get_db()[collection].find(
+            spec, SEARCH_FIELDS).sort([('created_utc', pymongo.DESCENDING),
+                ('_id', pymongo.DESCENDING)]).limit(limit + 1))
+        for document in cursor:
+            document['kind'] = collection[:-1]
+            results.append(document)
+    results.sort(key=lambda document: (document['created_utc'],
+        document['_id']), reverse=True)
+    return results[:limit + 1]
+
+@profiled('dao.watermark')
+def watermark(college):
+    """
+    Input:
+        college <string>: college name, '*' for all colleges
+
+    Returns: (created_utc of the newest post, write version) as recorded by
+        MongoDBService.update_watermark
+    """
+    record = get_db()[config.WATERMARK_COLLECTION].find_one(
+        {'college': college})
+    if record:
+        return record['created_utc'], record['version']
+    return None, 0
+
+@profiled('dao.get_post')
 def get_post(_id):
-    return mongodb.posts.find_one({'_id': _id})
+    return get_db().posts.find_one({'_id': _id})
 
+@profiled('dao.get_comment')
 def get_comment(_id):
-    return mongodb.comments.find_one({'_id': _id})
+    return get_db().comments.find_one({'_id': _id})
 
@@ -1,45 +1,491 @@
 import dao
 import analysis
-from datetime import datetime
+import cache
+import comparison
+import config
+import metrics
+import mongo
+import preprocess
+import reduction
+import rollups
+import similarity
+import vocabulary
+import json
+import multiprocessing
+import numpy
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from datetime import datetime, timedelta
 
-def create_graph_handler(college, start, end, threshold):
+results = cache.LRUCache(config.CACHE_ENTRIES, config.CACHE_DIRECTORY)
+search_pages = cache.LRUCache(config.SEARCH_CACHE_ENTRIES)
+SNIPPET_LENGTH = 300
+
+
+class RequestError(ValueError):
+    """ Invalid request parameters, answered with status 400 """
+    status = 400
+
+
+class NotFound(RequestError):
+    status = 404
+
+
+class Timeout(RequestError):
+    status = 504
+
+
+def graph_cache_key(college, start, end, threshold, top_k=None, tables=None,
+        compact=False, max_nodes=None, rank='degree', collapse=None,
+        cluster=None):
+    """
+    Normalized parameters of a graph request plus the college's watermark,
+    so the key changes whenever the crawler writes new data for the college.
+    """
+    return ('graph', college, dt_from_timestamp(start), dt_from_timestamp(end),
+        round(threshold, 6), top_k or None, tables or None, bool(compact),
+        max_nodes or None, rank, collapse, cluster, dao.watermark(college))
+
+def colleges_cache_key():
+    return ('colleges', dao.watermark('*'))
+
+def create_graph_handler(college, start, end, threshold, top_k=None,
+        tables=None, compact=False, key=None, **reduce_options):
+    """
+    Input:
+        key <tuple>: graph_cache_key of the request when the caller already
+            computed it, saves reading the watermark twice
+    """
+    key = key or graph_cache_key(college, start, end, threshold, top_k,
+        tables, compact, **reduce_options)
+    return results.get_or_compute(key, lambda: create_graph(
+        college, start, end, threshold, top_k, tables, compact,
+        **reduce_options))
+
+def graph_tables(top_k=None, tables=None):
+    """
+    Validate the similarity options of a graph request.
+
+    Returns: the number of hash tables, clamped to similarity.MAX_TABLES
+    """
+    if tables is None:
+        return None
+    if top_k:
+        raise RequestError('top_k and tables can not be combined')
+    if tables < 1:
+        raise RequestError('tables must be positive')
+    return min(tables, similarity.MAX_TABLES)
+
+def graph_reduction(compact=False, max_nodes=None, rank='degree',
+        collapse=None, cluster=None):
+    """
+    Validate the reduction options of a graph request, see reduced_graph.
+    Whether cluster exists is only known once the graph is built.
+    """
+    if max_nodes is not None and max_nodes < 1:
+        raise RequestError('max_nodes must be positive')
+    if rank not in ('degree', 'ups'):
+        raise RequestError('Unknown rank {}'.format(rank))
+    if collapse not in (None, 'components', 'clusters'):
+        raise RequestError('Unknown collapse {}'.format(collapse))
+    if cluster is not None and cluster < 0:
+        raise RequestError('Unknown cluster {}'.format(cluster))
+    if compact and collapse and cluster is None:
+        raise RequestError('format=compact can not be combined with collapse')
+
+def create_graph(college, start, end, threshold, top_k=None, tables=None,
+        compact=False, **reduce_options):
+    corpus = graph_corpus(college, start, end)
+    with metrics.stage('model'):
+        model = vocabulary.get_model(mongo.get_db(), college)
+    return cosine_graph(corpus, threshold, top_k=top_k, tables=tables,
+        model=model, compact=compact, **reduce_options)
+
+def stream_graph_handler(college, start, end, threshold, top_k=None,
+        tables=None, compact=False):
+    """
+    Newline delimited JSON version of the graph: one {"node": ...} line per
+    document followed by one {"edge": [source, target]} line per edge, sent
+    as the similarity engine produces them. The corpus and model are loaded
+    before the response starts, so invalid requests are still answered with
+    an error status.
+    """
+    corpus = graph_corpus(college, start, end)
+    with metrics.stage('model'):
+        model = vocabulary.get_model(mongo.get_db(), college)
+    return ndjson(iter_graph(corpus, threshold, top_k, tables, model,
+        compact))
+
+def ndjson(items):
+    for kind, value in items:
+        yield json.dumps({kind: value}) + '\n'
+
+def graph_corpus(college, start, end):
     start = dt_from_timestamp(start)
     end = dt_from_timestamp(end)
-    posts = list(dao.query(college, start, end))
+    with metrics.stage('query'):
+        posts = list(dao.query(college, start, end, dao.POST_FIELDS))
     for post in posts:
         post['color'] = 'red'
-    corpus = dao.join_comments(posts)
-    print len(corpus)
-    return cosine_graph(corpus, threshold)
-
-def cosine_graph(corpus, threshold):
-    keyword_extractor = analysis.KeywordExtractor(get_text=lambda x: x['text'])
-    vectors = keyword_extractor.compute(corpus)
-    nodes = [{'title': doc['text'], 'color': doc['color']} for doc in corpus]
+    with metrics.stage('comments'):
+        corpus = dao.join_comments(posts)
+    metrics.size('corpus_size', len(corpus))
+    return corpus
+
+def cosine_graph(corpus, threshold, top_k=None, tables=None, model=None,
+        compact=False, max_nodes=None, rank='degree', collapse=None,
+        cluster=None):
+    """
+    Build the similarity graph of a corpus. Every undirected edge is emitted
+    once with source < target.
+
+    Input:
+        corpus list<dict>: documents with '_id', 'text' and 'color'
+        threshold <float>: minimum cosine similarity for an edge
+        top_k <int>: if set, only keep each document's k nearest neighbours
+        tables <int>: if set, only score the candidate pairs found by a
+            random projection index with this many hash tables. Faster on
+            large windows at the cost of missing some edges.
+        model <vocabulary.TfidfModel>: persisted college model. The
+            vectorizer is fitted on the corpus when it is not given.
+        compact <bool>: nodes are [id, color] pairs whose text is fetched
+            through /post/<_id> or /comment/<_id>, and edges are a flat
+            [source, target, source, target, ...] array. Not available
+            for the super-nodes of collapse, which have no document to fetch.
+        max_nodes, rank, collapse, cluster: see reduced_graph
+    """
+    graph_reduction(compact, max_nodes, rank, collapse, cluster)
+    if max_nodes or collapse or cluster is not None:
+        pairs = list(graph_edges(corpus, threshold, top_k, tables, model))
+        with metrics.stage('reduce'):
+            return reduced_graph(corpus, pairs, max_nodes, rank, collapse,
+                cluster, compact)
+    nodes = []
     edges = []
-    for i, v in enumerate(vectors):
-        for j, k in enumerate(vectors):
-            if i == j:
-                continue
-            else:
-                angle = v.dot(k)
-                if angle >= threshold:
-                    edge = {'source': i, 'target': j}
-                    edges.append(edge)
+    for kind, value in iter_graph(corpus, threshold, top_k, tables, model,
+            compact):
+        if kind == 'node':
+            nodes.append(value)
+        elif compact:
+            edges.extend(value)
+        else:
+            edges.append({'source': value[0], 'target': value[1]})
+    metrics.size('edges', len(edges) / 2 if compact else len(edges))
     return {'nodes': nodes, 'edges': edges}
 
-def get_colleges_handler():
-    return dao.distinct_colleges()
+def iter_graph(corpus, threshold, top_k=None, tables=None, model=None,
+        compact=False):
+    """
+    Returns: iterator of ('node', node) for every document followed by
+        ('edge', [source, target]) for every edge
+    """
+    for doc in corpus:
+        yield 'node', node_json(doc, compact)
+    for edge in graph_edges(corpus, threshold, top_k, tables, model):
+        yield 'edge', list(edge)
+
+def node_json(doc, compact=False):
+    if compact:
+        return [str(doc['_id']), doc['color']]
+    return {'title': doc['text'], 'color': doc['color']}
+
+def graph_edges(corpus, threshold, top_k=None, tables=None, model=None):
+    """
+    Returns: iterator of (source, target) corpus indices with source < target
+    """
+    if not corpus:
+        return
+    keyword_extractor = analysis.KeywordExtractor(model=model,
+        get_tokens=vocabulary.analyze)
+    with metrics.stage('vectorize'):
+        vectors = keyword_extractor.compute_sparse(corpus)
+    if tables:
+        pairs = similarity.approximate_edges(vectors, threshold,
+            tables=tables)
+    elif top_k:
+        pairs = similarity.top_k_edges(vectors, top_k, threshold)
+    else:
+        pairs = similarity.threshold_edges(vectors, threshold)
+    # The edges are computed lazily, only time the computation and not the
+    # time spent sending every edge while streaming.
+    for pair in metrics.timed('similarity', pairs):
+        yield pair
+
+def reduced_graph(corpus, pairs, max_nodes=None, rank='degree', collapse=None,
+        cluster=None, compact=False):
+    """
+    Bound the size of a graph for the force layout.
+
+    Input:
+        corpus list<dict>: documents with '_id', 'text', 'color' and 'ups'
+        pairs list<(int, int)>: edges between corpus indices
+        max_nodes <int>: keep at most this many nodes (or super-nodes)
+        rank <string>: 'degree' or 'ups', which nodes max_nodes keeps
+        collapse <string>: 'components' or 'clusters', merge each group
+            into a super-node {'cluster', 'count', 'posts', 'comments',
+            'title', 'color'} joined by edges weighted by the number of
+            edges between the groups
+        cluster <int>: drill down into one group of the collapse mode
+            (clusters by default): only its documents are returned, as a
+            regular graph
+
+    Returns: {'nodes', 'edges'}
+    """
+    if collapse or cluster is not None:
+        if collapse == 'components':
+            labels = reduction.components(len(corpus), pairs)
+        else:
+            labels = reduction.clusters(len(corpus), pairs)
+        if cluster is None:
+            return collapsed_graph(corpus, pairs, labels, max_nodes)
+        keep = numpy.flatnonzero(labels == cluster)
+        if not len(keep):
+            raise RequestError('Unknown cluster {}'.format(cluster))
+        corpus = [corpus[i] for i in keep]
+        pairs = reduction.subgraph(keep, pairs)
+    if max_nodes and len(corpus) > max_nodes:
+        if rank == 'ups':
+            scores = [doc.get('ups', 0) for doc in corpus]
+        else:
+            scores = reduction.degrees(len(corpus), pairs)
+        keep = reduction.top_nodes(scores, max_nodes)
+        corpus = [corpus[i] for i in keep]
+        pairs = reduction.subgraph(keep, pairs)
+    nodes = [node_json(doc, compact) for doc in corpus]
+    if compact:
+        edges = [index for pair in pairs for index in pair]
+    else:
+        edges = [{'source': i, 'target': j} for i, j in pairs]
+    return {'nodes': nodes, 'edges': edges}
+
+def collapsed_graph(corpus, pairs, labels, max_nodes=None):
+    sizes, merged = reduction.collapse(labels, pairs)
+    posts = numpy.bincount(labels, minlength=len(sizes),
+        weights=[doc['color'] == 'red' for doc in corpus]).astype(int)
+    # The best connected member of every group gives it its title.
+    degree = reduction.degrees(len(corpus), pairs)
+    order = numpy.lexsort((-degree, labels))
+    representatives = order[numpy.searchsorted(labels[order],
+        numpy.arange(len(sizes)))]
+    groups = len(sizes) if not max_nodes else min(max_nodes, len(sizes))
+    nodes = [{
+        'cluster': group,
+        'count': int(sizes[group]),
+        'posts': int(posts[group]),
+        'comments': int(sizes[group] - posts[group]),
+        'title': corpus[representatives[group]]['text'],
+        'color': 'red' if posts[group] * 2 >= sizes[group] else 'blue'
+    } for group in range(groups)]
+    edges = [{'source': a, 'target': b, 'weight': weight}
+        for a, b, weight in merged if a < groups and b < groups]
+    return {'nodes': nodes, 'edges': edges}
+
+def keywords_handler(college, start, end, threshold=0.25, top_k=None,
+        limit=50):
+    """
+    Most common keywords of a college's posts and comments in a date range.
+    """
+    start = dt_from_timestamp(start)
+    end = dt_from_timestamp(end)
+    with metrics.stage('query'):
+        posts = list(dao.query(college, start, end, dao.POST_FIELDS))
+    with metrics.stage('comments'):
+        corpus = dao.join_comments(posts)
+    metrics.size('corpus_size', len(corpus))
+    if not corpus:
+        return []
+    with metrics.stage('model'):
+        model = vocabulary.get_model(mongo.get_db(), college)
+    if model and model.hashing:
+        # Hash buckets can't be mapped back to terms.
+        model = None
+    keyword_extractor = analysis.KeywordExtractor(model=model,
+        get_tokens=vocabulary.analyze)
+    with metrics.stage('keywords'):
+        frequencies = keyword_extractor.frequencies(corpus, threshold, top_k,
+            limit)
+        # Stored tokens are stems, show the word they most often come from.
+        forms = preprocess.surface_forms((document['text']
+            for document in corpus), [term for term, _ in frequencies])
+        return [{'term': forms.get(term, term), 'count': count}
+            for term, count in frequencies]
+
+def activity_handler(college, start, end, resolution='day'):
+    """
+    Post and comment counts of a college per day or hour, served from the
+    rollups maintained by the crawler.
+    """
+    if resolution not in rollups.COLLECTIONS:
+        raise RequestError('Unknown resolution {}'.format(resolution))
+    with metrics.stage('rollups'):
+        return [{'time': bucket['time'].isoformat(),
+            'posts': bucket.get('posts', 0),
+            'comments': bucket.get('comments', 0)}
+            for bucket in rollups.activity(mongo.get_db(), college,
+                dt_from_timestamp(start), dt_from_timestamp(end), resolution)]
+
+def sankey_handler(term, colleges=None, limit=1000, timeout=30, min_count=1,
+        top_k=None):
+    """
+    Tree of the phrases following term in the posts and comments of the
+    given colleges, all configured colleges by default.
+    """
+    colleges = colleges or [college['name'] for college in config.SUBREDDITS]
+    formatter = analysis.SankeyFormatter(mongo.get_db(), colleges, term)
+    with metrics.stage('sankey'):
+        graph = formatter.json(limit=limit, timeout=timeout,
+            min_count=min_count, top_k=top_k)
+    graph['complete'] = formatter.complete
+    return graph
+
+def search_handler(term, college=None, kind=None, cursor=None, limit=20):
+    """
+    One page of the posts and comments matching term, newest first. Pages
+    are cached until the crawler writes new data.
+
+    Input:
+        kind <string>: 'posts' or 'comments', both when None
+        cursor <string>: 'next' value of the previous page
+
+    Returns: {'results': [document], 'next': cursor of the next page or None}
+    """
+    if kind not in (None, 'posts', 'comments'):
+        raise RequestError('Unknown kind {}'.format(kind))
+    if not term.strip():
+        return {'results': [], 'next': None}
+    after = decode_cursor(cursor) if cursor else None
+    limit = max(1, min(limit, 100))
+    key = ('search', term.strip().lower(), college, kind, after, limit,
+        dao.watermark(college or '*'))
+    return search_pages.get_or_compute(key, lambda: search_page(
+        term, college, kind, after, limit))
+
+def search_page(term, college=None, kind=None, after=None, limit=20):
+    """
+    Input:
+        after <tuple>: decoded cursor of the previous page
+    """
+    with metrics.stage('search'):
+        documents = dao.search(term, college,
+            (kind,) if kind else ('posts', 'comments'), after, limit)
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(documents[-1])
+    results = []
+    for document in documents:
+        document = serialize(document)
+        document['text'] = document['text'][:SNIPPET_LENGTH]
+        results.append(document)
+    return {'results': results, 'next': next_cursor}
+
+def encode_cursor(document):
+    """
+    Returns: '<created_utc in ms>-<_id>' key of a search result
+    """
+    delta = document['created_utc'] - datetime(1970, 1, 1)
+    millis = delta.days * 86400000 + delta.seconds * 1000 + \
+        delta.microseconds // 1000
+    return '{}-{}'.format(millis, document['_id'])
+
+def decode_cursor(cursor):
+    """
+    Returns: (created_utc, _id) of the last result of the previous page
+    """
+    try:
+        millis, _id = cursor.split('-')
+        return (datetime(1970, 1, 1) + timedelta(milliseconds=int(millis)),
+            ObjectId(_id))
+    except (ValueError, TypeError, OverflowError, InvalidId):
+        raise RequestError('Invalid cursor {}'.format(cursor))
+
+def comparison_handler(start, end, colleges=None, method='log_odds',
+        top_k=20):
+    """
+    Distinctive keywords of every college in a date range, all configured
+    colleges by default. Served from the table stored by the batch job when
+    there is one, otherwise computed over at most config.COMPARISON_MAX_DAYS
+    days.
+    """
+    if method not in comparison.METHODS:
+        raise RequestError('Unknown method {}'.format(method))
+    if not 0 < top_k <= 100:
+        raise RequestError('top_k must be between 1 and 100')
+    colleges = sorted(colleges or
+        [college['name'] for college in config.SUBREDDITS])
+    start = dt_from_timestamp(start)
+    end = dt_from_timestamp(end)
+    if end < start:
+        raise RequestError('The end date is before the start date')
+    watermark = dao.watermark('*')
+    key = ('comparison', start, end, tuple(colleges), method, top_k,
+        watermark)
+
+    def compute():
+        with metrics.stage('comparison'):
+            table = comparison.stored(mongo.get_db(), start, end, method,
+                top_k, colleges, watermark)
+            if table is None:
+                if end - start > timedelta(days=config.COMPARISON_MAX_DAYS):
+                    raise RequestError('Comparisons of more than {} days are '
+                        'only served from the batch job'.format(
+                        config.COMPARISON_MAX_DAYS))
+                try:
+                    table = comparison.compare(colleges, start, end, method,
+                        top_k, max_documents=config.COMPARISON_MAX_DOCUMENTS,
+                        timeout=config.COMPARISON_TIMEOUT)
+                except multiprocessing.TimeoutError:
+                    raise Timeout('The comparison took more than {} '
+                        'seconds'.format(config.COMPARISON_TIMEOUT))
+                comparison.store(mongo.get_db(), start, end, method, top_k,
+                    colleges, table, watermark)
+        return table
+    return results.get_or_compute(key, compute)
+
+def get_colleges_handler(key=None):
+    return results.get_or_compute(key or colleges_cache_key(),
+        dao.distinct_colleges)
+
+def cache_stats_handler():
+    return results.stats()
 
 def get_post_handler(_id):
-    return dao.get_post(_id)
+    return serialize(found(dao.get_post(object_id(_id)), 'post', _id))
 
 def get_comment_handler(_id):
-    return dao.get_comment(_id)
+    return serialize(found(dao.get_comment(object_id(_id)), 'comment', _id))
 
 def get_comments_handler(_id):
-    post = dao.get_post(_id)
-    return dao.populate_comments(post)
+    post = found(dao.get_post(object_id(_id)), 'post', _id)
+    return [serialize(comment) for comment in dao.populate_comments(post)]
+
+def object_id(_id):
+    if not ObjectId.is_valid(_id):
+        raise RequestError('Invalid id {}'.format(_id))
+    return ObjectId(_id)
+
+def found(document, kind, _id):
+    if document is None:
+        raise NotFound('No {} {}'.format(kind, _id))
+    return document
+
+def serialize(document):
+    """
+    Make a Mongo document JSON serializable.
+    """
+    if document is None:
+        return None
+    document = dict(document)
+    document.pop('tokens', None)
+    document['_id'] = str(document['_id'])
+    if 'comments' in document:
+        document['comments'] = [str(_id) for _id in document['comments']]
+    if 'created_utc' in document:
+        document['created_utc'] = document['created_utc'].isoformat()
+    return document
 
 def dt_from_timestamp(s):
-    return datetime.strptime(s, '%b %d %Y')
\ No newline at end of file
+    try:
+        return datetime.strptime(s, '%b %d %Y')
+    except ValueError:
+        raise RequestError('Dates look like Jul 9 2015, got {}'.format(s))
\ No newline at end of file
@@ -0,0 +1,84 @@
+import config
+import logging
+import pymongo
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+ASCENDING = pymongo.ASCENDING
+DESCENDING = pymongo.DESCENDING
+TEXT = pymongo.TEXT
+
+# collection -> list of (keys, options)
+INDEXES = {
+    'posts': [
+        ([('reddit_id', ASCENDING)], {'unique': True}),
+        ([('college', ASCENDING), ('created_utc', DESCENDING)], {}),
+        ([('title', TEXT), ('text', TEXT)], {}),
+    ],
+    'comments': [
+        ([('reddit_id', ASCENDING)], {'unique': True}),
+        ([('college', ASCENDING), ('created_utc', DESCENDING)], {}),
+        ([('text', TEXT)], {}),
+    ],
+    'document_frequencies': [
+        ([('college', ASCENDING), ('hashed', ASCENDING), ('version', ASCENDING),
+            ('key', ASCENDING)], {'unique': True}),
+    ],
+    'corpus_stats': [
+        ([('college', ASCENDING), ('hashed', ASCENDING)], {'unique': True}),
+    ],
+    config.WATERMARK_COLLECTION: [
+        ([('college', ASCENDING)], {'unique': True}),
+    ],
+    'activity_daily': [
+        ([('college', ASCENDING), ('time', ASCENDING)], {'unique': True}),
+    ],
+    'activity_hourly': [
+        ([('college', ASCENDING), ('time', ASCENDING)], {'unique': True}),
+    ],
+    'crawl_checkpoints': [
+        ([('subreddit', ASCENDING)], {'unique': True}),
+    ],
+    'keyword_comparisons': [
+        ([('start', ASCENDING), ('end', ASCENDING), ('method', ASCENDING),
+            ('top_k', ASCENDING), ('colleges', ASCENDING)], {}),
+    ],
+    'crawl_jobs': [
+        ([('subreddit', ASCENDING)], {'unique': True}),
+    ],
+}
+
+# collection -> names of indexes replaced by one of INDEXES
+DROPPED = {
+    'document_frequencies': ['college_1_hashed_1_key_1'],
+}
+
+def ensure_indexes(db, indexes=INDEXES, dropped=DROPPED):
+    """
+    Build the declared indexes in the background. Existing indexes are left
+    alone; an index that can't be built (e.g. duplicate reddit ids in old
+    data) is logged instead of stopping startup.
+
+    Input:
+        db: pymongo database
+        indexes <dict>: collection name -> list of (keys, options)
+        dropped <dict>: collection name -> names of indexes to drop
+    """
+    for collection, names in dropped.iteritems():
+        existing = db[collection].index_information()
+        for name in names:
+            if name in existing:
+                db[collection].drop_index(name)
+    for collection, declared in indexes.iteritems():
+        for keys, options in declared:
+            try:
+                db[collection].create_index(keys, background=True, **options)
+            except OperationFailure:
+                logger.exception('Could not build index {} on {}'.format(
+                    keys, collection))
+
+
+if __name__ == '__main__':
+    import mongo
+    ensure_indexes(mongo.get_db())
@@ -0,0 +1,279 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from Queue import Queue
+import crawler
+import mongo
+import rollups
+import vocabulary
+
+logger = logging.getLogger(__name__)
+
+JOB_COLLECTION = 'crawl_jobs'
+
+
+class JobStore(object):
+    """
+    Persisted state of the crawl job of every subreddit: when it last ran,
+    when it runs next, the observed post rate and when each post-crawl hook
+    last ran. The scheduler picks up where it stopped after a restart.
+    """
+
+    def __init__(self, db, collection=JOB_COLLECTION):
+        self.db = db
+        self.collection = collection
+
+    def load(self, college_info):
+        """
+        Returns: the job of a college, next_run is None if it never ran
+        """
+        job = self.db[self.collection].find_one(
+            {'subreddit': college_info['subreddit']}, {'_id': False})
+        if job:
+            return job
+        return {
+            'subreddit': college_info['subreddit'],
+            'name': college_info['name'],
+            'next_run': None,
+            'last_run': None,
+            'last_duration': None,
+            'posts_per_hour': None,
+            'failures': 0,
+            'last_error': None,
+            'hooks': {}
+        }
+
+    def save(self, job):
+        self.db[self.collection].update({'subreddit': job['subreddit']},
+            {'$set': job}, upsert=True)
+
+    def all(self):
+        return list(self.db[self.collection].find({}, {'_id': False}))
+
+
+class Scheduler(object):
+    """
+    Re-crawls every subreddit on its own cadence. Busy subreddits are
+    crawled often and quiet ones rarely: the interval is the time the
+    subreddit takes to get target_posts new posts at its observed rate.
+    Crawls run on a pool of max_concurrent threads and each one holds a
+    slot of a credential, at most per_credential per credential.
+    """
+
+    def __init__(self, db, clients, database_client, colleges,
+            checkpoint=None, store=None, hooks=None, max_concurrent=4,
+            per_credential=1, target_posts=50,
+            min_interval=timedelta(minutes=15), max_interval=timedelta(days=1),
+            tick=5):
+        """
+        Input:
+            db: pymongo database
+            clients list: api clients, e.g. one RateLimitedClient per
+                credential
+            database_client <MongoDBService>: database writer
+            colleges[] <dict>: array of {'name', 'subreddit'}
+            checkpoint <CrawlCheckpoint>: completed windows, every crawl
+                only visits the windows newer than the last one
+            store <JobStore>: job state, in db by default
+            hooks list<(name, timedelta, function)>: run between the crawls
+                of a college when they haven't run for it within the
+                interval. function is called with (db, [college_info]).
+                The college isn't crawled while its hooks run, one college
+                at a time.
+            max_concurrent <int>: crawls running at the same time
+            per_credential <int>: crawls sharing one credential
+            target_posts <int>: new posts expected between two crawls
+            min_interval, max_interval <timedelta>: bounds of the cadence
+            tick <int>: seconds between checks for due jobs
+        """
+        self.db = db
+        self.database_client = database_client
+        self.colleges = colleges
+        self.checkpoint = checkpoint
+        self.store = store or JobStore(db)
+        self.hooks = DEFAULT_HOOKS if hooks is None else hooks
+        self.max_concurrent = max_concurrent
+        self.target_posts = target_posts
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.tick = tick
+        self.due = Queue()
+        self.slots = Queue()
+        for _ in range(per_credential):
+            for client in clients:
+                self.slots.put(client)
+        self.running = set()
+        self.maintenance = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self):
+        """
+        Start the crawl threads and schedule jobs until stop is called.
+        """
+        for i in range(self.max_concurrent):
+            worker = threading.Thread(target=self.work,
+                name='scheduler-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+        while not self.stopped.is_set():
+            self.schedule()
+            self.stopped.wait(self.tick)
+
+    def stop(self):
+        self.stopped.set()
+
+    def schedule(self):
+        """
+        Queue the jobs that are due and not already running, and start the
+        hooks of an idle college that are due.
+
+        Returns: number of jobs queued
+        """
+        now = datetime.utcnow()
+        queued = 0
+        for college_info in self.colleges:
+            with self.lock:
+                if college_info['subreddit'] in self.running:
+                    continue
+            job = self.store.load(college_info)
+            if job['next_run'] is None or job['next_run'] <= now:
+                with self.lock:
+                    self.running.add(college_info['subreddit'])
+                self.due.put(college_info)
+                queued += 1
+            elif self.maintenance is None and self.hooks_due(job, now):
+                self.maintain(college_info)
+        return queued
+
+    def hooks_due(self, job, now):
+        if not job.get('last_run'):
+            return False
+        for name, interval, _ in self.hooks:
+            last = job.get('hooks', {}).get(name)
+            if not last or now - last >= interval:
+                return True
+        return False
+
+    def maintain(self, college_info):
+        """
+        Run the due hooks of a college in their own thread. The rebuilds
+        replace what the listeners of a crawl write, so the college is held
+        as running and isn't crawled until they finish.
+        """
+        with self.lock:
+            self.running.add(college_info['subreddit'])
+        self.maintenance = threading.Thread(target=self.run_maintenance,
+            args=(college_info,), name='scheduler-hooks')
+        self.maintenance.daemon = True
+        self.maintenance.start()
+
+    def run_maintenance(self, college_info):
+        try:
+            job = self.store.load(college_info)
+            self.run_hooks(college_info, job)
+            self.store.save(job)
+        finally:
+            with self.lock:
+                self.running.discard(college_info['subreddit'])
+                self.maintenance = None
+
+    def work(self):
+        while True:
+            college_info = self.due.get()
+            client = self.slots.get()
+            try:
+                self.run_job(client, college_info)
+            finally:
+                self.slots.put(client)
+                with self.lock:
+                    self.running.discard(college_info['subreddit'])
+                self.due.task_done()
+
+    def run_job(self, client, college_info):
+        job = self.store.load(college_info)
+        started = datetime.utcnow()
+        try:
+            self.crawl(client, college_info)
+        except Exception as e:
+            logger.exception('Crawl of {} failed'.format(college_info['name']))
+            job['failures'] += 1
+            job['last_error'] = repr(e)
+            # Back off exponentially, but keep retrying within max_interval.
+            job['next_run'] = datetime.utcnow() + min(self.max_interval,
+                self.min_interval * 2 ** min(job['failures'], 10))
+            self.store.save(job)
+            return job
+        job['last_run'] = started
+        job['last_duration'] = (datetime.utcnow() - started).total_seconds()
+        job['failures'] = 0
+        job['last_error'] = None
+        job['posts_per_hour'] = self.post_rate(college_info,
+            job['posts_per_hour'])
+        job['next_run'] = datetime.utcnow() + self.interval(
+            job['posts_per_hour'])
+        self.store.save(job)
+        logger.info('Crawled {} in {:.0f}s, {:.1f} posts/h, next at {}'.format(
+            college_info['name'], job['last_duration'],
+            job['posts_per_hour'], job['next_run']))
+        return job
+
+    def crawl(self, client, college_info):
+        worker = crawler.RedditWorker(client, self.database_client, None,
+            checkpoint=self.checkpoint)
+        start, end = crawler.crawl_range(self.database_client, college_info,
+            self.checkpoint)
+        worker.crawl(college_info, start, end)
+
+    def post_rate(self, college_info, previous=None, window=timedelta(days=1)):
+        """
+        Returns: posts per hour over the last window, smoothed with the
+            previous estimate
+        """
+        count = self.db.posts.find({'college': college_info['name'],
+            'created_utc': {'$gte': datetime.utcnow() - window}}).count()
+        rate = count / (window.total_seconds() / 3600)
+        if previous is None:
+            return rate
+        return 0.5 * previous + 0.5 * rate
+
+    def interval(self, posts_per_hour):
+        if not posts_per_hour:
+            return self.max_interval
+        interval = timedelta(hours=self.target_posts / posts_per_hour)
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def run_hooks(self, college_info, job):
+        now = datetime.utcnow()
+        for name, interval, function in self.hooks:
+            last = job['hooks'].get(name)
+            if last and now - last < interval:
+                continue
+            try:
+                function(self.db, [college_info])
+                job['hooks'][name] = now
+            except Exception:
+                logger.exception('{} hook failed for {}'.format(
+                    name, college_info['name']))
+
+
+# The crawler's listeners keep the rollups and document frequencies up to
+# date incrementally. These rebuilds correct any drift, e.g. from crawls
+# interrupted between a write and its listeners.
+DEFAULT_HOOKS = [
+    ('rollups', timedelta(days=1), rollups.backfill),
+    ('vocabulary', timedelta(days=1), vocabulary.rebuild)
+]
+
+
+if __name__ == '__main__':
+    import indexes
+    from config import SUBREDDITS, CREDENTIALS
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('requests').setLevel(logging.CRITICAL)
+    logging.getLogger('urllib3').setLevel(logging.CRITICAL)
+    db = mongo.get_db()
+    indexes.ensure_indexes(db)
+    Scheduler(db, crawler.rate_limited_clients(CREDENTIALS),
+        crawler.default_database_service(), SUBREDDITS,
+        checkpoint=crawler.default_checkpoint()).start()
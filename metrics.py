@@ -0,0 +1,158 @@
+import bisect
+import threading
+import time
+import config
+
+LATENCY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {}
+
+
+class Histogram(object):
+    """ Counts of observations per bucket upper bound, plus sum and max """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def json(self):
+        labels = [str(bound) for bound in self.buckets] + ['+Inf']
+        return {
+            'buckets': dict(zip(labels, self.counts)),
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max
+        }
+
+
+class Stage(object):
+    """
+    Context manager timing one stage of the current request.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, (time.time() - self.start) * 1000)
+        return False
+
+
+class NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_stage = NullStage()
+
+def stage(name):
+    """
+    Input:
+        name <string>: stage name, reported in the Server-Timing header and
+            as the 'stage.<name>' histogram
+
+    Returns: a context manager, doing nothing when config.REQUEST_METRICS
+        is off
+    """
+    if not config.REQUEST_METRICS:
+        return _null_stage
+    return Stage(name)
+
+def timed(name, iterable):
+    """
+    Iterate over iterable timing the stage as the time spent producing the
+    items only, not the time the consumer holds on to each of them (e.g.
+    while a streamed response is sent). Recorded once the iteration ends.
+    """
+    if not config.REQUEST_METRICS:
+        for item in iterable:
+            yield item
+        return
+    iterator = iter(iterable)
+    millis = 0.0
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                millis += (time.time() - start) * 1000
+            yield item
+    finally:
+        record(name, millis)
+
+def record(name, millis):
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings.append((name, millis))
+    observe('stage.' + name, millis)
+
+def observe(name, value, buckets=LATENCY_BUCKETS):
+    if not config.REQUEST_METRICS:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+def size(name, value):
+    """ Record a corpus size, edge count or other count """
+    observe(name, value, SIZE_BUCKETS)
+
+def begin():
+    """ Start collecting the stage timings of the current thread's request """
+    if config.REQUEST_METRICS:
+        _local.timings = []
+        _local.start = time.time()
+
+def end(endpoint):
+    """
+    Record the request's total latency under 'request.<endpoint>'.
+
+    Returns: list of (stage, milliseconds) followed by ('total', ms)
+    """
+    timings = getattr(_local, 'timings', None)
+    if not config.REQUEST_METRICS or timings is None:
+        return []
+    total = (time.time() - _local.start) * 1000
+    observe('request.{}'.format(endpoint), total)
+    _local.timings = None
+    return timings + [('total', total)]
+
+def server_timing(timings):
+    """
+    Returns: Server-Timing header value, e.g. 'query;dur=12.1, total;dur=30.2'
+    """
+    return ', '.join('{};dur={:.1f}'.format(name, millis)
+        for name, millis in timings)
+
+def snapshot():
+    with _lock:
+        return dict((name, histogram.json())
+            for name, histogram in _histograms.iteritems())
+
+def reset():
+    with _lock:
+        _histograms.clear()
@@ -0,0 +1,37 @@
+import threading
+import pymongo
+import config
+
+_client = None
+_database = None
+_lock = threading.Lock()
+
+def connect(name=None):
+    """
+    Returns: a database on a new client. Processes forked from a process
+        holding a client need their own, sockets don't survive a fork.
+    """
+    client = pymongo.MongoClient(config.MONGO_URI,
+        maxPoolSize=config.MONGO_POOL_SIZE)
+    return client[name or config.MONGO_DATABASE]
+
+def get_db():
+    """
+    Returns: the process wide database, connected on first use
+    """
+    global _client, _database
+    if _database is None:
+        with _lock:
+            if _database is None:
+                _client = pymongo.MongoClient(config.MONGO_URI,
+                    maxPoolSize=config.MONGO_POOL_SIZE)
+                _database = _client[config.MONGO_DATABASE]
+    return _database
+
+def set_db(database):
+    """
+    Use another database, e.g. a mongomock one in benchmarks.
+    """
+    global _database
+    with _lock:
+        _database = database
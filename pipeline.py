@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+from Queue import Queue
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(object):
+    """
+    Pool of threads applying a function to the items of a bounded input
+    queue. The function returns an iterable of results which are put on the
+    next stage's queue, blocking when it is full so that a slow stage applies
+    backpressure to the ones before it.
+    """
+
+    def __init__(self, name, function, workers=1, queue_size=100):
+        """
+        Input:
+            name <string>: name used in logs and metrics
+            function <function>: item -> iterable of results. If it has a
+                flush method it is called once the stage has drained.
+            workers <int>: number of threads
+            queue_size <int>: capacity of the input queue
+        """
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue_size = queue_size
+        self.inbox = Queue(maxsize=queue_size)
+        self.next_stage = None
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.produced = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.run,
+                name='{}-{}'.format(self.name, i))
+            worker.daemon = True
+            worker.start()
+
+    def put(self, item):
+        self.inbox.put(item)
+        depth = self.inbox.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def run(self):
+        while True:
+            item = self.inbox.get()
+            start = time.time()
+            produced = 0
+            try:
+                for result in self.function(item) or ():
+                    if self.next_stage:
+                        self.next_stage.put(result)
+                    produced += 1
+            except Exception:
+                logger.exception('{} failed'.format(self.name))
+                with self.lock:
+                    self.errors += 1
+            finally:
+                with self.lock:
+                    self.processed += 1
+                    self.produced += produced
+                    self.busy += time.time() - start
+                self.inbox.task_done()
+
+    def join(self):
+        self.inbox.join()
+        flush = getattr(self.function, 'flush', None)
+        if flush:
+            for result in flush() or ():
+                if self.next_stage:
+                    self.next_stage.put(result)
+
+    def metrics(self):
+        elapsed = time.time() - self.started if self.started else 0
+        with self.lock:
+            return {
+                'stage': self.name,
+                'workers': self.workers,
+                'processed': self.processed,
+                'produced': self.produced,
+                'errors': self.errors,
+                'throughput': self.processed / elapsed if elapsed else 0.0,
+                'utilization': (self.busy / (elapsed * self.workers)
+                    if elapsed else 0.0),
+                'queue_depth': self.inbox.qsize(),
+                'max_queue_depth': self.max_depth
+            }
+
+
+class Pipeline(object):
+    """ Chain of stages, each feeding the next one's input queue """
+
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+
+    def start(self, log_interval=None):
+        """
+        Input:
+            log_interval <int>: seconds between metric log lines, disabled
+                when None
+        """
+        for stage in self.stages:
+            stage.start()
+        if log_interval:
+            monitor = threading.Thread(target=self.log, args=(log_interval,))
+            monitor.daemon = True
+            monitor.start()
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def join(self):
+        """
+        Wait for every item put so far to make it through the last stage.
+        """
+        for stage in self.stages:
+            stage.join()
+
+    def metrics(self):
+        return [stage.metrics() for stage in self.stages]
+
+    def log(self, interval):
+        while True:
+            time.sleep(interval)
+            for metrics in self.metrics():
+                logger.info('{stage}: {processed} done {throughput:.1f}/s '
+                    'queue {queue_depth}/{max_queue_depth} '
+                    'errors {errors}'.format(**metrics))
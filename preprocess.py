@@ -0,0 +1,156 @@
+import multiprocessing
+import re
+import threading
+from collections import Counter, defaultdict
+
+# CountVectorizer's default token pattern: words of two or more characters.
+TOKEN = re.compile(r'(?u)\b\w\w+\b')
+
+# Words whose stem is memoized, the memo is cleared when it is full.
+MAX_STEMS = 200000
+
+_stopwords = None
+_stemmer = None
+_stems = {}
+_preprocessor = None
+_preprocessor_lock = threading.Lock()
+
+def tokenize(text):
+    """
+    Normalize, tokenize, drop stopwords and stem a document.
+
+    Input:
+        text <string>: post or comment text
+
+    Returns: list<str> of stemmed tokens in document order
+    """
+    return [stem for _, stem in words(text)]
+
+def words(text):
+    """
+    Returns: list of (word, stem) of the words of a document that aren't
+        stopwords
+    """
+    global _stopwords, _stemmer
+    if _stopwords is None:
+        import nltk
+        from nltk.stem.porter import PorterStemmer
+        _stopwords = frozenset(nltk.corpus.stopwords.words('english'))
+        _stemmer = PorterStemmer()
+    pairs = []
+    for word in TOKEN.findall((text or '').lower()):
+        if word in _stopwords:
+            continue
+        stem = _stems.get(word)
+        if stem is None:
+            # Stemming dominates the cost and reddit vocabularies are small,
+            # so every word is only stemmed once per process.
+            if len(_stems) >= MAX_STEMS:
+                _stems.clear()
+            stem = _stems[word] = _stemmer.stem(word)
+        pairs.append((word, stem))
+    return pairs
+
+def surface_forms(texts, stems=None):
+    """
+    Map stems back to a readable word.
+
+    Input:
+        texts iterable<string>: documents the stems come from
+        stems iterable<str>: only map these stems, all of them when None
+
+    Returns: {stem: the most frequent word with that stem}
+    """
+    wanted = set(stems) if stems is not None else None
+    counts = defaultdict(Counter)
+    for text in texts:
+        for word, stem in words(text):
+            if wanted is None or stem in wanted:
+                counts[stem][word] += 1
+    return dict((stem, min(forms.iteritems(),
+        key=lambda form: (-form[1], form[0]))[0])
+        for stem, forms in counts.iteritems())
+
+def default_preprocessor():
+    """
+    Returns: the Preprocessor shared by every MongoDBService of the process
+    """
+    global _preprocessor
+    with _preprocessor_lock:
+        if _preprocessor is None:
+            _preprocessor = Preprocessor()
+    return _preprocessor
+
+
+class Preprocessor(object):
+    """
+    Tokenizes batches of serialized posts and comments in a process pool
+    and stores the tokens next to their text.
+    """
+
+    def __init__(self, processes=None, min_parallel=200, chunksize=50):
+        """
+        Input:
+            processes <int>: pool size, one per cpu by default
+            min_parallel <int>: smaller batches are tokenized in process
+            chunksize <int>: documents sent to a worker at a time
+        """
+        # Created up front so the workers are forked before the crawler
+        # starts its threads, see default_preprocessor.
+        self.pool = multiprocessing.Pool(processes)
+        self.min_parallel = min_parallel
+        self.chunksize = chunksize
+
+    def tokenize_many(self, texts):
+        if len(texts) < self.min_parallel:
+            return map(tokenize, texts)
+        return self.pool.map(tokenize, texts, self.chunksize)
+
+    def __call__(self, records):
+        """
+        Input:
+            records list<dict>: serialized documents, updated in place
+        """
+        for record, tokens in zip(records, self.tokenize_many(
+                [record['text'] for record in records])):
+            record['tokens'] = tokens
+
+
+def backfill(db, colleges, preprocessor=None, batch_size=1000):
+    """
+    Tokenize the posts and comments stored before the crawler preprocessed
+    documents.
+
+    Input:
+        db: pymongo database
+        colleges list<dict>: {'name', 'subreddit'}
+        preprocessor <Preprocessor>: created when not given
+    """
+    preprocessor = preprocessor or Preprocessor()
+    for college_info in colleges:
+        for collection in ('posts', 'comments'):
+            cursor = db[collection].find({'college': college_info['name'],
+                'tokens': {'$exists': False}}, {'text': True})
+            batch = []
+            for document in cursor:
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    _store(db[collection], batch, preprocessor)
+                    batch = []
+            _store(db[collection], batch, preprocessor)
+
+def _store(collection, documents, preprocessor):
+    if not documents:
+        return
+    preprocessor(documents)
+    bulk = collection.initialize_unordered_bulk_op()
+    for document in documents:
+        bulk.find({'_id': document['_id']}).update_one(
+            {'$set': {'tokens': document['tokens']}})
+    bulk.execute()
+
+
+if __name__ == '__main__':
+    import mongo
+    from config import SUBREDDITS
+    backfill(mongo.get_db(), SUBREDDITS)
@@ -0,0 +1,172 @@
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from pymongo.cursor import Cursor
+import config
+
+logger = logging.getLogger(__name__)
+
+records = deque(maxlen=1000)
+_lock = threading.Lock()
+
+def profiled(name):
+    """
+    When config.QUERY_PROFILING is on, record the latency of every call of
+    the decorated query function. A returned cursor is explained to record
+    the plan and documents examined, and its latency is only recorded once
+    it has been iterated, queries run lazily.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not config.QUERY_PROFILING:
+                return function(*args, **kwargs)
+            start = time.time()
+            result = function(*args, **kwargs)
+            record = {'name': name, 'millis': (time.time() - start) * 1000}
+            if isinstance(result, Cursor):
+                record.update(explain(result))
+                return TimedCursor(result, record)
+            remember(record)
+            return result
+        return wrapper
+    return decorator
+
+
+class TimedCursor(object):
+    """
+    Cursor proxy adding the time spent iterating the cursor to the record
+    of its query, which is remembered once the cursor is exhausted or
+    closed.
+    """
+
+    def __init__(self, cursor, record):
+        self.cursor = cursor
+        self.record = record
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            return self.cursor.next()
+        except StopIteration:
+            self.finish()
+            raise
+        finally:
+            self.record['millis'] += (time.time() - start) * 1000
+
+    def close(self):
+        self.cursor.close()
+        self.finish()
+
+    def finish(self):
+        if not self.done:
+            self.done = True
+            remember(self.record)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.cursor, name)
+        if not callable(attribute):
+            return attribute
+
+        def method(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            # Keep the proxy when chaining sort, limit, batch_size...
+            return self if result is self.cursor else result
+        return method
+
+def inspect(name, cursor):
+    """
+    Explain a cursor created inside a function that consumes it itself.
+    """
+    if config.QUERY_PROFILING:
+        record = {'name': name}
+        record.update(explain(cursor))
+        remember(record)
+    return cursor
+
+def explain(cursor):
+    """
+    Returns: {'plan', 'docs_examined', 'returned', 'server_millis',
+        'collscan'} from the explain output of MongoDB 2.x or 3.x servers
+    """
+    output = cursor.clone().explain()
+    if 'queryPlanner' in output:
+        stages = []
+        plan = output['queryPlanner']['winningPlan']
+        while plan:
+            stages.append(plan['stage'])
+            plan = plan.get('inputStage') or (plan.get('inputStages') or
+                [None])[0]
+        stats = output.get('executionStats', {})
+        return {
+            'plan': stages,
+            'docs_examined': stats.get('totalDocsExamined'),
+            'returned': stats.get('nReturned'),
+            'server_millis': stats.get('executionTimeMillis'),
+            'collscan': 'COLLSCAN' in stages
+        }
+    return {
+        'plan': [output.get('cursor')],
+        'docs_examined': output.get('nscannedObjects'),
+        'returned': output.get('n'),
+        'server_millis': output.get('millis'),
+        'collscan': output.get('cursor') == 'BasicCursor'
+    }
+
+def remember(record):
+    with _lock:
+        records.append(record)
+    if record.get('collscan'):
+        logger.warning('Collection scan in {name}: {docs_examined} '
+            'documents examined'.format(**record))
+    elif duration(record) > config.SLOW_QUERY_MS:
+        logger.warning('Slow query {}: {}'.format(record['name'], record))
+
+def duration(record):
+    """
+    Returns: the server execution time of a query when it was explained,
+        otherwise the time measured by the client
+    """
+    if record.get('server_millis') is not None:
+        return record['server_millis']
+    return record.get('millis') or 0
+
+def take():
+    """
+    Remove and return the records of this process. Pool workers send them
+    back to the parent process with their result, see merge.
+    """
+    with _lock:
+        taken = list(records)
+        records.clear()
+    return taken
+
+def merge(taken):
+    with _lock:
+        records.extend(taken)
+
+def summary():
+    """
+    Returns: per query name {'calls', 'mean_millis', 'max_millis',
+        'collscans'} plus the most recent records
+    """
+    with _lock:
+        recent = list(records)
+    queries = {}
+    for record in recent:
+        stats = queries.setdefault(record['name'], {'calls': 0,
+            'total_millis': 0.0, 'max_millis': 0.0, 'collscans': 0})
+        millis = duration(record)
+        stats['calls'] += 1
+        stats['total_millis'] += millis
+        stats['max_millis'] = max(stats['max_millis'], millis)
+        stats['collscans'] += int(bool(record.get('collscan')))
+    for stats in queries.itervalues():
+        stats['mean_millis'] = stats.pop('total_millis') / stats['calls']
+    return {'queries': queries, 'recent': recent[-50:]}
@@ -0,0 +1,111 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+
+def adjacency(n, pairs):
+    """
+    Returns: symmetric n x n scipy.sparse.csr_matrix of the undirected edges
+    """
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    columns = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, columns)),
+        shape=(n, n))
+
+
+def degrees(n, pairs):
+    return np.asarray(adjacency(n, pairs).sum(axis=1)).ravel()
+
+
+def renumber(labels):
+    """
+    Relabel groups 0, 1, ... from the largest to the smallest, ties broken
+    by their first member, so labels are stable for the same graph.
+    """
+    labels = np.asarray(labels)
+    groups, first, sizes = np.unique(labels, return_index=True,
+        return_counts=True)
+    order = np.lexsort((first, -sizes))
+    mapping = np.empty(len(groups), dtype=int)
+    mapping[order] = np.arange(len(groups))
+    return mapping[np.searchsorted(groups, labels)]
+
+
+def components(n, pairs):
+    """
+    Returns: array of the connected component of every node
+    """
+    _, labels = csgraph.connected_components(adjacency(n, pairs),
+        directed=False)
+    return renumber(labels)
+
+
+def clusters(n, pairs, iterations=10, seed=0):
+    """
+    Label propagation: every node repeatedly takes the most common label of
+    its neighbours until labels settle. Deterministic for a given seed.
+    Splits the giant component of a dense window into topical clusters.
+
+    Returns: array of the cluster of every node
+    """
+    graph = adjacency(n, pairs)
+    labels = np.arange(n)
+    random = np.random.RandomState(seed)
+    for _ in range(iterations):
+        changed = 0
+        for node in random.permutation(n):
+            start, end = graph.indptr[node], graph.indptr[node + 1]
+            if start == end:
+                continue
+            neighbours = labels[graph.indices[start:end]]
+            values, counts = np.unique(neighbours, return_counts=True)
+            candidates = values[counts == counts.max()]
+            # Keeping the current label on ties stops one label from
+            # flooding the graph through its bridges.
+            if labels[node] in candidates:
+                continue
+            labels[node] = candidates[random.randint(len(candidates))]
+            changed += 1
+        if not changed:
+            break
+    return renumber(labels)
+
+
+def top_nodes(scores, max_nodes):
+    """
+    Returns: sorted indices of the max_nodes highest scores
+    """
+    order = np.argsort(-np.asarray(scores, dtype=float), kind='mergesort')
+    return np.sort(order[:max_nodes])
+
+
+def subgraph(keep, pairs):
+    """
+    Input:
+        keep array<int>: sorted indices of the nodes kept
+        pairs list<(int, int)>: edges of the full graph
+
+    Returns: the edges between kept nodes, renumbered by position in keep
+    """
+    position = dict((node, i) for i, node in enumerate(keep))
+    return [(position[i], position[j]) for i, j in pairs
+        if i in position and j in position]
+
+
+def collapse(labels, pairs):
+    """
+    Merge every group of nodes into a super-node.
+
+    Returns: (array of group sizes, list of (source, target, weight) edges
+        between groups with weight the number of edges merged)
+    """
+    sizes = np.bincount(labels)
+    weights = {}
+    for i, j in pairs:
+        a, b = labels[i], labels[j]
+        if a != b:
+            key = (min(a, b), max(a, b))
+            weights[key] = weights.get(key, 0) + 1
+    return sizes, [(int(a), int(b), weight)
+        for (a, b), weight in sorted(weights.iteritems())]
@@ -0,0 +1,122 @@
+import pymongo
+from collections import Counter
+from datetime import datetime
+
+COLLECTIONS = {
+    'day': 'activity_daily',
+    'hour': 'activity_hourly'
+}
+
+def truncate(dt, resolution):
+    """
+    Start of the day or hour containing dt.
+    """
+    if resolution == 'day':
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+class ActivityRollup(object):
+    """
+    Maintains per-college post and comment counts per day and per hour as
+    the crawler inserts documents. Registered as a MongoDBService listener.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def on_write(self, college_info, posts, comments):
+        """
+        Input:
+            college_info <dict>: {'name', 'subreddit'}
+            posts list<dict>: newly inserted posts
+            comments list<dict>: newly inserted comments
+        """
+        college = college_info['name']
+        for resolution, collection in COLLECTIONS.iteritems():
+            counts = Counter()
+            for kind, documents in (('posts', posts), ('comments', comments)):
+                for document in documents:
+                    counts[truncate(document['created_utc'], resolution),
+                        kind] += 1
+            if not counts:
+                continue
+            bulk = self.db[collection].initialize_unordered_bulk_op()
+            for (time, kind), count in counts.iteritems():
+                bulk.find({'college': college, 'time': time}).upsert().update(
+                    {'$inc': {kind: count}})
+            bulk.execute()
+
+
+def backfill(db, colleges):
+    """
+    Rebuild the rollups of the given colleges from the posts and comments
+    already in the database. Run it while the colleges aren't crawled, see
+    jobs.Scheduler, the counts of a crawl writing meanwhile may be
+    overwritten.
+
+    Input:
+        db: pymongo database
+        colleges list<dict>: {'name', 'subreddit'}
+    """
+    for college_info in colleges:
+        college = college_info['name']
+        hourly = Counter()
+        for kind in ('posts', 'comments'):
+            pipeline = [
+                {'$match': {'college': college}},
+                {'$project': {
+                    'y': {'$year': '$created_utc'},
+                    'm': {'$month': '$created_utc'},
+                    'd': {'$dayOfMonth': '$created_utc'},
+                    'h': {'$hour': '$created_utc'}
+                }},
+                {'$group': {
+                    '_id': {'y': '$y', 'm': '$m', 'd': '$d', 'h': '$h'},
+                    'total': {'$sum': 1}
+                }}
+            ]
+            groups = db[kind].aggregate(pipeline)
+            # pymongo 2.x returns the command response, 3.x a cursor.
+            if isinstance(groups, dict):
+                groups = groups['result']
+            for group in groups:
+                _id = group['_id']
+                hourly[(_id['y'], _id['m'], _id['d'], _id['h']), kind] += \
+                    group['total']
+        for resolution, collection in COLLECTIONS.iteritems():
+            counts = Counter()
+            for (hour, kind), total in hourly.iteritems():
+                time = truncate(datetime(*hour), resolution)
+                counts[time, kind] += total
+            buckets = {}
+            for (time, kind), total in counts.iteritems():
+                buckets.setdefault(time, {'posts': 0, 'comments': 0})[kind] = \
+                    total
+            # Every bucket is replaced in place, /activity never sees a
+            # college without its buckets.
+            if buckets:
+                bulk = db[collection].initialize_unordered_bulk_op()
+                for time, bucket in buckets.iteritems():
+                    selector = bulk.find({'college': college, 'time': time})
+                    selector.upsert().update({'$set': bucket})
+                bulk.execute()
+            db[collection].remove({'college': college,
+                'time': {'$nin': buckets.keys()}})
+
+
+def activity(db, college, start, end, resolution='day'):
+    """
+    Returns: cursor over the rollups of a college between start and end
+    """
+    return db[COLLECTIONS[resolution]].find({
+        'college': college,
+        'time': {'$gte': truncate(start, resolution), '$lte': end}
+    }, {'_id': False, 'time': True, 'posts': True, 'comments': True}).sort(
+        'time', pymongo.ASCENDING)
+
+
+if __name__ == '__main__':
+    import mongo
+    from config import SUBREDDITS
+    backfill(mongo.get_db(), SUBREDDITS)
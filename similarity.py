@@ -0,0 +1,157 @@
+import numpy as np
+
+# Beyond this many tables the index costs more than the exact computation.
+MAX_TABLES = 64
+
+
+def threshold_edges(vectors, threshold, block_size=1024):
+    """
+    Find every pair of documents whose cosine similarity is at least the
+    threshold. The vectors are expected to be l2 normalized (which is what
+    the tfidf transformer produces) so the dot product is the cosine.
+
+    Input:
+        vectors <scipy.sparse matrix>: n x V document vectors
+        threshold <float>: minimum similarity for an edge
+        block_size <int>: number of rows multiplied against the corpus at a
+            time. Bounds the size of the intermediate similarity matrix.
+
+    Returns: iterator of (source, target) tuples with source < target
+    """
+    vectors = vectors.tocsr()
+    transposed = vectors.T.tocsc()
+    for offset in range(0, vectors.shape[0], block_size):
+        block = vectors[offset:offset + block_size].dot(transposed).tocoo()
+        rows = block.row + offset
+        # Only keep the upper triangle so each undirected edge is emitted once
+        # and self similarity is dropped.
+        mask = (block.data >= threshold) & (rows < block.col)
+        for source, target in zip(rows[mask], block.col[mask]):
+            yield int(source), int(target)
+
+
+def top_k_edges(vectors, k, threshold=0.0, block_size=1024):
+    """
+    Connect every document to its k most similar neighbours above the
+    threshold.
+
+    Input:
+        vectors <scipy.sparse matrix>: n x V l2 normalized document vectors
+        k <int>: maximum number of neighbours kept per document
+        threshold <float>: minimum similarity for an edge
+        block_size <int>: number of rows multiplied against the corpus at a
+            time.
+
+    Returns: iterator of (source, target) tuples with source < target
+    """
+    vectors = vectors.tocsr()
+    transposed = vectors.T.tocsc()
+    seen = set()
+    for offset in range(0, vectors.shape[0], block_size):
+        block = vectors[offset:offset + block_size].dot(transposed).tocsr()
+        for i in range(block.shape[0]):
+            source = i + offset
+            start, end = block.indptr[i], block.indptr[i + 1]
+            scores = block.data[start:end]
+            targets = block.indices[start:end]
+            mask = (scores >= threshold) & (targets != source)
+            scores, targets = scores[mask], targets[mask]
+            if len(scores) > k:
+                best = np.argpartition(-scores, k - 1)[:k]
+                targets = targets[best]
+            for target in targets:
+                edge = (min(source, target), max(source, target))
+                if edge not in seen:
+                    seen.add(edge)
+                    yield int(edge[0]), int(edge[1])
+
+
+class RandomProjectionIndex(object):
+    """
+    Locality sensitive hash for cosine similarity. Every table hashes a
+    vector to the signs of its projections onto random hyperplanes, so
+    similar vectors are likely to share a bucket in at least one table.
+    More tables raise recall, more bits per table shrink the buckets.
+    """
+
+    def __init__(self, n_features, tables=8, bits=12, seed=0):
+        """
+        Input:
+            n_features <int>: dimensionality of the indexed vectors
+            tables <int>: number of independent hash tables
+            bits <int>: hyperplanes per table
+            seed <int>: seed for the random hyperplanes
+        """
+        self.tables = tables
+        self.bits = bits
+        random = np.random.RandomState(seed)
+        self.planes = random.standard_normal(
+            (n_features, tables * bits)).astype(np.float32)
+        self.powers = 1 << np.arange(bits, dtype=np.int64)
+
+    def hash(self, vectors):
+        """
+        Returns: n x tables array of bucket codes
+        """
+        signs = np.asarray(vectors.dot(self.planes)) > 0
+        signs = signs.reshape(vectors.shape[0], self.tables, self.bits)
+        return signs.dot(self.powers)
+
+    def buckets(self, vectors, max_bucket_size=2000):
+        """
+        Groups of vectors that share a bucket, one table at a time.
+
+        Input:
+            vectors <scipy.sparse matrix>: n x n_features vectors
+            max_bucket_size <int>: buckets larger than this are ignored so
+                degenerate hashes (e.g. empty documents) can't bring back the
+                quadratic cost
+
+        Returns: iterator of sorted arrays of row indices
+        """
+        codes = self.hash(vectors)
+        for table in range(self.tables):
+            order = np.argsort(codes[:, table], kind='mergesort')
+            boundaries = np.flatnonzero(np.diff(codes[order, table])) + 1
+            for bucket in np.split(order, boundaries):
+                if 1 < len(bucket) <= max_bucket_size:
+                    yield np.sort(bucket)
+
+
+def approximate_edges(vectors, threshold, tables=8, bits=None, seed=0,
+        bucket_size=256):
+    """
+    Like threshold_edges but only scores pairs of documents that share a
+    bucket of a RandomProjectionIndex. Some edges may be missed, none are
+    invented.
+
+    Input:
+        vectors <scipy.sparse matrix>: n x V l2 normalized document vectors
+        threshold <float>: minimum similarity for an edge
+        tables <int>: number of hash tables, the recall/speed knob, at most
+            MAX_TABLES
+        bits <int>: hyperplanes per table. Defaults to enough bits for the
+            average bucket to hold bucket_size documents.
+        seed <int>: seed for the random hyperplanes
+        bucket_size <int>: target average bucket size when bits is not set
+
+    Returns: iterator of (source, target) tuples with source < target
+    """
+    if not 0 < tables <= MAX_TABLES:
+        raise ValueError('tables must be between 1 and {}'.format(MAX_TABLES))
+    vectors = vectors.tocsr()
+    if bits is None:
+        bits = int(np.clip(np.log2(vectors.shape[0] / float(bucket_size)),
+            1, 30))
+    index = RandomProjectionIndex(vectors.shape[1], tables, bits, seed)
+    seen = set()
+    for bucket in index.buckets(vectors):
+        members = vectors[bucket]
+        scores = members.dot(members.T).tocoo()
+        mask = (scores.data >= threshold) & (scores.row < scores.col)
+        for source, target in zip(bucket[scores.row[mask]],
+                bucket[scores.col[mask]]):
+            edge = (int(source), int(target))
+            if edge not in seen:
+                seen.add(edge)
+                yield edge
@@ -0,0 +1,348 @@
+import json
+import os
+import shutil
+import sys
+from datetime import datetime, timedelta
+import numpy as np
+from bson.objectid import ObjectId
+from scipy import sparse
+import preprocess
+
+EPOCH = datetime(1970, 1, 1)
+POST_FIELDS = {'_id': True, 'title': True, 'text': True, 'tokens': True,
+    'ups': True, 'created_utc': True, 'comments': True}
+COMMENT_FIELDS = {'_id': True, 'text': True, 'tokens': True, 'ups': True,
+    'created_utc': True}
+
+def to_millis(dt):
+    delta = dt - EPOCH
+    return delta.days * 86400000 + delta.seconds * 1000 + \
+        delta.microseconds // 1000
+
+def from_millis(millis):
+    return EPOCH + timedelta(milliseconds=int(millis))
+
+def months(start, end):
+    """
+    Returns: 'YYYY-MM' names of the months between two datetimes
+    """
+    year, month = start.year, start.month
+    names = []
+    while (year, month) <= (end.year, end.month):
+        names.append('{:04d}-{:02d}'.format(year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return names
+
+
+class Vocabulary(object):
+    """ Dictionary encoding of the tokens of a snapshot """
+
+    def __init__(self, terms=()):
+        self.terms = list(terms)
+        self.codes = dict((term, i) for i, term in enumerate(self.terms))
+
+    def encode(self, tokens):
+        codes = []
+        for token in tokens:
+            code = self.codes.get(token)
+            if code is None:
+                code = self.codes[token] = len(self.terms)
+                self.terms.append(token)
+            codes.append(code)
+        return codes
+
+
+class TableWriter(object):
+    """
+    Accumulates the rows of one table (posts or comments) of a partition and
+    writes every column as a .npy file. Variable length columns are a flat
+    values file plus an offsets file.
+    """
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.created_utc = []
+        self.ups = []
+        self.ids = []
+        self.strings = {}
+        self.tokens = []
+        self.token_offsets = [0]
+
+    def add(self, document, strings=('text',)):
+        self.created_utc.append(to_millis(document['created_utc']))
+        self.ups.append(document.get('ups') or 0)
+        self.ids.append(document['_id'].binary)
+        for name in strings:
+            self.strings.setdefault(name, []).append(
+                (document.get(name) or u'').encode('utf-8'))
+        tokens = document.get('tokens')
+        if tokens is None:
+            tokens = preprocess.tokenize(document['text'])
+        self.tokens.extend(self.vocabulary.encode(tokens))
+        self.token_offsets.append(len(self.tokens))
+
+    def write(self, directory, prefix):
+        def path(name):
+            return os.path.join(directory, '{}_{}'.format(prefix, name))
+        np.save(path('created_utc.npy'), np.array(self.created_utc, np.int64))
+        np.save(path('ups.npy'), np.array(self.ups, np.int32))
+        np.save(path('id.npy'), np.frombuffer(b''.join(self.ids),
+            np.uint8).reshape(-1, 12))
+        for name, values in self.strings.iteritems():
+            with open(path(name + '.bin'), 'wb') as f:
+                f.write(b''.join(values))
+            np.save(path(name + '_offsets.npy'), np.concatenate(
+                [[0], np.cumsum([len(value) for value in values])]).astype(
+                np.int64))
+        np.save(path('tokens.npy'), np.array(self.tokens, np.int32))
+        np.save(path('token_offsets.npy'), np.array(self.token_offsets,
+            np.int64))
+
+
+def export(db, root, colleges, batch_size=1000, keep=2):
+    """
+    Snapshot the posts and comments of the given colleges into
+    root/<subreddit>/<YYYY-MM>/, one directory per month of posts. Comments
+    are stored in the partition of their post, ordered by post, so a
+    partition is self contained. Comments no post refers to are left out.
+
+    root is a symlink to the current version, a directory next to it. A new
+    version is written in full then swapped in by renaming a symlink over
+    root, so readers always find a complete snapshot.
+
+    Input:
+        db: pymongo database
+        root <string>: snapshot path
+        colleges list<dict>: {'name', 'subreddit'}
+        batch_size <int>: posts whose comments are fetched in one query
+        keep <int>: versions kept, readers opened on the previous one can
+            finish
+    """
+    root = root.rstrip('/')
+    staging = '{}.{}'.format(root,
+        datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+    os.makedirs(staging)
+    vocabulary = Vocabulary()
+    manifest = {'created': datetime.utcnow().isoformat(), 'colleges': {}}
+    for college_info in colleges:
+        partitions = {}
+        cursor = db.posts.find({'college': college_info['name']},
+            POST_FIELDS).sort('created_utc', 1)
+        batch = []
+        for post in cursor:
+            batch.append(post)
+            if len(batch) >= batch_size:
+                _export_batch(db, batch, partitions, vocabulary)
+                batch = []
+        _export_batch(db, batch, partitions, vocabulary)
+        for month, (posts, comments, offsets) in partitions.iteritems():
+            directory = os.path.join(staging, college_info['subreddit'],
+                month)
+            os.makedirs(directory)
+            posts.write(directory, 'posts')
+            comments.write(directory, 'comments')
+            np.save(os.path.join(directory, 'posts_comment_offsets.npy'),
+                np.array(offsets, np.int64))
+        manifest['colleges'][college_info['name']] = {
+            'subreddit': college_info['subreddit'],
+            'months': sorted(partitions),
+            'posts': sum(len(p[0].ids) for p in partitions.itervalues()),
+            'comments': sum(len(p[1].ids) for p in partitions.itervalues())
+        }
+    with open(os.path.join(staging, 'vocabulary.json'), 'w') as f:
+        json.dump(vocabulary.terms, f)
+    with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    swap(root, staging)
+    _prune(root, keep)
+    return manifest
+
+def swap(root, version):
+    """
+    Atomically point the root symlink at a version directory.
+    """
+    if os.path.isdir(root) and not os.path.islink(root):
+        # Snapshots written before root was a symlink.
+        shutil.rmtree(root)
+    link = version + '.link'
+    os.symlink(os.path.basename(version), link)
+    os.rename(link, root)
+
+def _prune(root, keep):
+    directory, name = os.path.split(os.path.abspath(root))
+    current = os.path.basename(os.readlink(root))
+    versions = sorted(entry for entry in os.listdir(directory)
+        if entry.startswith(name + '.') and entry != current and
+        os.path.isdir(os.path.join(directory, entry)) and
+        not os.path.islink(os.path.join(directory, entry)))
+    for entry in versions[:max(len(versions) - keep + 1, 0)]:
+        shutil.rmtree(os.path.join(directory, entry))
+
+def _export_batch(db, posts, partitions, vocabulary):
+    ids = [_id for post in posts for _id in post.get('comments', []) if _id]
+    found = dict((comment['_id'], comment) for comment in
+        db.comments.find({'_id': {'$in': ids}}, COMMENT_FIELDS)) if ids else {}
+    for post in posts:
+        month = post['created_utc'].strftime('%Y-%m')
+        if month not in partitions:
+            partitions[month] = (TableWriter(vocabulary),
+                TableWriter(vocabulary), [0])
+        post_table, comment_table, offsets = partitions[month]
+        post_table.add(post, strings=('title', 'text'))
+        for _id in post.get('comments', []):
+            if _id in found:
+                comment_table.add(found[_id])
+        offsets.append(len(comment_table.ids))
+
+
+class Table(object):
+    """ Memory mapped columns of the posts or comments of a partition """
+
+    def __init__(self, directory, prefix):
+        self.directory = directory
+        self.prefix = prefix
+        self.columns = {}
+
+    def column(self, name):
+        if name not in self.columns:
+            path = os.path.join(self.directory,
+                '{}_{}'.format(self.prefix, name))
+            if name.endswith('.bin'):
+                if os.path.getsize(path):
+                    self.columns[name] = np.memmap(path, np.uint8, 'r')
+                else:
+                    self.columns[name] = np.zeros(0, np.uint8)
+            else:
+                self.columns[name] = np.load(path + '.npy', mmap_mode='r')
+        return self.columns[name]
+
+    def __len__(self):
+        return len(self.column('created_utc'))
+
+    def string(self, name, i):
+        offsets = self.column(name + '_offsets')
+        return self.column(name + '.bin')[
+            offsets[i]:offsets[i + 1]].tostring().decode('utf-8')
+
+    def token_codes(self, i):
+        offsets = self.column('token_offsets')
+        return self.column('tokens')[offsets[i]:offsets[i + 1]]
+
+    def object_id(self, i):
+        return ObjectId(self.column('id')[i].tostring())
+
+
+class Snapshot(object):
+    """
+    Read only view of a snapshot written by export. Columns are memory
+    mapped, nothing is read until a document or count matrix is built.
+    """
+
+    def __init__(self, root):
+        # Stay on the version current when opened, export may swap root.
+        self.root = os.path.realpath(root)
+        with open(os.path.join(self.root, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self._terms = None
+
+    @property
+    def terms(self):
+        """ numpy object array of the term of every token code """
+        if self._terms is None:
+            with open(os.path.join(self.root, 'vocabulary.json')) as f:
+                self._terms = np.array(json.load(f), dtype=object)
+        return self._terms
+
+    def partitions(self, college, start, end):
+        """
+        Returns: list of (posts Table, comments Table, comment offsets, first
+            post row, end post row) of the posts created between start and
+            end
+        """
+        info = self.manifest['colleges'].get(college)
+        if not info:
+            return []
+        selected = []
+        for month in months(start, end):
+            if month not in info['months']:
+                continue
+            directory = os.path.join(self.root, info['subreddit'], month)
+            posts = Table(directory, 'posts')
+            created = posts.column('created_utc')
+            first = np.searchsorted(created, to_millis(start), 'left')
+            last = np.searchsorted(created, to_millis(end), 'right')
+            if first < last:
+                selected.append((posts, Table(directory, 'comments'),
+                    posts.column('comment_offsets'), first, last))
+        return selected
+
+    def corpus(self, college, start, end, text=True):
+        """
+        Same documents and fields as handlers.graph_corpus: the posts
+        created between start and end, oldest first, followed by their
+        comments.
+
+        Returns: list<dict> with '_id', 'text', 'tokens', 'ups',
+            'created_utc' and 'color'
+        """
+        posts = []
+        comments = []
+        terms = self.terms
+        for post_table, comment_table, offsets, first, last in \
+                self.partitions(college, start, end):
+            for table, rows, color, documents in (
+                    (post_table, range(first, last), 'red', posts),
+                    (comment_table, range(offsets[first], offsets[last]),
+                        'blue', comments)):
+                created = table.column('created_utc')
+                ups = table.column('ups')
+                for i in rows:
+                    document = {
+                        '_id': table.object_id(i),
+                        'tokens': list(terms[table.token_codes(i)]),
+                        'ups': int(ups[i]),
+                        'created_utc': from_millis(created[i]),
+                        'color': color
+                    }
+                    if text:
+                        document['text'] = table.string('text', i)
+                    documents.append(document)
+        return posts + comments
+
+    def counts(self, college, start, end):
+        """
+        Token counts of the corpus of a date range, built straight from the
+        token code columns.
+
+        Returns: (scipy.sparse.csr_matrix documents x terms in corpus order,
+            terms array)
+        """
+        indices = {'posts': [], 'comments': []}
+        lengths = {'posts': [], 'comments': []}
+        for post_table, comment_table, offsets, first, last in \
+                self.partitions(college, start, end):
+            for kind, table, begin, end_row in (
+                    ('posts', post_table, first, last),
+                    ('comments', comment_table, offsets[first],
+                        offsets[last])):
+                token_offsets = table.column('token_offsets')
+                indices[kind].append(table.column('tokens')[
+                    token_offsets[begin]:token_offsets[end_row]])
+                lengths[kind].append(np.diff(
+                    token_offsets[begin:end_row + 1]))
+        parts = indices['posts'] + indices['comments']
+        sizes = lengths['posts'] + lengths['comments']
+        columns = np.concatenate(parts) if parts else np.zeros(0, np.int32)
+        indptr = np.concatenate([[0], np.cumsum(np.concatenate(sizes))]) \
+            if sizes else np.zeros(1, np.int64)
+        matrix = sparse.csr_matrix((np.ones(len(columns)), columns, indptr),
+            shape=(len(indptr) - 1, len(self.terms)))
+        matrix.sum_duplicates()
+        return matrix, self.terms
+
+
+if __name__ == '__main__':
+    # python snapshot.py <directory>
+    import mongo
+    from config import SUBREDDITS
+    export(mongo.get_db(), sys.argv[1], SUBREDDITS)
@@ -1,36 +1,137 @@
 import unittest
-from analysis import recent, KeywordExtractor, db
+from analysis import recent, KeywordExtractor, SankeyFormatter
+from mongo import get_db
+import mongo
 from tree import SuffixTree
+from crawler import (TokenBucket, ConcurrentCrawler, MongoDBService,
+    PipelineCrawler, BatchWriter, CrawlCheckpoint, WindowTracker)
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from similarity import threshold_edges, top_k_edges, approximate_edges
+import analysis
+import benchmarks
+import config
+import dao
+import crawler
+import comparison
+import handlers
+import jobs
+import metrics
+import pipeline
+import preprocess
+import profiling
+import reduction
+import rollups
+import similarity
+import snapshot
+import vocabulary
+from scipy import sparse
+import numpy as np
 import nltk
+import os
+import shutil
+import tempfile
+import time
 from collections import Counter
+from multiprocessing.dummy import Pool as ThreadPool
 
-# class SankeyTest(unittest.TestCase):
 
-#     def setUp(self): 
-#         self.formatter = SankeyFormatter(db, ['Georgia Tech', 'Purdue'], 'CS')
-#         self.text = self.formatter.search()
+def mongomock_database(test):
+    """
+    In-memory database shared by the modules for the duration of a test.
+    """
+    try:
+        import mongomock
+    except ImportError:
+        test.skipTest('mongomock is not installed')
+    database = mongomock.MongoClient().reddit
+    mongo.set_db(database)
+    test.addCleanup(mongo.set_db, None)
+    return database
 
-#     def test_process(self):
-#         for r in self.formatter._process(self.text):
-#             print r['relevent']
+class StubPool(object):
+    """ Answers the tasks of the given colleges, the others never finish """
 
+    def __init__(self, answered):
+        self.answered = answered
+        self.submitted = []
 
-# class SuffixTreeTest(unittest.TestCase):
+    def apply_async(self, function, args, callback):
+        task = args[0]
+        self.submitted.append(task)
+        if task[0] in self.answered:
+            callback(([['is', task[0]]], []))
 
-#     def setUp(self):
-#         self.docs = ['CS is hard', 'CS is easy', 'CS is fun']
-#         self.tree = SuffixTree('CS')
-#         self.tokens = [sent.split(' ') for sent in self.docs]
 
-#     def test_insert(self):
-#         for t in self.tokens:
-#             self.tree.insert(t)
+class SankeyTest(unittest.TestCase):
 
-#     def test_json(self):
-#         for t in self.tokens:
-#             self.tree.insert(t)
-#         graph = self.tree.json()
-#         print graph
+    def test_process(self):
+        formatter = SankeyFormatter(None, ['Georgia Tech'], 'CS')
+        self.assertEqual(list(formatter._process(
+            ['I think CS is hard. Math too', None, 'cs rocks!'])),
+            [['is', 'hard'], ['rocks']])
+
+    def test_json(self):
+        formatter = SankeyFormatter(None, ['a', 'b'], 'CS')
+        graph = formatter.json(pool=StubPool(['a', 'b']), timeout=1)
+        self.assertTrue(formatter.complete)
+        self.assertEqual(graph['nodes'][1], {'term': 'is', 'depth': 1,
+            'count': 4})
+
+    def test_timeout_stops_submitting(self):
+        formatter = SankeyFormatter(None, ['a', 'b', 'c', 'd'], 'CS')
+        pool = StubPool(['a'])
+        graph = formatter.json(pool=pool, timeout=0.05, parallel=2)
+        self.assertFalse(formatter.complete)
+        self.assertEqual(len(pool.submitted), 4)
+        self.assertEqual(graph['nodes'][1]['count'], 2)
+
+    def test_max_tasks(self):
+        formatter = SankeyFormatter(None, ['a', 'b', 'c'], 'CS')
+        pool = StubPool(['a', 'b', 'c'])
+        formatter.json(pool=pool, max_tasks=4)
+        self.assertFalse(formatter.complete)
+        self.assertEqual(len(pool.submitted), 4)
+
+
+class SuffixTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.docs = ['CS is hard', 'CS is easy', 'CS is fun', 'CS is hard']
+        self.tree = SuffixTree('CS')
+        self.tokens = [sent.split(' ') for sent in self.docs]
+
+    def test_insert(self):
+        self.tree.insert_many(self.tokens)
+        node = self.tree.root.children['is']
+        self.assertEqual(node.count, 4)
+        self.assertEqual(node.children['hard'].count, 2)
+        self.assertEqual(node.children['fun'].count, 1)
+
+    def test_json(self):
+        self.tree.insert_many(self.tokens)
+        graph = self.tree.json()
+        terms = [node['term'] for node in graph['nodes']]
+        self.assertEqual(terms, ['CS', 'is', 'hard', 'easy', 'fun'])
+        for edge in graph['edges']:
+            self.assertEqual(edge['weight'],
+                graph['nodes'][edge['target']]['count'])
+
+    def test_repeated_terms_keep_their_branches(self):
+        self.tree.insert_many([['a', 'b'], ['b', 'a']])
+        graph = self.tree.json()
+        edges = set((graph['nodes'][e['source']]['term'],
+            graph['nodes'][e['target']]['term']) for e in graph['edges'])
+        self.assertEqual(edges,
+            set([('CS', 'a'), ('a', 'b'), ('CS', 'b'), ('b', 'a')]))
+
+    def test_prune(self):
+        self.tree.insert_many(self.tokens)
+        self.tree.prune(min_count=2)
+        graph = self.tree.json()
+        self.assertEqual([node['term'] for node in graph['nodes']],
+            ['CS', 'is', 'hard'])
+        self.assertEqual(len(self.tree.json(top_k=1, max_depth=1)['nodes']), 2)
 
 class KeywordTests(unittest.TestCase):
 
@@ -39,11 +140,10 @@ class KeywordTests(unittest.TestCase):
         comments = []
         for p in posts:
             for c in p['comments']:
-                comment = db.comments.find_one({'_id': c})
+                comment = get_db().comments.find_one({'_id': c})
                 comments.append(comment)
         self.documents = posts + comments
         self.documents = [d for d in self.documents]
-        print len(self.documents)
         self.keywords = KeywordExtractor(get_text=lambda x: x['text'])
 
     def test_extract(self):
@@ -56,13 +156,977 @@ class KeywordTests(unittest.TestCase):
                     term = self.keywords.vocabulary_keys[self.keywords.vocabulary_values.index(i)]
                     terms.append(term)
             freqdist.extend(terms)
-            # print document['text']
-            # print '--------'
-            # print ','.join(terms)
-        # cnt = Counter(freqdist)
-        # for word, val in cnt.most_common(50):
-        #     print word, val
-        
+
+
+class KeywordExtractorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.documents = [{'text': text} for text in [
+            'the exam in the computer science class was hard',
+            'computer science majors take the hardest exam',
+            'football game on saturday, tickets for the game',
+            'the dining hall food is better than the football team',
+            'registration for classes opens on monday']]
+        self.keywords = KeywordExtractor(get_text=lambda x: x['text'])
+
+    def test_extract(self):
+        vectors = self.keywords.compute(self.documents)
+        terms = self.keywords.terms()
+        keywords = self.keywords.extract(self.documents, threshold=0.3)
+        self.assertEqual(len(keywords), len(self.documents))
+        for vector, document_keywords in zip(vectors, keywords):
+            expected = set(terms[i] for i, score in enumerate(vector)
+                if score > 0.3)
+            self.assertEqual(set(term for term, _ in document_keywords),
+                expected)
+        self.assertTrue(keywords[2][0][0] == 'game')
+
+    def test_extract_top_k(self):
+        keywords = self.keywords.extract(self.documents, threshold=0,
+            top_k=3)
+        for document_keywords in keywords:
+            self.assertEqual(len(document_keywords), 3)
+            scores = [score for _, score in document_keywords]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_frequencies(self):
+        frequencies = dict(self.keywords.frequencies(self.documents,
+            threshold=0))
+        self.assertEqual(frequencies['exam'], 2)
+        self.assertEqual(frequencies['football'], 2)
+        self.assertEqual(frequencies['registration'], 1)
+        self.assertEqual(self.keywords.frequencies(self.documents,
+            threshold=0, limit=2)[0][1], 2)
+
+
+class SimilarityTests(unittest.TestCase):
+
+    def setUp(self):
+        vectors = np.array([[1.0, 0.0, 0.0],
+                            [0.8, 0.6, 0.0],
+                            [0.0, 0.6, 0.8],
+                            [0.0, 0.0, 1.0]])
+        self.vectors = sparse.csr_matrix(vectors)
+        self.dense = vectors
+
+    def test_threshold_edges(self):
+        edges = sorted(threshold_edges(self.vectors, 0.5, block_size=3))
+        expected = [(i, j) for i in range(4) for j in range(i + 1, 4)
+            if self.dense[i].dot(self.dense[j]) >= 0.5]
+        self.assertEqual(edges, expected)
+
+    def test_top_k_edges(self):
+        edges = sorted(top_k_edges(self.vectors, 1, block_size=2))
+        self.assertEqual(edges, [(0, 1), (2, 3)])
+
+    def test_approximate_edges(self):
+        exact = set(threshold_edges(self.vectors, 0.5))
+        approximate = set(approximate_edges(self.vectors, 0.5, tables=32,
+            bits=1))
+        self.assertTrue(approximate <= exact)
+
+    def test_approximate_edges_recall(self):
+        vectors = benchmarks.synthetic_vectors(300, n_terms=2000,
+            n_topics=10)
+        exact = set(threshold_edges(vectors, 0.3))
+        approximate = set(approximate_edges(vectors, 0.3, tables=32))
+        self.assertTrue(len(exact) > 100)
+        self.assertTrue(len(approximate & exact) >= 0.9 * len(exact))
+
+    def test_tables_are_bounded(self):
+        self.assertEqual(handlers.graph_tables(None, 1000),
+            similarity.MAX_TABLES)
+        self.assertRaises(handlers.RequestError, handlers.graph_tables, 5, 8)
+        self.assertRaises(handlers.RequestError, handlers.graph_tables,
+            None, 0)
+        self.assertRaises(ValueError, list,
+            approximate_edges(self.vectors, 0.5, tables=1000))
+
+
+class StubRedditClient(object):
+
+    def __init__(self, username, calls):
+        self.username = username
+        self.calls = calls
+
+    def get_posts(self, subreddit, start, end, sort='new'):
+        self.calls.append((self.username, subreddit))
+        time.sleep(0.005)
+        return []
+
+    def get_comments(self, post):
+        return []
+
+
+class StubDatabaseService(object):
+
+    def save(self, posts, college_info, get_comments):
+        return
+
+    def last_post_date(self, college_info):
+        return False
+
+
+class CrawlerTests(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=50, capacity=1)
+        start = time.time()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertTrue(time.time() - start >= 0.09)
+
+    def test_concurrent_crawler_uses_every_credential(self):
+        calls = []
+        colleges = [{'name': str(i), 'subreddit': str(i)} for i in range(12)]
+        credentials = [('a', ''), ('b', ''), ('c', '')]
+        crawler = ConcurrentCrawler(credentials, colleges,
+            requests_per_second=1000, burst=1000, workers_per_credential=2,
+            client_factory=lambda username, _: StubRedditClient(username, calls),
+            database_factory=StubDatabaseService)
+        crawler.start()
+        self.assertEqual(set(subreddit for _, subreddit in calls),
+            set(college['subreddit'] for college in colleges))
+        self.assertEqual(set(username for username, _ in calls),
+            set(['a', 'b', 'c']))
+
+    def test_change_detection(self):
+        service = MongoDBService(None)
+        post = benchmarks.SyntheticSubmission('p', 'title', 'text', 3, 0, [])
+        record = service.serialize_post(post, {'name': 'a', 'subreddit': 'a'})
+        self.assertFalse(service.changed(record, dict(record)))
+        self.assertTrue(service.changed(record, dict(record, ups=2)))
+        self.assertTrue(service.changed(record, None))
+        self.assertTrue(service.comments_unchanged(post, record))
+        self.assertFalse(service.comments_unchanged(post,
+            dict(record, num_comments=1)))
+
+
+class ChangeDetectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock_database(self)
+        self.college_info, self.posts = benchmarks.synthetic_reddit(10,
+            n_colleges=1)[0]
+        self.service = MongoDBService(self.db,
+            listeners=[vocabulary.DocumentFrequencyUpdater(self.db)])
+        self.expanded = []
+        self.save()
+
+    def get_comments(self, post):
+        self.expanded.append(post.id)
+        return post.comments
+
+    def save(self):
+        self.service.counters.clear()
+        del self.expanded[:]
+        self.service.save(self.posts, self.college_info, self.get_comments)
+
+    def documents(self):
+        return sorted(self.db.posts.find(), key=lambda post: post['reddit_id'])
+
+    def test_unchanged_recrawl_writes_nothing(self):
+        documents = self.documents()
+        watermark = dao.watermark('*')
+        self.save()
+        self.assertEqual(self.expanded, [])
+        self.assertEqual(self.documents(), documents)
+        self.assertEqual(dao.watermark('*'), watermark)
+        self.assertEqual(self.service.stats(), {'posts_written': 0,
+            'posts_skipped': 10, 'comments_written': 0, 'comments_skipped': 0,
+            'expansions': 0, 'expansions_skipped': 10})
+
+    def test_changes_are_written(self):
+        watermark = dao.watermark('*')
+        post = self.posts[0]
+        post.ups += 1
+        post.comments.append(benchmarks.SyntheticComment('new', 'zebra', 1,
+            post.created_utc))
+        post.num_comments += 1
+        self.save()
+        self.assertEqual(self.expanded, [post.id])
+        stats = self.service.stats()
+        self.assertEqual((stats['posts_written'], stats['comments_written'],
+            stats['comments_skipped']), (1, 1, len(post.comments) - 1))
+        stored = self.db.posts.find_one({'reddit_id': post.id})
+        self.assertEqual(stored['ups'], post.ups)
+        self.assertEqual(len(stored['comments']), len(post.comments))
+        self.assertEqual(dao.watermark('*')[1], watermark[1] + 1)
+
+    def test_edits_move_document_frequencies(self):
+        self.posts[0].selftext = 'zebra crossing'
+        self.save()
+        self.assertEqual(self.service.stats()['posts_written'], 1)
+        college = self.college_info['name']
+        incremental = vocabulary.TfidfModel.load(self.db, college)
+        vocabulary.rebuild(self.db, [self.college_info])
+        rebuilt = vocabulary.TfidfModel.load(self.db, college)
+        self.assertTrue('zebra' in incremental.vocabulary)
+        self.assertTrue(np.allclose(
+            [incremental.idf[incremental.vocabulary[term]]
+                for term in rebuilt.vocabulary],
+            [rebuilt.idf[rebuilt.vocabulary[term]]
+                for term in rebuilt.vocabulary]))
+
+    def test_flush_interval_during_expansion(self):
+        clock = StubClock()
+        self.addCleanup(setattr, crawler, 'time', crawler.time)
+        crawler.time = clock
+        service = MongoDBService(self.db, flush_interval=5)
+        posts = [benchmarks.SyntheticSubmission(reddit_id, 'title', 'text', 1,
+            0, [benchmarks.SyntheticComment(reddit_id + str(i), 'text', 1, 0)
+            for i in range(n_comments)])
+            for reddit_id, n_comments in [('quick', 0), ('slow', 2)]]
+        stored = []
+
+        def get_comments(post):
+            for comment in post.comments:
+                yield comment
+                clock.now += 10
+                stored.append(self.db.posts.find({'title': 'title'}).count())
+        service.save(posts, self.college_info, get_comments)
+        self.assertEqual(stored, [0, 1])
+        self.assertEqual(self.db.posts.find({'title': 'title'}).count(), 2)
+
+
+class StubClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class StubListingClient(object):
+    """ Lists synthetic posts by date, fails to expand the given posts """
+
+    def __init__(self, posts, failing=()):
+        self.posts = posts
+        self.failing = set(failing)
+
+    def get_posts(self, subreddit, start, end, sort='new'):
+        return [post for post in self.posts if
+            end < datetime.utcfromtimestamp(post.created_utc) <= start]
+
+    def get_comments(self, post):
+        if post.id in self.failing:
+            raise IOError('timed out')
+        return post.comments
+
+
+class StubWriter(object):
+
+    batch_size = 3
+
+    def __init__(self):
+        self.batches = []
+
+    def write(self, records, college_info):
+        self.batches.append(len(records))
+
+
+class StubCountingClient(object):
+    """ Returns posts_per_hour posts for every hour of a window """
+
+    def __init__(self, posts_per_hour):
+        self.posts_per_hour = posts_per_hour
+
+    def get_posts(self, subreddit, start, end, sort='new'):
+        hours = (start - end).total_seconds() / 3600
+        return [None] * int(hours * self.posts_per_hour)
+
+
+class WindowTests(unittest.TestCase):
+
+    def setUp(self):
+        self.start = datetime(2015, 3, 1)
+        self.end = datetime(2015, 1, 1)
+
+    def windows(self, posts_per_hour):
+        policy = crawler.WindowPolicy(initial=timedelta(days=1),
+            saturation=100)
+        return [(upper, lower, len(posts)) for upper, lower, posts in
+            policy.listings(StubCountingClient(posts_per_hour), 'a',
+                self.start, self.end)]
+
+    def assertCovers(self, windows):
+        self.assertEqual(windows[0][0], self.start)
+        self.assertEqual(windows[-1][1], self.end)
+        for (_, lower, _), (upper, _, _) in zip(windows, windows[1:]):
+            self.assertEqual(lower, upper)
+
+    def test_busy_subreddits_get_small_windows(self):
+        windows = self.windows(10)
+        self.assertCovers(windows)
+        self.assertTrue(all(count < 100 for _, _, count in windows))
+
+    def test_quiet_subreddits_get_large_windows(self):
+        windows = self.windows(0.01)
+        self.assertCovers(windows)
+        self.assertEqual([(upper - lower).days for upper, lower, _ in windows],
+            [1, 2, 4, 8, 16, 28])
+
+    def test_checkpoint_resume_and_compaction(self):
+        db = mongomock_database(self)
+        checkpoint = CrawlCheckpoint(db, compact_after=2)
+        day = timedelta(days=1)
+        checkpoint.mark('a', self.start, self.start - 3 * day)
+        checkpoint.mark('a', self.start - 5 * day, self.start - 8 * day)
+        self.assertEqual(checkpoint.remaining('a', self.start,
+            self.start - 10 * day), [(self.start - 3 * day,
+            self.start - 5 * day), (self.start - 8 * day,
+            self.start - 10 * day)])
+        checkpoint.mark('a', self.start - 2 * day, self.start - 6 * day)
+        self.assertEqual(checkpoint.completed('a'),
+            [(self.start, self.start - 8 * day)])
+        self.assertEqual(len(db.crawl_checkpoints.find_one()['windows']), 1)
+        self.assertEqual(checkpoint.earliest('a'), self.start - 8 * day)
+        self.assertEqual(checkpoint.remaining('a', self.start,
+            self.start - 4 * day), [])
+
+    def test_tracker_marks_once_listed_and_written(self):
+        marked = []
+
+        class Checkpoint(object):
+            def mark(self, subreddit, upper, lower):
+                marked.append((upper, lower))
+        tracker = WindowTracker(Checkpoint(), 'a', 2, 1)
+        tracker.add()
+        tracker.add()
+        tracker.written()
+        tracker.finish_listing()
+        self.assertEqual(marked, [])
+        tracker.written()
+        self.assertEqual(marked, [(2, 1)])
+
+
+class PipelineTests(unittest.TestCase):
+
+    def test_backpressure(self):
+        consumed = []
+
+        def consume(item):
+            time.sleep(0.002)
+            consumed.append(item)
+        stages = [pipeline.Stage('produce', lambda n: range(n), 1, 10),
+            pipeline.Stage('consume', consume, 1, 2)]
+        flow = pipeline.Pipeline(stages)
+        flow.start()
+        flow.put(30)
+        flow.join()
+        self.assertEqual(sorted(consumed), range(30))
+        self.assertTrue(stages[1].metrics()['max_queue_depth'] <= 2)
+        # The producer was held back by the consumer's full queue.
+        self.assertTrue(stages[0].busy >= 0.03)
+
+    def test_errors_are_counted(self):
+        def parse(item):
+            return [int(item)]
+        stage = pipeline.Stage('parse', parse, 2, 10)
+        flow = pipeline.Pipeline([stage])
+        flow.start()
+        for item in ['1', 'x', '3']:
+            flow.put(item)
+        flow.join()
+        self.assertEqual(stage.metrics()['errors'], 1)
+        self.assertEqual(stage.metrics()['produced'], 2)
+
+    def test_batch_writer_flushes_on_join(self):
+        writer = StubWriter()
+        marked = []
+
+        class Checkpoint(object):
+            def mark(self, subreddit, upper, lower):
+                marked.append(subreddit)
+        tracker = WindowTracker(Checkpoint(), 'a', 2, 1)
+        college_info = {'name': 'a', 'subreddit': 'a'}
+        flow = pipeline.Pipeline([pipeline.Stage('write', BatchWriter(writer))])
+        flow.start()
+        for i in range(4):
+            tracker.add()
+            flow.put((college_info, {'reddit_id': i}, [], tracker))
+        tracker.finish_listing()
+        flow.join()
+        self.assertEqual(writer.batches, [3, 1])
+        self.assertEqual(marked, ['a'])
+
+    def test_failed_expansion_leaves_window_unmarked(self):
+        db = mongomock_database(self)
+        college_info, posts = benchmarks.synthetic_reddit(10, n_colleges=1,
+            days=3)[0]
+        failing = posts[0]
+        client = StubListingClient(posts, [failing.id])
+        checkpoint = CrawlCheckpoint(db)
+        crawler = PipelineCrawler([client], MongoDBService(db),
+            [college_info], checkpoint=checkpoint, log_interval=None)
+        start, end = datetime(2015, 1, 4), datetime(2015, 1, 1)
+        crawler.run([(college_info, start, end)])
+        self.assertEqual(list(crawler.failed),
+            [(college_info['name'], failing.id)])
+        self.assertEqual(db.posts.count(), 9)
+        created = datetime.utcfromtimestamp(failing.created_utc)
+        gaps = checkpoint.remaining(college_info['subreddit'], start, end)
+        self.assertEqual(len(gaps), 1)
+        self.assertTrue(gaps[0][1] < created <= gaps[0][0])
+
+
+class StubCursor(object):
+
+    def __init__(self, output, documents=()):
+        self.output = output
+        self.documents = iter(documents)
+
+    def clone(self):
+        return self
+
+    def explain(self):
+        return self.output
+
+    def limit(self, n):
+        return self
+
+    def next(self):
+        time.sleep(0.01)
+        return next(self.documents)
+
+
+class ProfilingTests(unittest.TestCase):
+
+    def test_explain_flags_collection_scans(self):
+        record = profiling.explain(StubCursor({
+            'queryPlanner': {'winningPlan': {'stage': 'FETCH',
+                'inputStage': {'stage': 'COLLSCAN'}}},
+            'executionStats': {'totalDocsExamined': 50, 'nReturned': 2,
+                'executionTimeMillis': 3}
+        }))
+        self.assertEqual(record['plan'], ['FETCH', 'COLLSCAN'])
+        self.assertEqual(record['docs_examined'], 50)
+        self.assertTrue(record['collscan'])
+        record = profiling.explain(StubCursor({'cursor': 'BtreeCursor x_1',
+            'nscannedObjects': 2, 'n': 2, 'millis': 0}))
+        self.assertFalse(record['collscan'])
+
+    def test_timed_cursor_covers_iteration(self):
+        profiling.take()
+        record = {'name': 'stub', 'millis': 0.0}
+        cursor = profiling.TimedCursor(StubCursor({}, [1, 2]), record)
+        self.assertTrue(cursor.limit(2) is cursor)
+        self.assertEqual(list(cursor), [1, 2])
+        self.assertEqual(profiling.take(), [record])
+        self.assertTrue(record['millis'] >= 20)
+
+    def test_summary_prefers_server_time(self):
+        profiling.take()
+        profiling.merge([{'name': 'q', 'millis': 50, 'server_millis': 4}])
+        self.assertEqual(
+            profiling.summary()['queries']['q']['max_millis'], 4)
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram((10, 100))
+        for value in (1, 10, 50, 1000):
+            histogram.observe(value)
+        self.assertEqual(histogram.json()['buckets'],
+            {'10': 2, '100': 1, '+Inf': 1})
+        self.assertEqual(histogram.json()['max'], 1000)
+
+    def test_stage_timings(self):
+        metrics.begin()
+        with metrics.stage('query'):
+            pass
+        timings = metrics.end('test')
+        self.assertEqual([name for name, _ in timings], ['query', 'total'])
+        self.assertTrue(metrics.server_timing(timings).startswith(
+            'query;dur='))
+
+    def test_timed_excludes_consumer_time(self):
+        def produce():
+            for i in range(2):
+                time.sleep(0.01)
+                yield i
+        metrics.begin()
+        for _ in metrics.timed('produce', produce()):
+            time.sleep(0.05)
+        timings = dict(metrics.end('test'))
+        self.assertTrue(20 <= timings['produce'] < 60)
+        self.assertTrue(timings['total'] >= 100)
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_synthetic_reddit_is_deterministic(self):
+        first = benchmarks.synthetic_reddit(10, n_colleges=2, seed=3)
+        second = benchmarks.synthetic_reddit(10, n_colleges=2, seed=3)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(
+            [(post.id, post.selftext, [comment.body for comment in post.comments])
+                for _, posts in first for post in posts],
+            [(post.id, post.selftext, [comment.body for comment in post.comments])
+                for _, posts in second for post in posts])
+
+    def test_suite_runs_offline(self):
+        try:
+            import mongomock
+        except ImportError:
+            self.skipTest('mongomock is not installed')
+        results = benchmarks.suite(scales=(5,))
+        self.assertEqual(set(result['benchmark'] for result in results),
+            set(['MongoDBService.save', 'MongoDBService.save unchanged',
+                'dao.join_comments', 'cosine_graph', 'cosine_graph top_k',
+                'KeywordExtractor.compute', 'KeywordExtractor.extract',
+                'SuffixTree.insert', 'SuffixTree.json']))
+        self.assertTrue(all(result['posts'] == 5 for result in results))
+
+    def test_suite_restores_database(self):
+        try:
+            import mongomock
+        except ImportError:
+            self.skipTest('mongomock is not installed')
+        self.assertRaises(TypeError, benchmarks.suite, scales=('x',))
+        self.assertTrue(mongo._database is None)
+
+    def test_record_per_kind(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'benchmarks.json')
+        suite = [{'posts': 5, 'benchmark': 'cosine_graph', 'seconds': 1.0}]
+        imports = [{'posts': 0, 'benchmark': 'import crawler', 'seconds': 0.5}]
+        self.assertEqual(benchmarks.record(suite, 'suite', path), None)
+        self.assertEqual(benchmarks.record(imports, 'imports', path), None)
+        previous = benchmarks.record(suite, 'suite', path)
+        self.assertEqual(previous['results'], suite)
+        slower = [dict(suite[0], seconds=2.0)]
+        self.assertEqual(benchmarks.compare(previous, slower),
+            [(5, 'cosine_graph', 1.0, 2.0, 2.0)])
+
+
+class PreprocessTests(unittest.TestCase):
+
+    def test_tokenize(self):
+        self.assertEqual(preprocess.tokenize('The computers and computing'),
+            ['comput', 'comput'])
+
+    def test_surface_forms(self):
+        forms = preprocess.surface_forms(['universities and studies',
+            'the university', 'university students'], ['univers', 'studi'])
+        self.assertEqual(forms, {'univers': 'university',
+            'studi': 'studies'})
+
+    def test_extract_pretokenized(self):
+        documents = [{'tokens': ['comput', 'scienc']},
+            {'tokens': ['comput', 'game', 'game']}]
+        extractor = KeywordExtractor(get_tokens=lambda x: x['tokens'])
+        keywords = extractor.extract(documents, threshold=0)
+        self.assertEqual(keywords[1][0][0], 'game')
+
+
+class StubJobStore(object):
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def load(self, college_info):
+        return self.jobs[college_info['subreddit']]
+
+    def save(self, job):
+        pass
+
+
+class SchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.colleges = [{'name': 'A', 'subreddit': 'a'},
+            {'name': 'B', 'subreddit': 'b'}]
+        store = StubJobStore({
+            'a': {'next_run': None},
+            'b': {'next_run': datetime.utcnow() + timedelta(hours=1)}
+        })
+        self.scheduler = jobs.Scheduler(None, [object()], None, self.colleges,
+            store=store, hooks=[], target_posts=10)
+
+    def test_interval_follows_post_rate(self):
+        self.assertEqual(self.scheduler.interval(5), timedelta(hours=2))
+        self.assertEqual(self.scheduler.interval(0), timedelta(days=1))
+        self.assertEqual(self.scheduler.interval(1000), timedelta(minutes=15))
+
+    def test_schedule_queues_due_jobs_once(self):
+        self.assertEqual(self.scheduler.schedule(), 1)
+        self.assertEqual(self.scheduler.due.get(), self.colleges[0])
+        self.assertEqual(self.scheduler.schedule(), 0)
+
+    def test_hooks_wait_for_the_crawl(self):
+        calls = []
+        job = {'next_run': datetime.utcnow() + timedelta(hours=1),
+            'last_run': datetime.utcnow(), 'hooks': {}}
+        scheduler = jobs.Scheduler(None, [object()], None, self.colleges[:1],
+            store=StubJobStore({'a': job}), hooks=[('rebuild',
+            timedelta(days=1), lambda db, colleges: calls.append(colleges))])
+        scheduler.running.add('a')
+        scheduler.schedule()
+        self.assertEqual(scheduler.maintenance, None)
+        scheduler.running.discard('a')
+        self.assertEqual(scheduler.schedule(), 0)
+        scheduler.maintenance.join()
+        self.assertEqual(calls, [self.colleges[:1]])
+        self.assertEqual(scheduler.running, set())
+        # Ran within the interval, not started again.
+        scheduler.schedule()
+        self.assertEqual(scheduler.maintenance, None)
+        self.assertEqual(len(calls), 1)
+
+
+class ReductionTests(unittest.TestCase):
+
+    def setUp(self):
+        # Two triangles joined by one edge and an isolated node.
+        self.pairs = [(0, 1), (1, 2), (0, 2), (3, 4), (4, 5), (3, 5), (2, 3)]
+
+    def test_components(self):
+        self.assertEqual(list(reduction.components(7, self.pairs)),
+            [0, 0, 0, 0, 0, 0, 1])
+
+    def test_clusters_collapse(self):
+        labels = reduction.clusters(7, self.pairs)
+        self.assertEqual(len(set(labels[:3])), 1)
+        self.assertEqual(len(set(labels[3:6])), 1)
+        sizes, edges = reduction.collapse(labels, self.pairs)
+        self.assertEqual(sorted(sizes), [1, 3, 3])
+        self.assertEqual([weight for _, _, weight in edges], [1])
+
+    def test_top_nodes_subgraph(self):
+        keep = reduction.top_nodes(reduction.degrees(7, self.pairs), 2)
+        self.assertEqual(list(keep), [2, 3])
+        self.assertEqual(reduction.subgraph(keep, self.pairs), [(0, 1)])
+
+    def test_invalid_options(self):
+        corpus = [{'_id': i, 'text': str(i), 'color': 'red', 'ups': 1}
+            for i in range(7)]
+        for options in [{'collapse': 'bogus'}, {'rank': 'bogus'},
+                {'max_nodes': 0}, {'max_nodes': -1}, {'cluster': -1}]:
+            self.assertRaises(handlers.RequestError,
+                handlers.graph_reduction, **options)
+        self.assertRaises(handlers.RequestError, handlers.reduced_graph,
+            corpus, self.pairs, cluster=999)
+        self.assertEqual(len(handlers.reduced_graph(corpus, self.pairs,
+            max_nodes=2, rank='ups')['nodes']), 2)
+
+    def test_compact_reduced_graph(self):
+        corpus = [{'_id': i, 'text': str(i), 'color': 'red'} for i in range(7)]
+        self.assertRaises(handlers.RequestError, handlers.cosine_graph,
+            corpus, 0.5, compact=True, collapse='components')
+        graph = handlers.reduced_graph(corpus, self.pairs, collapse='clusters',
+            cluster=reduction.clusters(7, self.pairs)[0], compact=True)
+        self.assertEqual(graph['nodes'], [['0', 'red'], ['1', 'red'],
+            ['2', 'red']])
+        self.assertEqual(graph['edges'], [0, 1, 1, 2, 0, 2])
+
+
+class SearchCursorTests(unittest.TestCase):
+
+    def test_cursor_round_trip(self):
+        document = {'created_utc': datetime(2015, 7, 9, 12, 30, 1, 250000),
+            '_id': ObjectId('55a0f1f2e138230c4c6d8b2a')}
+        self.assertEqual(handlers.decode_cursor(
+            handlers.encode_cursor(document)),
+            (document['created_utc'], document['_id']))
+
+    def test_invalid_requests(self):
+        for cursor in ['nope', '12-nope', 'x-55a0f1f2e138230c4c6d8b2a',
+                '1-2-3', '99999999999999999999-55a0f1f2e138230c4c6d8b2a']:
+            self.assertRaises(handlers.RequestError, handlers.decode_cursor,
+                cursor)
+        self.assertRaises(handlers.RequestError, handlers.search_handler,
+            'exam', kind='users')
+
+
+class DocumentRouteTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock_database(self)
+        import application
+        self.client = application.application.test_client()
+
+    def test_malformed_id(self):
+        self.assertRaises(handlers.RequestError, handlers.get_post_handler,
+            'nope')
+        self.assertEqual(self.client.get('/comment/nope').status_code, 400)
+
+    def test_missing_document(self):
+        _id = str(ObjectId())
+        self.assertRaises(handlers.NotFound, handlers.get_comments_handler,
+            _id)
+        self.assertEqual(self.client.get('/post/' + _id).status_code, 404)
+        self.assertEqual(
+            self.client.get('/posts/comments/' + _id).status_code, 404)
+
+    def test_post_and_comments(self):
+        comment = self.db.comments.insert({'text': 'hi',
+            'created_utc': datetime(2015, 1, 1)})
+        post = self.db.posts.insert({'text': 'post', 'comments': [comment],
+            'created_utc': datetime(2015, 1, 1)})
+        self.assertEqual(handlers.get_post_handler(str(post))['comments'],
+            [str(comment)])
+        self.assertEqual([document['text'] for document in
+            handlers.get_comments_handler(str(post))], ['hi'])
+
+    def test_streamed_graph_invalid_date(self):
+        response = self.client.get('/College 0/nope/Jan 1 2030/0.5?stream=1')
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue('Jul 9 2015' in response.data)
+
+    def test_invalid_graph_options(self):
+        for query in ['collapse=bogus', 'rank=bogus', 'cluster=999',
+                'max_nodes=0']:
+            response = self.client.get(
+                '/College 0/Jan 1 2015/Jan 1 2030/0.5?' + query)
+            self.assertEqual(response.status_code, 400)
+
+    def test_watermark_read_once(self):
+        college_info, posts = benchmarks.synthetic_reddit(10,
+            n_colleges=1)[0]
+        MongoDBService(self.db).save(posts, college_info,
+            lambda post: post.comments)
+        self.assertEqual(self.db.watermarks.find({'college': '*'}).count(), 1)
+        watermark = dao.watermark
+        calls = []
+
+        def counting(college):
+            calls.append(college)
+            return watermark(college)
+        dao.watermark = counting
+        self.addCleanup(setattr, dao, 'watermark', watermark)
+        handlers.results.clear()
+        self.assertEqual(self.client.get('/colleges').status_code, 200)
+        self.assertEqual(calls, ['*'])
+        del calls[:]
+        response = self.client.get('/{}/Jan 1 2000/Jan 1 2030/0.5'.format(
+            college_info['name']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(calls, [college_info['name']])
+
+
+class VocabularyTests(unittest.TestCase):
+
+    def test_rebuild_swaps_versions(self):
+        db = mongomock_database(self)
+        college_info, posts = benchmarks.synthetic_reddit(10,
+            n_colleges=1)[0]
+        service = MongoDBService(db,
+            listeners=[vocabulary.DocumentFrequencyUpdater(db)])
+        service.save(posts, college_info, lambda post: post.comments)
+        college = college_info['name']
+        incremental = vocabulary.TfidfModel.load(db, college)
+        vocabulary.rebuild(db, [college_info])
+        rebuilt = vocabulary.TfidfModel.load(db, college)
+        self.assertEqual(rebuilt.vocabulary, incremental.vocabulary)
+        self.assertTrue(np.allclose(rebuilt.idf, incremental.idf))
+        vocabulary.rebuild(db, [college_info])
+        self.assertEqual(sorted(db.document_frequencies.distinct('version')),
+            [1, 2])
+        self.assertEqual(db.document_frequencies.count(),
+            2 * len(incremental.vocabulary))
+        self.assertEqual(db.corpus_stats.find_one()['version'], 2)
+        self.assertTrue(np.allclose(
+            vocabulary.TfidfModel.load(db, college).idf, incremental.idf))
+
+    def test_rebuild_replays_concurrent_writes(self):
+        db = mongomock_database(self)
+        (college_info, posts), (_, later) = benchmarks.synthetic_reddit(10,
+            n_colleges=2)
+        for post in later:
+            post.id += '_later'
+        service = MongoDBService(db,
+            listeners=[vocabulary.DocumentFrequencyUpdater(db)])
+        service.save(posts, college_info, lambda post: post.comments)
+        scan = vocabulary._scan
+
+        def crawling_scan(*args):
+            # A crawl writes while the first collection is scanned.
+            if later:
+                service.save(later, college_info, lambda post: post.comments)
+                del later[:]
+            return scan(*args)
+        self.addCleanup(setattr, vocabulary, '_scan', scan)
+        vocabulary._scan = crawling_scan
+        vocabulary.rebuild(db, [college_info])
+        college = college_info['name']
+        replayed = vocabulary.TfidfModel.load(db, college)
+        stats = db.corpus_stats.find_one()
+        vocabulary._scan = scan
+        vocabulary.rebuild(db, [college_info])
+        rebuilt = vocabulary.TfidfModel.load(db, college)
+        self.assertEqual(stats['documents'],
+            db.corpus_stats.find_one()['documents'])
+        self.assertEqual(replayed.vocabulary, rebuilt.vocabulary)
+        self.assertTrue(np.allclose(replayed.idf, rebuilt.idf))
+
+
+class RollupTests(unittest.TestCase):
+
+    def buckets(self, db, college, resolution):
+        return [(bucket['time'], bucket.get('posts', 0),
+            bucket.get('comments', 0)) for bucket in rollups.activity(db,
+            college, datetime(2014, 12, 1), datetime(2015, 3, 1), resolution)]
+
+    def test_incremental_counts_match_backfill(self):
+        db = mongomock_database(self)
+        colleges = benchmarks.synthetic_reddit(20, n_colleges=2, days=5)
+        service = MongoDBService(db, listeners=[rollups.ActivityRollup(db)])
+        for college_info, posts in colleges:
+            service.save(posts, college_info, lambda post: post.comments)
+        infos = [college_info for college_info, _ in colleges]
+        incremental = dict(((college_info['name'], resolution),
+            self.buckets(db, college_info['name'], resolution))
+            for college_info in infos for resolution in rollups.COLLECTIONS)
+        rollups.backfill(db, infos)
+        for (college, resolution), buckets in incremental.iteritems():
+            self.assertTrue(buckets)
+            self.assertEqual(self.buckets(db, college, resolution), buckets)
+        daily = incremental[infos[0]['name'], 'day']
+        self.assertEqual(sum(posts for _, posts, _ in daily), 20)
+
+    def test_backfill_replaces_buckets_in_place(self):
+        db = mongomock_database(self)
+        college_info, posts = benchmarks.synthetic_reddit(10,
+            n_colleges=1, days=3)[0]
+        service = MongoDBService(db, listeners=[rollups.ActivityRollup(db)])
+        service.save(posts, college_info, lambda post: post.comments)
+        college = college_info['name']
+        expected = self.buckets(db, college, 'day')
+        # Drifted counts and a bucket without any document.
+        db.activity_daily.update({'college': college}, {'$inc': {'posts': 5}},
+            multi=True)
+        db.activity_daily.insert({'college': college, 'posts': 1,
+            'comments': 0, 'time': datetime(2015, 2, 20)})
+        ids = sorted(bucket['_id'] for bucket in db.activity_daily.find(
+            {'college': college, 'time': {'$lt': datetime(2015, 2, 20)}}))
+        rollups.backfill(db, [college_info])
+        self.assertEqual(self.buckets(db, college, 'day'), expected)
+        self.assertEqual(sorted(bucket['_id'] for bucket in
+            db.activity_daily.find({'college': college})), ids)
+
+    def test_unknown_resolution(self):
+        self.assertRaises(handlers.RequestError, handlers.activity_handler,
+            'a', 'Jan 1 2015', 'Jan 2 2015', 'minute')
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def test_export_round_trip(self):
+        db = mongomock_database(self)
+        colleges = benchmarks.synthetic_reddit(15, n_colleges=2, days=60)
+        service = MongoDBService(db)
+        for college_info, posts in colleges:
+            service.save(posts, college_info, lambda post: post.comments)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        root = os.path.join(directory, 'snapshot')
+        infos = [college_info for college_info, _ in colleges]
+        snapshot.export(db, root, infos)
+        snapshot.export(db, root, infos)
+        snapshot.export(db, root, infos)
+        self.assertTrue(os.path.islink(root))
+        self.assertEqual(len(os.listdir(directory)), 3)
+        reader = snapshot.Snapshot(root)
+        college = infos[0]['name']
+        start, end = datetime(2014, 12, 1), datetime(2015, 4, 1)
+        expected = dao.join_comments(list(db.posts.find({'college': college},
+            dao.POST_FIELDS)))
+        corpus = reader.corpus(college, start, end)
+        self.assertEqual(dict((document['_id'], document['text'])
+            for document in corpus), dict((document['_id'], document['text'])
+            for document in expected))
+        counts, terms = reader.counts(college, start, end)
+        self.assertEqual(counts.shape[0], len(corpus))
+        for row, document in zip(counts, corpus):
+            self.assertEqual(dict((terms[i], value) for i, value in
+                zip(row.indices, row.data)), Counter(document['tokens']))
+
+    def test_months(self):
+        self.assertEqual(snapshot.months(datetime(2014, 11, 20),
+            datetime(2015, 2, 1)), ['2014-11', '2014-12', '2015-01', '2015-02'])
+
+    def test_millis_round_trip(self):
+        dt = datetime(2015, 7, 9, 12, 30, 1, 250000)
+        self.assertEqual(snapshot.from_millis(snapshot.to_millis(dt)), dt)
+
+    def test_vocabulary_encoding(self):
+        vocabulary = snapshot.Vocabulary()
+        self.assertEqual(vocabulary.encode(['a', 'b', 'a']), [0, 1, 0])
+        self.assertEqual(vocabulary.terms, ['a', 'b'])
+
+
+class ComparisonTests(unittest.TestCase):
+
+    def setUp(self):
+        self.results = [('b', Counter({'game': 10, 'class': 5}), 3),
+            ('a', Counter({'exam': 12, 'class': 5}), 4)]
+
+    def test_count_matrix(self):
+        colleges, terms, counts, documents = comparison.count_matrix(
+            self.results)
+        self.assertEqual(colleges, ['a', 'b'])
+        self.assertEqual(documents, [4, 3])
+        self.assertEqual(sorted(terms), ['class', 'exam', 'game'])
+        self.assertEqual(counts.sum(), 32)
+
+    def test_log_odds(self):
+        colleges, terms, counts, _ = comparison.count_matrix(self.results)
+        scores = comparison.log_odds(counts)
+        column = dict((term, i) for i, term in enumerate(terms))
+        self.assertTrue(scores[0, column['exam']] > 0)
+        self.assertTrue(scores[1, column['exam']] < 0)
+        self.assertTrue(scores[1, column['game']] >
+            scores[1, column['class']])
+
+    def test_compare_store_and_stored(self):
+        db = mongomock_database(self)
+        service = MongoDBService(db)
+        colleges = benchmarks.synthetic_reddit(20, n_colleges=2, days=10)
+        for college_info, posts in colleges:
+            service.save(posts, college_info, lambda post: post.comments)
+        names = [college_info['name'] for college_info, _ in colleges]
+        start, end = datetime(2015, 1, 1), datetime(2015, 2, 1)
+        table = comparison.compare(names, start, end, top_k=3, min_count=2,
+            pool=ThreadPool(2))
+        self.assertEqual(sorted(table['colleges']), names)
+        for college in names:
+            self.assertTrue(table['colleges'][college]['documents'] > 20)
+            self.assertEqual(len(table['colleges'][college]['terms']), 3)
+        current = (None, 1)
+        comparison.store(db, start, end, 'log_odds', 3, names, table, current)
+        self.assertEqual(comparison.stored(db, start, end, 'log_odds', 3,
+            list(reversed(names)), current, max_age=timedelta(0)), table)
+        # Written to since, but still young enough.
+        self.assertEqual(comparison.stored(db, start, end, 'log_odds', 3,
+            names, (None, 2)), table)
+        self.assertEqual(comparison.stored(db, start, end, 'log_odds', 3,
+            names, (None, 2), max_age=timedelta(0)), None)
+        self.assertEqual(comparison.stored(db, start, end, 'tfidf', 3,
+            names, current), None)
+
+    def test_compare_timeout(self):
+        mongomock_database(self)
+        # The only worker is busy, the colleges are never read.
+        pool = ThreadPool(1)
+        self.addCleanup(pool.terminate)
+        pool.apply_async(time.sleep, (0.5,))
+        self.addCleanup(setattr, analysis, '_pool', analysis._pool)
+        analysis._pool = pool
+        self.addCleanup(setattr, config, 'COMPARISON_TIMEOUT',
+            config.COMPARISON_TIMEOUT)
+        config.COMPARISON_TIMEOUT = 0.05
+        start = time.time()
+        try:
+            handlers.comparison_handler('Jan 1 2015', 'Jan 10 2015', ['a'])
+            self.fail('The comparison did not time out')
+        except handlers.Timeout as error:
+            self.assertEqual(error.status, 504)
+        self.assertTrue(time.time() - start < 0.4)
+
 
 if __name__ == '__main__': 
     unittest.main()
\ No newline at end of file
@@ -1,67 +1,99 @@
-from collections import deque
-from random import random
 
 class SuffixTree(object):
+    """
+    Trie of the phrases following a root word. Every node counts how many
+    inserted sequences went through it, which is the weight of the edge
+    from its parent.
+    """
 
     def __init__(self, root_word):
         self.root_word = root_word
         self.root = Node(root_word)
 
     def insert(self, tokens):
-        q = deque(tokens)
-        self._traverse(self.root, q)
+        node = self.root
+        node.count += 1
+        for term in tokens:
+            # Repeating the current term (e.g. the root word) doesn't
+            # start a new branch.
+            if term == node.term:
+                continue
+            child = node.children.get(term)
+            if child is None:
+                child = node.children[term] = Node(term)
+            child.count += 1
+            node = child
 
-    def _traverse(self, node, q):
-        if not q:
-            return 
-        term = q.popleft()
-        if term == node.term:
-            self._traverse(node, q)
-            return
-        if term not in node._set:
-            new_node = Node(term, parent=node)
-            node._set.add(term)
-            node.nodes.append(new_node)
-            self._traverse(new_node, q)
-        else:
-            for n in node.nodes:
-                if term == n.term:
-                    self._traverse(n, q)
-        self._traverse(node, q)
+    def insert_many(self, sequences):
+        """
+        Input:
+            sequences iterable<list<str>>: token sequences
+        """
+        for tokens in sequences:
+            self.insert(tokens)
 
-    def json(self):
+    def prune(self, min_count=1, top_k=None):
+        """
+        Drop the branches seen fewer than min_count times and keep at most
+        the top_k most frequent children of every node.
+        """
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            node.children = dict((child.term, child)
+                for child in node.ranked(min_count, top_k))
+            stack.extend(node.children.itervalues())
+
+    def json(self, min_count=1, top_k=None, max_depth=None):
+        """
+        Serialize the tree without modifying it.
+
+        Input:
+            min_count <int>: skip branches seen fewer times
+            top_k <int>: only keep the most frequent children of every node
+            max_depth <int>: stop below this depth
+
+        Returns: {'nodes': [{'term', 'depth', 'count'}],
+            'edges': [{'source', 'target', 'weight'}]}
+        """
         nodes = []
         edges = []
-        location = {}
-        self._json_traverse(self.root, nodes, edges, location, 0)
-        return {'nodes': nodes, 'edges' : edges}
-
-    def _json_traverse(self, node, nodes, edges, location, depth):
-        n = {'term': node.term,
-            'depth': depth}
-        nodes.append(n)
-        location[node.term] = len(nodes) - 1
-        depth += 1
-        if node.parent:
-            e = {'source': location[node.parent.term], 
-                'target': location[node.term],
-                'weight': len(node.nodes)
-                }
-            edges.append(e)
-        for child in node.nodes:
-            child.depth = depth
-            self._json_traverse(child, nodes, edges, location, depth)
-        return 
+        stack = [(self.root, None, 0)]
+        while stack:
+            node, parent, depth = stack.pop()
+            index = len(nodes)
+            nodes.append({'term': node.term, 'depth': depth,
+                'count': node.count})
+            if parent is not None:
+                edges.append({'source': parent, 'target': index,
+                    'weight': node.count})
+            if max_depth is not None and depth >= max_depth:
+                continue
+            # Reversed so the most frequent child is serialized first.
+            for child in reversed(node.ranked(min_count, top_k)):
+                stack.append((child, index, depth + 1))
+        return {'nodes': nodes, 'edges': edges}
 
 
 class Node(object):
 
-    def __init__(self, term, parent=None):
-        self._set = set()
+    __slots__ = ('term', 'children', 'count')
+
+    def __init__(self, term):
         self.term = term
-        self.nodes = []
-        self.parent = parent
-        self.depth = 0
+        self.children = {}
+        self.count = 0
+
+    def ranked(self, min_count=1, top_k=None):
+        """
+        Returns: children seen at least min_count times, most frequent first
+        """
+        if not self.children:
+            return []
+        children = sorted((child for child in self.children.itervalues()
+            if child.count >= min_count),
+            key=lambda child: (-child.count, child.term))
+        return children[:top_k]
 
     def __repr__(self):
         return '<Node %s>' % self.term
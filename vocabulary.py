@@ -0,0 +1,280 @@
+import threading
+import time
+from collections import Counter
+import numpy as np
+from scipy import sparse
+import preprocess
+
+FREQUENCY_COLLECTION = 'document_frequencies'
+STATS_COLLECTION = 'corpus_stats'
+# Hashing mode maps terms to a fixed number of buckets so the model never
+# has to store or load a vocabulary.
+HASHING = False
+N_FEATURES = 2 ** 18
+
+_murmurhash = None
+
+def analyze(document):
+    """
+    Stemmed tokens of a document, the ones stored by the crawler when
+    present.
+    """
+    tokens = document.get('tokens')
+    if tokens is None:
+        tokens = preprocess.tokenize(document['text'])
+    return tokens
+
+def frequency_spec(college, hashing, version):
+    """
+    Query of the document frequencies of one version of a college's model.
+    Frequencies written before models were versioned have no version.
+    """
+    return {'college': college, 'hashed': hashing,
+        'version': version if version else {'$exists': False}}
+
+def feature_key(term, hashing=HASHING, n_features=N_FEATURES):
+    global _murmurhash
+    if hashing:
+        if _murmurhash is None:
+            from sklearn.utils import murmurhash3_32
+            _murmurhash = murmurhash3_32
+        return _murmurhash(term, positive=True) % n_features
+    return term
+
+
+class DocumentFrequencyUpdater(object):
+    """
+    Keeps the per-college document frequencies up to date as the crawler
+    inserts documents. Registered as a MongoDBService listener.
+    """
+
+    def __init__(self, db, hashing=HASHING, n_features=N_FEATURES):
+        self.db = db
+        self.hashing = hashing
+        self.n_features = n_features
+
+    def on_write(self, college_info, posts, comments):
+        """
+        Input:
+            college_info <dict>: {'name', 'subreddit'}
+            posts list<dict>: newly inserted posts
+            comments list<dict>: newly inserted comments
+        """
+        documents = posts + comments
+        if not documents:
+            return
+        college = college_info['name']
+        spec = {'college': college, 'hashed': self.hashing}
+        stats = self.db[STATS_COLLECTION].find_one(spec, {'version': True})
+        self.store(college, self.frequencies(documents),
+            stats.get('version', 0) if stats else 0)
+        self.db[STATS_COLLECTION].update(spec,
+            {'$inc': {'documents': len(documents)}}, upsert=True)
+
+    def on_update(self, college_info, documents, previous):
+        """
+        Move the document frequencies of edited documents from their
+        previous terms to their new ones.
+
+        Input:
+            documents list<dict>: edited posts and comments
+            previous list<dict>: their stored versions
+        """
+        college = college_info['name']
+        stats = self.db[STATS_COLLECTION].find_one(
+            {'college': college, 'hashed': self.hashing}, {'version': True})
+        changes = self.frequencies(documents)
+        changes.subtract(self.frequencies(previous))
+        self.store(college, dict((key, count) for key, count in
+            changes.iteritems() if count), stats.get('version', 0)
+            if stats else 0)
+
+    def frequencies(self, documents):
+        """
+        Returns: Counter of the number of documents every feature is in
+        """
+        frequencies = Counter()
+        for document in documents:
+            frequencies.update(set(feature_key(term, self.hashing,
+                self.n_features) for term in analyze(document)))
+        return frequencies
+
+    def store(self, college, frequencies, version):
+        if not frequencies:
+            return
+        spec = frequency_spec(college, self.hashing, version)
+        bulk = self.db[FREQUENCY_COLLECTION].initialize_unordered_bulk_op()
+        for key, count in frequencies.iteritems():
+            bulk.find(dict(spec, key=key)).upsert().update(
+                {'$inc': {'df': count}})
+        bulk.execute()
+
+
+class TfidfModel(object):
+    """
+    Request time tfidf vectorizer backed by the persisted document
+    frequencies. Produces the same smoothed, l2 normalized vectors as
+    sklearn's TfidfTransformer.
+    """
+
+    def __init__(self, n_documents, frequencies, hashing=HASHING,
+            n_features=N_FEATURES):
+        """
+        Input:
+            n_documents <int>: number of documents in the college's corpus
+            frequencies <dict>: feature key to document frequency
+            hashing <bool>: keys are hash buckets instead of terms
+            n_features <int>: number of hash buckets
+        """
+        self.hashing = hashing
+        self.n_features = n_features
+        if hashing:
+            self.vocabulary = None
+            df = np.zeros(n_features)
+            for key, count in frequencies.iteritems():
+                df[key] = count
+        else:
+            terms = sorted(frequencies)
+            self.vocabulary = dict((term, i) for i, term in enumerate(terms))
+            df = np.array([frequencies[term] for term in terms], dtype=float)
+        self.idf = np.log((1.0 + n_documents) / (1.0 + df)) + 1.0
+
+    @classmethod
+    def load(cls, db, college, hashing=HASHING, n_features=N_FEATURES):
+        """
+        Returns: the college's TfidfModel or None if it hasn't been crawled
+        """
+        stats = db[STATS_COLLECTION].find_one({'college': college,
+            'hashed': hashing})
+        if not stats:
+            return None
+        frequencies = dict((record['key'], record['df']) for record in
+            db[FREQUENCY_COLLECTION].find(frequency_spec(college, hashing,
+                stats.get('version', 0)),
+                {'_id': False, 'key': True, 'df': True}))
+        return cls(stats['documents'], frequencies, hashing, n_features)
+
+    def transform(self, texts):
+        """
+        Input:
+            texts list<str>: documents
+
+        Returns: scipy.sparse.csr_matrix of l2 normalized tfidf vectors
+        """
+        return self.transform_tokens(map(preprocess.tokenize, texts))
+
+    def transform_tokens(self, sequences):
+        """
+        Input:
+            sequences list<list<str>>: tokens of every document
+
+        Returns: scipy.sparse.csr_matrix of l2 normalized tfidf vectors
+        """
+        indices = []
+        indptr = [0]
+        for tokens in sequences:
+            for term in tokens:
+                if self.hashing:
+                    indices.append(feature_key(term, True, self.n_features))
+                elif term in self.vocabulary:
+                    indices.append(self.vocabulary[term])
+            indptr.append(len(indices))
+        counts = sparse.csr_matrix(
+            (np.ones(len(indices)), indices, indptr),
+            shape=(len(sequences), len(self.idf)))
+        counts.sum_duplicates()
+        from sklearn import preprocessing
+        return preprocessing.normalize(counts.multiply(self.idf).tocsr())
+
+
+_models = {}
+_lock = threading.Lock()
+
+def get_model(db, college, max_age=300):
+    """
+    Lazily load a college's model, reusing it for max_age seconds.
+    """
+    with _lock:
+        cached = _models.get(college)
+    if cached and time.time() - cached[0] < max_age:
+        return cached[1]
+    model = TfidfModel.load(db, college)
+    with _lock:
+        _models[college] = (time.time(), model)
+    return model
+
+
+def rebuild(db, colleges, hashing=HASHING, n_features=N_FEATURES,
+        batch_size=1000):
+    """
+    Recompute the document frequencies of the given colleges from the posts
+    and comments already in the database.
+
+    The frequencies are written as a new version next to the current one,
+    which readers keep loading until the stats document is switched to the
+    new version. The version before the current one is removed then, so a
+    reader that loaded the old stats just before the switch still finds
+    its frequencies. Documents inserted during the scan are counted by the
+    listeners into the current version only, they are replayed into the
+    new one before the switch.
+
+    Input:
+        db: pymongo database
+        colleges list<dict>: {'name', 'subreddit'}
+    """
+    updater = DocumentFrequencyUpdater(db, hashing, n_features)
+    for college_info in colleges:
+        college = college_info['name']
+        spec = {'college': college, 'hashed': hashing}
+        stats = db[STATS_COLLECTION].find_one(spec) or {}
+        current = stats.get('version', 0)
+        version = current + 1
+        # Leftovers of an interrupted rebuild.
+        db[FREQUENCY_COLLECTION].remove(frequency_spec(college, hashing,
+            version))
+        collections = ('posts', 'comments')
+        scanned = {}
+        for collection in collections:
+            newest = list(db[collection].find({'college': college},
+                {'_id': True}).sort('_id', -1).limit(1))
+            scanned[collection] = newest[0]['_id'] if newest else None
+        documents = 0
+        for collection in collections:
+            if scanned[collection] is not None:
+                documents += _scan(db[collection], updater, college,
+                    version, {'$lte': scanned[collection]}, batch_size)
+        for collection in collections:
+            newer = ({'$gt': scanned[collection]}
+                if scanned[collection] is not None else {'$exists': True})
+            documents += _scan(db[collection], updater, college, version,
+                newer, batch_size)
+        db[STATS_COLLECTION].update(spec, {'$set': {'documents': documents,
+            'version': version}}, upsert=True)
+        retired = {'$nin': [current, version]}
+        if not current:
+            retired['$exists'] = True
+        db[FREQUENCY_COLLECTION].remove(dict(spec, version=retired))
+
+
+def _scan(collection, updater, college, version, ids, batch_size):
+    """
+    Store the frequencies of a college's documents whose _id matches ids.
+
+    Returns: number of documents read
+    """
+    documents = 0
+    batch = []
+    for document in collection.find({'college': college, '_id': ids},
+            {'text': True, 'tokens': True}):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            updater.store(college, updater.frequencies(batch), version)
+            documents += len(batch)
+            batch = []
+    updater.store(college, updater.frequencies(batch), version)
+    return documents + len(batch)
+
+if __name__ == '__main__':
+    import mongo
+    from config import SUBREDDITS
+    rebuild(mongo.get_db(), SUBREDDITS)